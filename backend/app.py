@@ -1,17 +1,24 @@
-import re, time
-from pathlib import Path
-from typing import List, Optional, Dict, Any
+import asyncio, html, logging, math, os, re, time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Optional, Dict, Any, BinaryIO, Callable
 from urllib.parse import quote
 
+import anyio
 from fastapi import FastAPI, Request, status
-from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
-from google.genai.errors import ClientError, ServerError
-
-from gemini_client import generate_text, generate_image_png_bytes
+import gemini_client
+import metrics
+from gemini_client import agenerate_text, agenerate_image, astream_text
+import rate_limit
+from rate_limit import RateLimited
 from prompts import (
     SYSTEM_RULES,
     OUTPUT_FORMAT_FIRST,
@@ -20,24 +27,89 @@ from prompts import (
     LENGTH_GUIDE, TONE_GUIDE, GENRE_GUIDE, AGE_GUIDE
 )
 import storage
-from pdf_utils import text_to_pdf_bytes
+import export_cache
+import bulk_export
+import images
+from cache import llm_cache, cache_mode
+import render_pool
+from jobs import job_queue
+from streaming import SectionParser, sse_event
+import story_context
+
+log = logging.getLogger(__name__)
 
 
 # ---------------------------
 # App setup
 # ---------------------------
-app = FastAPI()
-
+async def warmup():
+    """
+    Optional startup work, run after the server is already accepting
+    requests. Each step is also done lazily on first use, so a request
+    that arrives first is only slower, never wrong.
+    """
+    steps = (
+        ("db", lambda: asyncio.to_thread(storage.init_db)),   # PRAGMA + migration
+        ("jobs", job_queue.recover),                          # job ที่ค้างจากรอบก่อน
+        ("gemini", lambda: asyncio.to_thread(gemini_client.get_client)),  # import SDK + connection pool
+        ("pdf", render_pool.warmup),                          # spawn worker + ลงทะเบียน font ไทย
+    )
+    for name, step in steps:
+        t0 = time.perf_counter()
+        try:
+            await step()
+        except Exception:
+            # เช่น ยังไม่ได้ตั้ง GEMINI_API_KEY -> request แรกจะได้ error เดิม
+            log.warning("warmup %s failed", name, exc_info=True)
+        else:
+            log.info("warmup %s: %.0f ms", name, (time.perf_counter() - t0) * 1000)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await job_queue.start()
+    image_gc = asyncio.create_task(images.gc_loop())
+    warm = asyncio.create_task(warmup())
+    yield
+    warm.cancel()
+    image_gc.cancel()
+    await job_queue.stop()
+    await gemini_client.aclose()
+    render_pool.shutdown()
+    storage.close_connections()
+
+
+app = FastAPI(lifespan=lifespan)
+# Server-Timing header + http_request_seconds ของทุก request
+app.add_middleware(metrics.ServerTimingMiddleware)
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """Generated images never change once written (ชื่อไฟล์มาจาก hash ของเนื้อหา)."""
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200 and "/" not in path:
+            response.headers["Cache-Control"] = images.IMMUTABLE_CACHE_CONTROL
+            images.note_access(path)
+        return response
+
+
+# ต้อง mount ก่อน /static (route แรกที่ตรงได้ไป)
+images.IMAGE_DIR.mkdir(parents=True, exist_ok=True)
+app.mount("/static/generated", ImmutableStaticFiles(directory=str(images.IMAGE_DIR)), name="generated")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 DEFAULT_MODEL = "gemini-2.5-flash"
 IMAGE_MODEL = "gemini-2.5-flash-image"
 
-GENERATED_DIR = Path("static/generated")
-GENERATED_DIR.mkdir(parents=True, exist_ok=True)
+# requests/sec:burst ต่อ model (ทับได้ด้วย RATE_LIMITS ใน .env)
+rate_limit.configure({DEFAULT_MODEL: "2:10", IMAGE_MODEL: "0.5:4"})
+RATE_LIMIT_MESSAGE = "429 Rate limit: รอสักครู่แล้วลองใหม่ครับ"
 
-storage.init_db()
+# ปิด buffering ของ proxy (nginx) ให้ event ออกไปทันที
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
 
 # ---------------------------
@@ -62,6 +134,13 @@ class StoryBody(BaseModel):
     characters: List[Character] = Field(default_factory=list)
     relationships: str = ""
     want_illustration_prompt: bool = True
+    # สร้าง illustration prompt พร้อมกับเนื้อเรื่อง (ไม่รอ title) -> ลด latency เกือบครึ่ง
+    concurrent_illustration: bool = True
+
+
+class BatchBody(BaseModel):
+    items: List[StoryBody] = Field(..., min_length=1, max_length=100)
+    concurrency: int = Field(4, ge=1, le=16, description="Stories generated at the same time")
 
 
 class NextBody(BaseModel):
@@ -107,43 +186,8 @@ def _parse_next_chapter(text: str):
     return title or "Next Chapter", chapter
 
 
-def _slug_filename(title: str, story_id: int) -> str:
-    filename_base = re.sub(r"[^a-zA-Z0-9ก-๙ _-]+", "", title).strip() or f"story_{story_id}"
-    return filename_base[:80]
-
-
-# ---------------------------
-# Pages (HTML)
-# ---------------------------
-@app.get("/", response_class=HTMLResponse)
-def page_home(request: Request):
-    return templates.TemplateResponse("home.html", {"request": request, "title": "Home"})
-
-
-@app.get("/create", response_class=HTMLResponse)
-def page_create(request: Request):
-    return templates.TemplateResponse("create.html", {"request": request, "title": "Create"})
-
-
-@app.get("/stories", response_class=HTMLResponse)
-def page_stories(request: Request):
-    return templates.TemplateResponse("stories.html", {"request": request, "title": "Stories"})
-
-
-@app.get("/story/{story_id}", response_class=HTMLResponse)
-def page_story(request: Request, story_id: int):
-    return templates.TemplateResponse("story.html", {"request": request, "title": "Story", "story_id": story_id})
-
-
-# ---------------------------
-# API (JSON)
-# ---------------------------
-@app.post("/api/generate")
-def api_generate_story(body: StoryBody):
-    idea = (body.idea or "").strip()
-    if not idea:
-        return JSONResponse({"error": "กรุณาพิมพ์ไอเดียหรือพล็อตที่ต้องการก่อนครับ"}, status_code=400)
-
+@metrics.timed("prompt", metrics.PROMPT_SECONDS)
+def _story_context(body: StoryBody) -> Dict[str, Any]:
     genre = _safe_map(GENRE_GUIDE, body.genre, "แฟนตาซี")
     tone = _safe_map(TONE_GUIDE, body.tone, "อบอุ่น ให้กำลังใจ")
     length = _safe_map(LENGTH_GUIDE, body.length, "ประมาณ 300-500 คำ")
@@ -165,22 +209,33 @@ def api_generate_story(body: StoryBody):
         "characters": [c.model_dump() for c in chars],
         "relationships": body.relationships.strip(),
     }
-    outline_block = (body.outline or "").strip()
+    return {
+        "genre": genre,
+        "tone": tone,
+        "length": length,
+        "age": age,
+        "char_block": char_block,
+        "options": options_for_store,
+    }
+
 
-    prompt = f"""{SYSTEM_RULES}
+@metrics.timed("prompt", metrics.PROMPT_SECONDS)
+def _story_prompt(body: StoryBody, idea: str, ctx: Dict[str, Any]) -> str:
+    outline_block = (body.outline or "").strip()
+    return f"""{SYSTEM_RULES}
 {OUTPUT_FORMAT_FIRST}
 
 [Options]
-Genre: {genre}
-Tone: {tone}
-Target age: {age}
-Length: {length}
+Genre: {ctx["genre"]}
+Tone: {ctx["tone"]}
+Target age: {ctx["age"]}
+Length: {ctx["length"]}
 
 Setting: {body.setting}
 Theme / Moral direction: {body.theme}
 
 Characters:
-{char_block}
+{ctx["char_block"]}
 
 Relationships (if any):
 {body.relationships.strip() or "(none)"}
@@ -192,136 +247,560 @@ Relationships (if any):
 {idea}
 """
 
-    try:
-        full_text = generate_text(DEFAULT_MODEL, prompt)
-        title = _extract_title(full_text)
-
-        illustration_prompt: Optional[str] = None
-        if body.want_illustration_prompt:
-            iprompt = f"""{ILLUSTRATION_PROMPT_RULES}
 
-[Story Title]
-{title}
+@metrics.timed("prompt", metrics.PROMPT_SECONDS)
+def _illustration_prompt(body: StoryBody, idea: str, ctx: Dict[str, Any], title: Optional[str] = None) -> str:
+    # title=None -> โหมด concurrent (ยังไม่มีชื่อเรื่องตอนเริ่ม)
+    title_block = f"[Story Title]\n{title}\n\n" if title else ""
+    return f"""{ILLUSTRATION_PROMPT_RULES}
 
-[Story Context]
-Genre: {genre}
-Tone: {tone}
+{title_block}[Story Context]
+Genre: {ctx["genre"]}
+Tone: {ctx["tone"]}
 Setting: {body.setting}
 Characters:
-{char_block}
+{ctx["char_block"]}
 
 User idea:
 {idea}
 """
-            illustration_prompt = generate_text(DEFAULT_MODEL, iprompt)
 
-        story_id = storage.create_story(options_for_store, title, full_text, illustration_prompt)
 
-        # เก็บ chapter 1
-        storage.add_chapter(story_id, 1, "Chapter 1", full_text)
+@metrics.timed("prompt", metrics.PROMPT_SECONDS)
+def _next_prompt(story: Dict[str, Any], ctx: Dict[str, Any], user_direction: str) -> str:
+    """ctx มาจาก story_context.gather(): สรุปตอนก่อนๆ + เนื้อเต็มของตอนล่าสุด"""
+    user_dir = (user_direction or "").strip()
+    recent = "\n\n".join(f"--- Chapter {c['index']}: {c['title']} ---\n{c['text']}" for c in ctx["recent"])
+    return f"""{SYSTEM_RULES}
+{OUTPUT_FORMAT_NEXT}
+
+[Story title]
+{story["title"]}
+
+[Summary of earlier chapters]
+{ctx["summary"] or "(none)"}
+
+[Most recent chapters]
+{recent}
+
+[Existing chapters count]
+{ctx["last_index"]}
+
+[User direction for next chapter]
+{user_dir or "(none)"}
+"""
+
+
+async def _llm_text(endpoint: str, request: Request, prompt: str) -> str:
+    """agenerate_text ผ่าน response cache (ถ้า endpoint นี้ opt-in ไว้)"""
+    return await llm_cache.get_or_generate(
+        endpoint,
+        DEFAULT_MODEL,
+        prompt,
+        lambda: agenerate_text(DEFAULT_MODEL, prompt),
+        cache_mode(request.headers.get("cache-control")),
+    )
+
+
+def _retry_after(e: RateLimited) -> str:
+    return str(max(1, math.ceil(e.retry_after)))
+
+
+def _rate_limited_response(e: RateLimited) -> JSONResponse:
+    return JSONResponse({"error": RATE_LIMIT_MESSAGE}, status_code=429, headers={"Retry-After": _retry_after(e)})
+
+
+def _error_payload(e: Exception) -> Dict[str, Any]:
+    """Error body + status for failures reported inside an SSE stream."""
+    s = str(e)
+    if isinstance(e, RateLimited):
+        return {"error": RATE_LIMIT_MESSAGE, "status": 429, "retry_after": int(_retry_after(e))}
+    api = gemini_client.api_error_status(e)
+    if api is not None:
+        return {"error": f"Gemini {api[0]}: {s}", "status": api[1]}
+    return {"error": f"{type(e).__name__}: {s}", "status": 500}
+
+
+# ---------------------------
+# Pages (HTML)
+# ---------------------------
+@app.get("/", response_class=HTMLResponse)
+def page_home(request: Request):
+    return templates.TemplateResponse("home.html", {"request": request, "title": "Home"})
+
+
+@app.get("/create", response_class=HTMLResponse)
+def page_create(request: Request):
+    return templates.TemplateResponse("create.html", {"request": request, "title": "Create"})
+
+
+@app.get("/stories", response_class=HTMLResponse)
+def page_stories(request: Request):
+    return templates.TemplateResponse("stories.html", {"request": request, "title": "Stories"})
+
+
+@app.get("/story/{story_id}", response_class=HTMLResponse)
+def page_story(request: Request, story_id: int):
+    return templates.TemplateResponse("story.html", {"request": request, "title": "Story", "story_id": story_id})
+
+
+# ---------------------------
+# API (JSON)
+# ---------------------------
+async def _generate_draft(body: StoryBody, idea: str, request: Request) -> Dict[str, Any]:
+    """Story text (+ illustration prompt) from Gemini, not yet stored."""
+    ctx = _story_context(body)
+    prompt = _story_prompt(body, idea, ctx)
+
+    illustration_prompt: Optional[str] = None
+    if body.want_illustration_prompt and body.concurrent_illustration:
+        full_text, illustration_prompt = await asyncio.gather(
+            _llm_text("generate", request, prompt),
+            _llm_text("generate", request, _illustration_prompt(body, idea, ctx)),
+        )
+        title = _extract_title(full_text)
+    else:
+        full_text = await _llm_text("generate", request, prompt)
+        title = _extract_title(full_text)
+        if body.want_illustration_prompt:
+            iprompt = _illustration_prompt(body, idea, ctx, title)
+            illustration_prompt = await _llm_text("generate", request, iprompt)
+
+    return {
+        "options": ctx["options"],
+        "title": title,
+        "full_text": full_text,
+        "illustration_prompt": illustration_prompt,
+    }
+
+
+@app.post("/api/generate")
+async def api_generate_story(body: StoryBody, request: Request):
+    idea = (body.idea or "").strip()
+    if not idea:
+        return JSONResponse({"error": "กรุณาพิมพ์ไอเดียหรือพล็อตที่ต้องการก่อนครับ"}, status_code=400)
+
+    try:
+        draft = await _generate_draft(body, idea, request)
+        # story + chapter 1 ใน transaction เดียว (sqlite แบบ sync -> ทำใน thread)
+        story_id = (await run_in_threadpool(storage.create_stories, [draft]))[0]
 
         return {
             "story_id": story_id,
-            "title": title,
-            "text": full_text,
-            "illustration_prompt": illustration_prompt,
+            "title": draft["title"],
+            "text": draft["full_text"],
+            "illustration_prompt": draft["illustration_prompt"],
         }
 
-    except ClientError as e:
-        msg = str(e)
-        if "429" in msg or "RESOURCE_EXHAUSTED" in msg:
-            return JSONResponse({"error": "429 Rate limit: รอสักครู่แล้วลองใหม่ครับ"}, status_code=429)
-        return JSONResponse({"error": f"Gemini ClientError: {msg}"}, status_code=400)
-    except ServerError as e:
-        return JSONResponse({"error": f"Gemini ServerError: {str(e)}"}, status_code=502)
+    except RateLimited as e:
+        return _rate_limited_response(e)
     except Exception as e:
+        api = gemini_client.api_error_status(e)
+        if api is not None:
+            return JSONResponse({"error": f"Gemini {api[0]}: {str(e)}"}, status_code=api[1])
         return JSONResponse({"error": f"Server error: {repr(e)}"}, status_code=500)
 
 
+@app.post("/api/generate/stream")
+async def api_generate_story_stream(body: StoryBody, request: Request):
+    """Same as /api/generate but streams the story as Server-Sent Events."""
+    idea = (body.idea or "").strip()
+    if not idea:
+        return JSONResponse({"error": "กรุณาพิมพ์ไอเดียหรือพล็อตที่ต้องการก่อนครับ"}, status_code=400)
+
+    ctx = _story_context(body)
+    prompt = _story_prompt(body, idea, ctx)
+
+    mode = cache_mode(request.headers.get("cache-control"))
+
+    async def story_chunks():
+        cached = await llm_cache.alookup("generate", DEFAULT_MODEL, prompt, mode)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        async for chunk in astream_text(DEFAULT_MODEL, prompt):
+            parts.append(chunk)
+            yield chunk
+        await llm_cache.astore("generate", DEFAULT_MODEL, prompt, "".join(parts).strip(), mode)
+
+    async def events():
+        parser = SectionParser("Title")
+        illustration_task: Optional[asyncio.Task] = None
+        if body.want_illustration_prompt and body.concurrent_illustration:
+            illustration_task = asyncio.create_task(
+                _llm_text("generate", request, _illustration_prompt(body, idea, ctx))
+            )
+        try:
+            async for chunk in story_chunks():
+                yield sse_event("delta", {"text": chunk})
+                for name, data in parser.feed(chunk):
+                    yield sse_event(name, data)
+            for name, data in parser.close():
+                yield sse_event(name, data)
+
+            full_text = parser.text.strip()
+            title = _extract_title(full_text)
+
+            illustration_prompt: Optional[str] = None
+            if body.want_illustration_prompt:
+                yield sse_event("status", {"stage": "illustration_prompt"})
+                if illustration_task is not None:
+                    illustration_prompt = await illustration_task
+                else:
+                    iprompt = _illustration_prompt(body, idea, ctx, title)
+                    illustration_prompt = await _llm_text("generate", request, iprompt)
+
+            draft = {"options": ctx["options"], "title": title, "full_text": full_text,
+                     "illustration_prompt": illustration_prompt}
+            story_id = (await run_in_threadpool(storage.create_stories, [draft]))[0]
+
+            yield sse_event("done", {
+                "story_id": story_id,
+                "title": title,
+                "illustration_prompt": illustration_prompt,
+            })
+        except Exception as e:
+            yield sse_event("error", _error_payload(e))
+        finally:
+            if illustration_task is not None and not illustration_task.done():
+                illustration_task.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.post("/api/generate/batch")
+async def api_generate_batch(body: BatchBody, request: Request):
+    """
+    Generate one story per item, `concurrency` at a time (Gemini calls still
+    queue behind the per-model rate limiter). Progress is streamed as SSE:
+    start -> item (per story, in completion order) -> saved -> done.
+    A failed item only reports its own error; successful stories are stored
+    together in one transaction at the end.
+    """
+    sem = asyncio.Semaphore(body.concurrency)
+    # item ที่ไม่มีไอเดีย = input ผิด (400) ตรวจก่อนเลย ไม่ต้องรอคิว
+    ideas = {i: (item.idea or "").strip() for i, item in enumerate(body.items)}
+    invalid = [i for i, idea in ideas.items() if not idea]
+
+    async def run(i: int, item: StoryBody):
+        try:
+            async with sem:
+                return i, await _generate_draft(item, ideas[i], request), None
+        except Exception as e:
+            return i, None, e
+
+    async def events():
+        tasks = [asyncio.create_task(run(i, item)) for i, item in enumerate(body.items) if ideas[i]]
+        drafts: Dict[int, Dict[str, Any]] = {}
+        failed = len(invalid)
+        saved = False
+        yield sse_event("start", {"total": len(body.items)})
+        for i in invalid:
+            yield sse_event("item", {"index": i, "ok": False, "status": 400,
+                                     "error": "กรุณาพิมพ์ไอเดียหรือพล็อตที่ต้องการก่อนครับ"})
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                i, draft, err = await next_done
+                if err is None:
+                    drafts[i] = draft
+                    yield sse_event("item", {"index": i, "ok": True, "title": draft["title"]})
+                else:
+                    failed += 1
+                    yield sse_event("item", {"index": i, "ok": False, **_error_payload(err)})
+
+            order = sorted(drafts)
+            try:
+                ids = await run_in_threadpool(storage.create_stories, [drafts[i] for i in order])
+            except Exception as e:
+                yield sse_event("error", _error_payload(e))
+                return
+            finally:
+                saved = True
+            yield sse_event("saved", {"items": [{"index": i, "story_id": sid} for i, sid in zip(order, ids)]})
+            yield sse_event("done", {"ok": len(ids), "failed": failed})
+        finally:
+            for t in tasks:
+                t.cancel()
+            # client ตัดการเชื่อมต่อกลางทาง -> scope ของ response ถูก cancel แล้ว
+            # ต้อง shield ไม่งั้น run_in_threadpool จะถูก cancel ก่อน thread เริ่ม (ไม่ได้บันทึกเลย)
+            if not saved and drafts:
+                with anyio.CancelScope(shield=True):
+                    await run_in_threadpool(storage.create_stories, [drafts[i] for i in sorted(drafts)])
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@job_queue.handler("summarize")
+async def _summarize_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return await story_context.catch_up(payload["story_id"], lambda p: agenerate_text(DEFAULT_MODEL, p))
+
+
+async def _schedule_summary(story_id: int):
+    """Queue a rolling-summary update when a chapter has left the verbatim window."""
+    if await run_in_threadpool(story_context.needs_summary, story_id):
+        await job_queue.submit("summarize", dedupe_key=str(story_id), payload={"story_id": story_id}, story_id=story_id)
+
+
+def _next_context(story_id: int):
+    """(story header, story_context.gather()) or (None, None) - งาน DB ทั้งหมดของ /api/next ก่อนเรียก LLM."""
+    story = storage.get_story_header(story_id)
+    return story, (story_context.gather(story) if story else None)
+
+
 @app.post("/api/next")
-def api_next_chapter(body: NextBody):
-    story = storage.get_story(body.story_id)
+async def api_next_chapter(body: NextBody):
+    # header + summary + ตอนล่าสุดไม่กี่ตอน: งาน DB คงที่ ไม่ขึ้นกับจำนวนตอน
+    story, ctx = await run_in_threadpool(_next_context, body.story_id)
     if not story:
         return JSONResponse({"error": "ไม่พบ story_id นี้"}, status_code=404)
 
-    chapters = storage.list_chapters(body.story_id)
-    next_index = (chapters[-1]["index"] + 1) if chapters else 2
-    user_dir = (body.user_direction or "").strip()
+    prompt = _next_prompt(story, ctx, body.user_direction)
 
-    prompt = f"""{SYSTEM_RULES}
-{OUTPUT_FORMAT_NEXT}
+    try:
+        text = await agenerate_text(DEFAULT_MODEL, prompt)
+        ch_title, ch_text = _parse_next_chapter(text)
+        # index จองตอน insert (request พร้อมกันได้ตอนถัดๆ ไป ไม่ชน unique index)
+        next_index = await run_in_threadpool(storage.append_chapter, body.story_id, ch_title, ch_text)
+        await _schedule_summary(body.story_id)
+        return {"chapter_index": next_index, "chapter_title": ch_title, "chapter_text": ch_text}
+    except RateLimited as e:
+        return _rate_limited_response(e)
+    except Exception as e:
+        return JSONResponse({"error": f"{type(e).__name__}: {str(e)}"}, status_code=500)
 
-[Story so far]
-{story["full_text"]}
 
-[Existing chapters count]
-{len(chapters)}
+@app.post("/api/next/stream")
+async def api_next_chapter_stream(body: NextBody):
+    """Same as /api/next but streams the chapter as Server-Sent Events."""
+    story, ctx = await run_in_threadpool(_next_context, body.story_id)
+    if not story:
+        return JSONResponse({"error": "ไม่พบ story_id นี้"}, status_code=404)
 
-[User direction for next chapter]
-{user_dir or "(none)"}
-"""
+    prompt = _next_prompt(story, ctx, body.user_direction)
+
+    async def events():
+        parser = SectionParser("Chapter Title")
+        # index ที่คาดไว้; ค่าจริงอยู่ใน "done" (ถ้ามีตอนอื่นถูกเพิ่มระหว่าง stream)
+        yield sse_event("start", {"chapter_index": ctx["last_index"] + 1})
+        try:
+            async for chunk in astream_text(DEFAULT_MODEL, prompt):
+                yield sse_event("delta", {"text": chunk})
+                for name, data in parser.feed(chunk):
+                    yield sse_event(name, data)
+            for name, data in parser.close():
+                yield sse_event(name, data)
+
+            ch_title, ch_text = _parse_next_chapter(parser.text)
+            next_index = await run_in_threadpool(storage.append_chapter, body.story_id, ch_title, ch_text)
+            await _schedule_summary(body.story_id)
+            yield sse_event("done", {"chapter_index": next_index, "chapter_title": ch_title})
+        except Exception as e:
+            yield sse_event("error", _error_payload(e))
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+STORY_PAGE_MAX = 100
 
+
+def _epoch(iso: str) -> float:
+    # created_at ทุกตารางเก็บเป็น UTC แบบไม่มี timezone
+    return datetime.fromisoformat(iso).replace(tzinfo=timezone.utc).timestamp()
+
+
+def _not_modified(request: Request, tag: str, modified: float) -> bool:
+    # มี If-None-Match -> ใช้ ETag อย่างเดียว (Last-Modified ละเอียดแค่วินาที)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return export_cache.etag_matches(if_none_match, tag)
     try:
-        text = generate_text(DEFAULT_MODEL, prompt)
-        ch_title, ch_text = _parse_next_chapter(text)
-        storage.add_chapter(body.story_id, next_index, ch_title, ch_text)
-        return {"chapter_index": next_index, "chapter_title": ch_title, "chapter_text": ch_text}
-    except Exception as e:
-        s = str(e)
-        if "429" in s or "RESOURCE_EXHAUSTED" in s:
-            return JSONResponse({"error": "429 Rate limit: รอสักครู่แล้วลองใหม่ครับ"}, status_code=429)
-        return JSONResponse({"error": f"{type(e).__name__}: {s}"}, status_code=500)
+        since = parsedate_to_datetime(request.headers.get("if-modified-since") or "")
+    except (TypeError, ValueError):
+        return False
+    return since.tzinfo is not None and int(modified) <= since.timestamp()
 
 
 @app.get("/api/story/{story_id}")
-def api_get_story(story_id: int):
-    story = storage.get_story(story_id)
+def api_get_story(story_id: int, request: Request, since_index: int = 0, limit: int = STORY_PAGE_MAX):
+    """
+    Story plus its chapters with index > since_index (at most `limit`).
+    A client holding chapters 1..k passes since_index=k and gets only the new
+    ones; story.full_text is only sent with the first page (since_index=0).
+    Conditional GET: ETag / Last-Modified -> 304.
+    """
+    since_index = max(0, since_index)
+    limit = max(1, min(limit, STORY_PAGE_MAX))
+    story = storage.get_story(story_id) if since_index == 0 else storage.get_story_header(story_id)
     if not story:
         return JSONResponse({"error": "not found"}, status_code=404)
-    chapters = storage.list_chapters(story_id)
-    return {"story": story, "chapters": chapters}
 
+    stats = storage.chapter_stats(story_id)
+    image = images.latest_for_stories([story_id]).get(story_id)
+    tag = f'"story-{story_id}-{storage.story_version(stats)}-i{image["id"] if image else 0}-{since_index}-{limit}"'
+    modified = max(
+        _epoch(story["created_at"]),
+        _epoch(stats["modified_at"]) if stats["modified_at"] else 0,
+        _epoch(image["created_at"]) if image else 0,
+    )
+    headers = {"ETag": tag, "Last-Modified": formatdate(modified, usegmt=True), "Cache-Control": "no-cache"}
+    if _not_modified(request, tag, modified):
+        return Response(status_code=304, headers=headers)
 
-@app.get("/api/stories")
-def api_list_stories():
-    return {"items": storage.list_stories(60)}
+    chapters = storage.chapters_after(story_id, since_index, limit)
+    upto = chapters[-1]["index"] if chapters else since_index
+    return JSONResponse(
+        {
+            "story": story,
+            "chapters": chapters,
+            "image": image,
+            "chapter_count": stats["count"],
+            "last_index": stats["max_index"],
+            "has_more": upto < stats["max_index"],
+        },
+        headers=headers,
+    )
 
 
-@app.post("/api/illustrate")
-def api_illustrate(body: IllustrateBody):
-    story = storage.get_story(body.story_id)
-    if not story:
-        return JSONResponse({"error": "ไม่พบ story_id นี้"}, status_code=404)
+@app.get("/api/cache/stats")
+def api_cache_stats():
+    return {**llm_cache.stats(), "singleflight": gemini_client.flights.stats()}
 
-    base_prompt = (story.get("illustration_prompt") or "").strip()
-    if not base_prompt:
-        base_prompt = f"Anime key visual illustration for the story titled: {story['title']}"
 
-    anime_suffix = """
+@app.get("/metrics")
+def api_metrics():
+    """Prometheus scrape endpoint."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/api/rate-limit/stats")
+def api_rate_limit_stats():
+    return rate_limit.stats()
+
+
+@app.get("/api/job-queue/stats")
+def api_job_queue_stats():
+    return job_queue.stats()
+
+
+@app.get("/api/render-pool/stats")
+def api_render_pool_stats():
+    return render_pool.stats()
+
+
+@app.get("/api/stories")
+def api_list_stories(
+    limit: int = 60,
+    before_id: Optional[int] = None,
+    genre: Optional[str] = None,
+    tone: Optional[str] = None,
+    age: Optional[str] = None,
+):
+    limit = max(1, min(limit, 100))
+    # รับได้ทั้ง key (fantasy) และค่าที่เก็บจริง (แฟนตาซี)
+    items = storage.list_stories(
+        limit,
+        before_id=before_id,
+        genre=GENRE_GUIDE.get(genre, genre) if genre else None,
+        tone=TONE_GUIDE.get(tone, tone) if tone else None,
+        age=AGE_GUIDE.get(age, age) if age else None,
+    )
+    thumbs = images.latest_for_stories(it["id"] for it in items)
+    for it in items:
+        it["thumb_url"] = (thumbs.get(it["id"]) or {}).get("thumb_url")
+    next_before_id = items[-1]["id"] if len(items) == limit else None
+    return {"items": items, "next_before_id": next_before_id}
+
+
+@app.get("/api/search")
+def api_search(q: str = "", limit: int = 20):
+    if not storage.fts_query(q):
+        return JSONResponse(
+            {"error": f"กรุณาพิมพ์คำค้นอย่างน้อย {storage.SEARCH_MIN_TERM} ตัวอักษรครับ"}, status_code=400
+        )
+    items = storage.search(q, max(1, min(limit, 50)))
+    for it in items:
+        # escape ก่อน แล้วค่อยใส่ <mark> ตรงคำที่ตรง
+        it["snippet_html"] = (
+            html.escape(it.pop("snippet") or "")
+            .replace(storage.SNIPPET_OPEN, "<mark>")
+            .replace(storage.SNIPPET_CLOSE, "</mark>")
+        )
+    return {"items": items}
+
+
+ANIME_SUFFIX = """
 Style: high quality anime key visual, cel shading, detailed eyes, clean line art,
 cinematic lighting, vibrant colors, depth of field, masterpiece, no text, no watermark, no logo.
 Composition: main characters in the center, background matches the setting.
 """
 
-    final_prompt = f"{base_prompt}\n\n{anime_suffix}"
+
+@job_queue.handler("illustrate")
+async def _illustrate_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    story_id = payload["story_id"]
+    story = await run_in_threadpool(storage.get_story_header, story_id)
+    if not story:
+        raise LookupError("ไม่พบ story_id นี้")
+
+    base_prompt = (story.get("illustration_prompt") or "").strip()
+    if not base_prompt:
+        base_prompt = f"Anime key visual illustration for the story titled: {story['title']}"
+
+    final_prompt = f"{base_prompt}\n\n{ANIME_SUFFIX}"
 
     try:
-        png_bytes = generate_image_png_bytes(
+        data, mime_type = await agenerate_image(
             model=IMAGE_MODEL,
             prompt=final_prompt,
-            aspect_ratio=body.aspect_ratio,
+            aspect_ratio=payload["aspect_ratio"],
         )
-        ts = int(time.time())
-        filename = f"story_{body.story_id}_{ts}.png"
-        path = GENERATED_DIR / filename
-        path.write_bytes(png_bytes)
-        return {"image_url": f"/static/generated/{filename}"}
+    except RateLimited as e:
+        raise RuntimeError(RATE_LIMIT_MESSAGE) from e
 
-    except Exception as e:
-        s = str(e)
-        if "429" in s or "RESOURCE_EXHAUSTED" in s:
-            return JSONResponse({"error": "429 Rate limit: รอสักครู่แล้วลองใหม่ครับ"}, status_code=429)
-        return JSONResponse({"error": f"{type(e).__name__}: {s}"}, status_code=500)
+    # เขียน bytes จาก model ตรงๆ + สร้าง WebP/thumbnail (encode ใน thread)
+    return await run_in_threadpool(images.save_generated, story_id, data, mime_type, payload["aspect_ratio"])
+
+
+def _job_payload(job: Dict[str, Any]) -> Dict[str, Any]:
+    out = {"job_id": job["id"], "status": job["status"], "status_url": f"/api/jobs/{job['id']}"}
+    if job["status"] == "done":
+        out.update(job["result"] or {})
+    elif job["status"] == "error":
+        out["error"] = job["error"]
+    return out
+
+
+@app.post("/api/illustrate")
+async def api_illustrate(body: IllustrateBody):
+    """Queue an illustration; poll status_url until status is done/error."""
+    story = await run_in_threadpool(storage.get_story_header, body.story_id)
+    if not story:
+        return JSONResponse({"error": "ไม่พบ story_id นี้"}, status_code=404)
+
+    # คำขอเดิม (story + aspect ratio เดียวกัน) ที่ยังไม่เสร็จ -> ได้ job เดิมกลับไป
+    job = await job_queue.submit(
+        "illustrate",
+        dedupe_key=f"{body.story_id}:{body.aspect_ratio}",
+        payload={"story_id": body.story_id, "aspect_ratio": body.aspect_ratio},
+        story_id=body.story_id,
+    )
+    return JSONResponse(_job_payload(job), status_code=202)
+
+
+@app.get("/api/story/{story_id}/images")
+def api_story_images(story_id: int):
+    if not storage.get_story_header(story_id):
+        return JSONResponse({"error": "not found"}, status_code=404)
+    return {"items": images.list_for_story(story_id)}
+
+
+@app.get("/api/jobs/{job_id}")
+def api_job(job_id: str):
+    job = storage.get_job(job_id)
+    if not job:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    return _job_payload(job)
 
 @app.delete("/api/story/{story_id}")
 def api_delete_story(story_id: int):
@@ -342,41 +821,139 @@ def _ascii_filename(story_id: int, ext: str) -> str:
     return f"story_{story_id}.{ext}"
 
 
+EXPORT_MEDIA_TYPES = {
+    "md": "text/markdown; charset=utf-8",
+    "txt": "text/plain; charset=utf-8",
+    "pdf": "application/pdf",
+}
+EXPORT_CHUNK = 64 * 1024
+
+
+def _file_response(f: BinaryIO, media_type: str, headers: Dict[str, str]) -> StreamingResponse:
+    """Stream an already opened export (ไฟล์ใน cache อาจถูก evict ไปแล้ว แต่ handle ที่เปิดไว้ยังอ่านได้)."""
+    size = os.fstat(f.fileno()).st_size
+
+    def body():
+        while chunk := f.read(EXPORT_CHUNK):
+            yield chunk
+
+    return StreamingResponse(
+        body(), media_type=media_type, headers={**headers, "Content-Length": str(size)},
+        background=BackgroundTask(f.close),
+    )
+
+
+def _export_writer(story: Dict[str, Any], ext: str) -> Callable[[BinaryIO], None]:
+    """Write md/txt chunk by chunk straight into a file (PDF goes through render_pool)."""
+    def write(f: BinaryIO):
+        bulk_export.write_text(f, story, storage.iter_chapters(story["id"]), ext)
+
+    return write
+
+
+EXPORT_ZIP_MAX_STORIES = 1000
+
+
+# ต้องอยู่ก่อน /download/{story_id}.{ext} (ไม่งั้น "stories.zip" ถูกจับเป็น story_id)
+@app.get("/download/stories.zip")
+def download_zip(
+    ids: str = "",
+    genre: Optional[str] = None,
+    tone: Optional[str] = None,
+    age: Optional[str] = None,
+    formats: str = "md,pdf",
+    with_images: bool = True,
+    limit: int = 200,
+):
+    """
+    Stream many stories as one ZIP: ids=1,2,3 or a genre/tone/age filter
+    (newest first, up to `limit`). formats: any of md,txt,pdf.
+    """
+    fmts = [f for f in (x.strip() for x in formats.split(",")) if f]
+    if not fmts or any(f not in bulk_export.FORMATS for f in fmts):
+        return JSONResponse({"error": "formats must be md|txt|pdf (comma separated)"}, status_code=400)
+
+    limit = max(1, min(limit, EXPORT_ZIP_MAX_STORIES))
+    if ids:
+        try:
+            story_ids = [int(x) for x in ids.split(",") if x.strip()][:limit]
+        except ValueError:
+            return JSONResponse({"error": "ids must be comma separated integers"}, status_code=400)
+    else:
+        # ใช้ keyset pagination เดิม (อ่านแค่ id/title)
+        story_ids = []
+        before_id = None
+        while len(story_ids) < limit:
+            want = min(100, limit - len(story_ids))
+            page = storage.list_stories(
+                want,
+                before_id=before_id,
+                genre=GENRE_GUIDE.get(genre, genre) if genre else None,
+                tone=TONE_GUIDE.get(tone, tone) if tone else None,
+                age=AGE_GUIDE.get(age, age) if age else None,
+            )
+            story_ids.extend(it["id"] for it in page)
+            if len(page) < want:
+                break
+            before_id = page[-1]["id"]
+
+    if not story_ids:
+        return JSONResponse({"error": "no stories matched"}, status_code=404)
+
+    body = bulk_export.iter_zip(bulk_export.id_batches(story_ids), fmts, with_images)
+    headers = {"Content-Disposition": content_disposition("stories.zip", "stories.zip")}
+    return StreamingResponse(body, media_type="application/zip", headers=headers)
+
+
 @app.get("/download/{story_id}.{ext}")
-def download(story_id: int, ext: str):
-    story = storage.get_story(story_id)
+async def download(story_id: int, ext: str, request: Request):
+    story = await run_in_threadpool(storage.get_story, story_id)
     if not story:
         return JSONResponse({"error": "not found"}, status_code=404)
 
-    chapters = storage.list_chapters(story_id)
-    md = storage.story_markdown(story, chapters)
+    if ext not in EXPORT_MEDIA_TYPES:
+        return JSONResponse({"error": "ext must be md|txt|pdf"}, status_code=400)
 
     # ชื่อจริง (อาจมีไทย)
-    nice_base = _slug_filename(story["title"], story_id)
+    nice_base = bulk_export.slug_filename(story["title"], story_id)
     nice_name = f"{nice_base}.{ext}"
 
     # ชื่อ fallback (ASCII เท่านั้น)
     safe_name = _ascii_filename(story_id, ext)
 
-    headers = {"Content-Disposition": content_disposition(safe_name, nice_name)}
-
-    if ext == "md":
-        return Response(md.encode("utf-8"), media_type="text/markdown; charset=utf-8", headers=headers)
-
-    if ext == "txt":
-        txt = md.replace("# ", "").replace("## ", "").replace("### ", "")
-        return Response(txt.encode("utf-8"), media_type="text/plain; charset=utf-8", headers=headers)
-
-    if ext == "pdf":
-        pdf_bytes = text_to_pdf_bytes(story["title"], md)
-        return Response(pdf_bytes, media_type="application/pdf", headers=headers)
-
-    return JSONResponse({"error": "ext must be md|txt|pdf"}, status_code=400)
+    version = storage.story_version(await run_in_threadpool(storage.chapter_stats, story_id))
+    tag = export_cache.etag(story_id, version, ext)
+    cache_headers = {"ETag": tag, "Cache-Control": "no-cache"}
+
+    if export_cache.etag_matches(request.headers.get("if-none-match"), tag):
+        return Response(status_code=304, headers=cache_headers)
+
+    f = export_cache.open_cached(story_id, version, ext)
+    if f is None:
+        if ext == "pdf":
+            # CPU หนัก -> ส่งไป process pool ไม่ให้ถือ GIL ของ worker นี้
+            try:
+                with export_cache.staging(story_id, version, ext) as tmp:
+                    await render_pool.render_story_pdf(story_id, tmp)
+                    f = export_cache.open_staged(tmp)
+            except render_pool.RenderBusy:
+                return JSONResponse(
+                    {"error": "ระบบกำลังสร้าง PDF จำนวนมาก กรุณาลองใหม่อีกครั้งครับ"},
+                    status_code=503,
+                    headers={"Retry-After": "5"},
+                )
+            except asyncio.TimeoutError:
+                return JSONResponse({"error": "สร้าง PDF นานเกินไป กรุณาลองใหม่ครับ"}, status_code=504)
+        else:
+            f = await run_in_threadpool(export_cache.put, story_id, version, ext, _export_writer(story, ext))
+
+    headers = {"Content-Disposition": content_disposition(safe_name, nice_name), **cache_headers}
+    return _file_response(f, EXPORT_MEDIA_TYPES[ext], headers)
 
 
 
 @app.post("/api/outline")
-def api_outline(body: OutlineBody):
+async def api_outline(body: OutlineBody, request: Request):
     idea = (body.idea or "").strip()
     if not idea:
         return JSONResponse({"error": "กรุณาพิมพ์ไอเดียก่อนครับ"}, status_code=400)
@@ -416,10 +993,9 @@ Characters:
 """
 
     try:
-        outline_text = generate_text(DEFAULT_MODEL, prompt)
+        outline_text = await _llm_text("outline", request, prompt)
         return {"outline": (outline_text or "").strip()}
+    except RateLimited as e:
+        return _rate_limited_response(e)
     except Exception as e:
-        s = str(e)
-        if "429" in s or "RESOURCE_EXHAUSTED" in s:
-            return JSONResponse({"error": "429 Rate limit: รอสักครู่แล้วลองใหม่ครับ"}, status_code=429)
-        return JSONResponse({"error": f"{type(e).__name__}: {s}"}, status_code=500)
+        return JSONResponse({"error": f"{type(e).__name__}: {str(e)}"}, status_code=500)
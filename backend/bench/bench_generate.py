@@ -0,0 +1,72 @@
+"""
+Benchmark /api/generate (want_illustration_prompt=True) against a stubbed
+Gemini backend: sequential pipeline vs concurrent pipeline.
+
+    cd backend
+    python bench/bench_generate.py --requests 20 --latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+os.chdir(BACKEND_DIR)
+sys.path.insert(0, str(BACKEND_DIR))
+
+import storage  # noqa: E402
+
+storage.DB_PATH = str(Path(tempfile.mkdtemp()) / "bench.db")
+
+import app as app_module  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+STUB_STORY = "[Title]\nเรื่องทดสอบ\n\n[Story]\nกาลครั้งหนึ่งนานมาแล้ว\n\n[Moral]\nความพยายาม\n\n[Summary]\n- a\n"
+
+
+def _stub_backend(latency: float):
+    async def fake_generate_text(model: str, prompt: str) -> str:
+        await asyncio.sleep(latency)
+        if "illustration prompt" in prompt:
+            return "anime illustration of a small village near a forest"
+        return STUB_STORY
+
+    return fake_generate_text
+
+
+def _run(client: TestClient, n: int, concurrent: bool) -> list:
+    body = {"idea": "ทดสอบ", "want_illustration_prompt": True, "concurrent_illustration": concurrent}
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        r = client.post("/api/generate", json=body, headers={"Cache-Control": "no-store"})
+        times.append(time.perf_counter() - t0)
+        r.raise_for_status()
+    return times
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=20)
+    ap.add_argument("--latency", type=float, default=0.5, help="stub Gemini latency per call (s)")
+    args = ap.parse_args()
+
+    app_module.agenerate_text = _stub_backend(args.latency)
+
+    with TestClient(app_module.app) as client:
+        seq = _run(client, args.requests, concurrent=False)
+        conc = _run(client, args.requests, concurrent=True)
+
+    p50_seq = statistics.median(seq)
+    p50_conc = statistics.median(conc)
+    print(f"sequential  p50={p50_seq * 1000:.1f} ms")
+    print(f"concurrent  p50={p50_conc * 1000:.1f} ms")
+    print(f"speedup     x{p50_seq / p50_conc:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark text_to_pdf_bytes on a LENGTH_GUIDE["long"]-sized Thai story
+(~1600 words, long unspaced Thai paragraphs).
+
+    cd backend
+    python bench/bench_pdf.py --repeat 5
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from pdf_utils import text_to_pdf_bytes  # noqa: E402
+
+SENTENCE = (
+    "กาลครั้งหนึ่งนานมาแล้วในหมู่บ้านเล็กๆใกล้ป่าใหญ่มีเด็กหญิงชื่อมะลิผู้ใจดีและช่างสงสัย"
+    "เธอมักจะออกไปเดินเล่นริมลำธารเพื่อฟังเสียงนกร้องและมองดูแสงแดดที่ลอดผ่านใบไม้"
+)
+
+
+def long_story(words: int = 1600) -> str:
+    # ประโยคละ ~20 คำ, ย่อหน้าละ 8 ประโยค (ไม่มีช่องว่างในประโยค เหมือนข้อความไทยจริง)
+    sentences = max(1, words // 20)
+    paragraphs = []
+    for i in range(0, sentences, 8):
+        paragraphs.append(" ".join([SENTENCE] * min(8, sentences - i)))
+    return "[Title]\nมะลิกับป่าใหญ่\n\n[Story]\n" + "\n\n".join(paragraphs)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--words", type=int, default=1600)
+    args = ap.parse_args()
+
+    text = long_story(args.words)
+    text_to_pdf_bytes("warmup", "ทดสอบ")  # register fonts
+
+    times = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        pdf = text_to_pdf_bytes("มะลิกับป่าใหญ่", text)
+        times.append(time.perf_counter() - t0)
+
+    print(f"chars={len(text)} pdf_bytes={len(pdf)}")
+    print(f"text_to_pdf_bytes p50={statistics.median(times) * 1000:.1f} ms min={min(times) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
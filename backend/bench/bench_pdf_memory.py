@@ -0,0 +1,73 @@
+"""
+Peak Python memory of one PDF export for a 50-chapter story:
+the old in-memory path (markdown string -> text_to_pdf_bytes -> bytes body)
+vs rendering straight into the export cache file.
+
+    cd backend
+    python bench/bench_pdf_memory.py --chapters 50
+"""
+import argparse
+import gc
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+import storage  # noqa: E402
+import pdf_utils  # noqa: E402
+from bench_pdf import long_story  # noqa: E402
+
+
+def _seed(chapters: int) -> int:
+    storage.DB_PATH = str(Path(tempfile.mkdtemp()) / "bench.db")
+    storage.init_db()
+    text = long_story(1600)
+    sid = storage.create_story({"genre": "แฟนตาซี"}, "มะลิกับป่าใหญ่", text, None)
+    for i in range(1, chapters + 1):
+        storage.add_chapter(sid, i, f"Chapter {i}", text)
+    return sid
+
+
+def _peak(fn) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chapters", type=int, default=50)
+    args = ap.parse_args()
+
+    sid = _seed(args.chapters)
+    pdf_utils.text_to_pdf_bytes("warmup", "ทดสอบ")
+    out = Path(tempfile.mkdtemp()) / "out.pdf"
+
+    def in_memory():
+        story = storage.get_story(sid)
+        md = storage.story_markdown(story, storage.list_chapters(sid))
+        body = pdf_utils.text_to_pdf_bytes(story["title"], md)
+        out.write_bytes(body)
+
+    def to_file():
+        story = storage.get_story(sid)
+        chunks = storage.story_markdown_chunks(story, storage.iter_chapters(sid))
+        with open(out, "wb") as f:
+            pdf_utils.write_pdf(f, story["title"], chunks)
+
+    results = {"in-memory bytes": _peak(in_memory), "streamed to file": _peak(to_file)}
+
+    print(f"chapters={args.chapters} pdf_size={out.stat().st_size / 1e6:.1f} MB")
+    for name, peak in results.items():
+        print(f"{name:18s} peak={peak / 1e6:7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
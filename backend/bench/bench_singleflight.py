@@ -0,0 +1,140 @@
+"""
+Show that N identical concurrent Gemini calls cost exactly one upstream call
+(single-flight), using a slow stub client in place of Gemini.
+
+    cd backend
+    python bench/bench_singleflight.py --concurrency 20 --latency 0.5
+
+Checks, each with N identical concurrent callers:
+- agenerate_text / agenerate_image          (asyncio.gather)
+- generate_text                             (worker threads)
+- POST /api/outline with Cache-Control: no-store (so the response cache
+  cannot be what deduplicates)
+Exits non-zero if any check sees more than one upstream call.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+os.chdir(BACKEND_DIR)
+sys.path.insert(0, str(BACKEND_DIR))
+
+import storage  # noqa: E402
+
+storage.DB_PATH = str(Path(tempfile.mkdtemp()) / "bench.db")
+
+import app as app_module  # noqa: E402
+import gemini_client  # noqa: E402
+import httpx  # noqa: E402
+
+PNG_1PX = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+class SlowStub:
+    """Stands in for genai.Client: counts upstream calls, answers after `latency`."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.models = SimpleNamespace(generate_content=self._sync)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self._async))
+
+    def _response(self, config):
+        if config is not None:
+            blob = SimpleNamespace(data=PNG_1PX, mime_type="image/png")
+            return SimpleNamespace(parts=[SimpleNamespace(inline_data=blob)], text=None)
+        return SimpleNamespace(text="- Title: ทดสอบ", parts=[])
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+    def _sync(self, model, contents, config=None):
+        self._count()
+        time.sleep(self.latency)
+        return self._response(config)
+
+    async def _async(self, model, contents, config=None):
+        self._count()
+        await asyncio.sleep(self.latency)
+        return self._response(config)
+
+
+def check(name: str, stub: SlowStub, n: int, seconds: float) -> bool:
+    ok = stub.calls == 1
+    print(f"{name:<28} {n:>3} callers -> {stub.calls} upstream call(s) in {seconds:.2f}s  {'OK' if ok else 'FAIL'}")
+    return ok
+
+
+def run_check(name: str, n: int, latency: float, fn) -> bool:
+    stub = SlowStub(latency)
+    gemini_client._client = stub
+    t0 = time.perf_counter()
+    fn(n)
+    return check(name, stub, n, time.perf_counter() - t0)
+
+
+def async_text(n: int):
+    async def go():
+        results = await asyncio.gather(*[gemini_client.agenerate_text("m", "same prompt") for _ in range(n)])
+        assert len(set(results)) == 1
+    asyncio.run(go())
+
+
+def async_image(n: int):
+    async def go():
+        await asyncio.gather(*[gemini_client.agenerate_image("m-img", "same prompt", "3:4") for _ in range(n)])
+    asyncio.run(go())
+
+
+def threaded_text(n: int):
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        results = list(pool.map(lambda _: gemini_client.generate_text("m", "same prompt"), range(n)))
+    assert len(set(results)) == 1
+
+
+def outline_endpoint(n: int):
+    async def go():
+        transport = httpx.ASGITransport(app=app_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            body = {"idea": "แมวกับดาว", "genre": "fantasy"}
+            resps = await asyncio.gather(*[
+                client.post("/api/outline", json=body, headers={"Cache-Control": "no-store"}) for _ in range(n)
+            ])
+        assert all(r.status_code == 200 for r in resps), [r.status_code for r in resps]
+    asyncio.run(go())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    # limiter ไม่ใช่สิ่งที่วัด -> เปิดกว้าง
+    gemini_client.rate_limit.configure({m: "1000:1000" for m in ("m", "m-img", app_module.DEFAULT_MODEL)})
+
+    results = [
+        run_check("agenerate_text", args.concurrency, args.latency, async_text),
+        run_check("agenerate_image", args.concurrency, args.latency, async_image),
+        run_check("generate_text (threads)", args.concurrency, args.latency, threaded_text),
+        run_check("POST /api/outline", args.concurrency, args.latency, outline_endpoint),
+    ]
+    print(gemini_client.flights.stats())
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Cold-start numbers for the server:
+- `python -X importtime -c "import app"`: total and the heaviest top-level packages
+- time from process spawn to the first 200 from GET /api/stories
+- latency of the first PDF download (fonts, render pool) vs a second one
+
+    cd backend
+    python bench/bench_startup.py --runs 5
+
+Runs against the offline Gemini stub with a temp DB / image dir / export cache.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from loadtest import _free_port  # noqa: E402
+
+_IMPORTTIME_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def import_times() -> dict:
+    """
+    Cumulative µs of `import app`, plus per package the cumulative time of
+    each subtree where it is imported from a different package (subtrees
+    nest, so the per-package numbers overlap).
+    """
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=BACKEND_DIR, capture_output=True, text=True, env=_env(tempfile.mkdtemp()),
+    )
+    if out.returncode != 0:
+        raise SystemExit(out.stderr[-2000:])
+    per_package = defaultdict(int)
+    total = 0
+    stack = []  # (depth, package, cumulative) - importtime พิมพ์ลูกก่อนพ่อ
+    for line in out.stderr.splitlines():
+        m = _IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        cumulative, depth, name = int(m.group(2)), len(m.group(3)), m.group(4)
+        package = name.split(".")[0]
+        while stack and stack[-1][0] > depth:
+            _, child, child_cumulative = stack.pop()
+            if child != package:
+                per_package[child] += child_cumulative
+        stack.append((depth, package, cumulative))
+        if name == "app":
+            total = cumulative
+    for _, package, cumulative in stack:
+        per_package[package] += cumulative
+    return {"total": total, "packages": dict(per_package)}
+
+
+def _env(workdir: str) -> dict:
+    return {
+        **os.environ,
+        "GEMINI_BACKEND": "stub",
+        "GEMINI_STUB_LATENCY": "fixed:0",
+        "STORIES_DB": str(Path(workdir) / "bench.db"),
+        "IMAGE_DIR": str(Path(workdir) / "generated"),
+        "EXPORT_CACHE_DIR": str(Path(workdir) / "exports"),
+    }
+
+
+def first_requests() -> dict:
+    workdir = tempfile.mkdtemp(prefix="startup-")
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=_env(workdir),
+    )
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise SystemExit(f"server exited with code {proc.returncode}")
+            try:
+                if httpx.get(f"{base}/api/stories?limit=1", timeout=2).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                time.sleep(0.01)
+        ready = time.perf_counter() - t0
+
+        story_id = httpx.post(f"{base}/api/generate", json={"idea": "startup"}, timeout=30).json()["story_id"]
+        httpx.post(f"{base}/api/next", json={"story_id": story_id}, timeout=30)  # PDF ใหม่ (ไม่โดน export cache)
+        t1 = time.perf_counter()
+        httpx.get(f"{base}/download/{story_id}.pdf", timeout=60).raise_for_status()
+        first_pdf = time.perf_counter() - t1
+
+        httpx.post(f"{base}/api/next", json={"story_id": story_id}, timeout=30)
+        t2 = time.perf_counter()
+        httpx.get(f"{base}/download/{story_id}.pdf", timeout=60).raise_for_status()
+        second_pdf = time.perf_counter() - t2
+        return {"ready": ready, "first_pdf": first_pdf, "second_pdf": second_pdf}
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--top", type=int, default=8, help="heaviest packages to list")
+    args = ap.parse_args()
+
+    imports = [import_times() for _ in range(args.runs)]
+    totals = [i["total"] / 1000 for i in imports]
+    print(f"import app: median {statistics.median(totals):.0f} ms (min {min(totals):.0f}, max {max(totals):.0f})")
+    packages = defaultdict(list)
+    for i in imports:
+        for name, us in i["packages"].items():
+            packages[name].append(us / 1000)
+    packages.pop("app", None)
+    heaviest = sorted(packages.items(), key=lambda kv: -statistics.median(kv[1]))[:args.top]
+    for name, ms in heaviest:
+        print(f"  {name:<20} {statistics.median(ms):8.1f} ms")
+
+    runs = [first_requests() for _ in range(args.runs)]
+    for key, label in (("ready", "spawn -> first 200"), ("first_pdf", "first PDF"), ("second_pdf", "second PDF")):
+        values = [r[key] * 1000 for r in runs]
+        print(f"{label:<20} median {statistics.median(values):7.0f} ms (min {min(values):.0f}, max {max(values):.0f})")
+
+
+if __name__ == "__main__":
+    main()
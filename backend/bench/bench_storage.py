@@ -0,0 +1,84 @@
+"""
+Micro-benchmark get_story + list_chapters throughput:
+a fresh sqlite3.connect per call (old behaviour) vs the pooled per-thread
+connections with WAL/pragmas.
+
+    cd backend
+    python bench/bench_storage.py --stories 200 --chapters 10 --reads 5000
+"""
+import argparse
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+import storage  # noqa: E402
+
+
+def _seed(db_path: str, stories: int, chapters: int):
+    storage.DB_PATH = db_path
+    storage.init_db()
+    for i in range(stories):
+        sid = storage.create_story({"genre": "fantasy"}, f"story {i}", "ข้อความ " * 300, None)
+        for ch in range(1, chapters + 1):
+            storage.add_chapter(sid, ch, f"Chapter {ch}", "เนื้อเรื่อง " * 200)
+    storage.close_connections()
+
+
+def _read(ids, reads: int, threads: int) -> float:
+    def work(n):
+        for _ in range(n):
+            sid = random.choice(ids)
+            storage.get_story(sid)
+            storage.list_chapters(sid)
+
+    per = reads // threads
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(threads) as ex:
+        list(ex.map(work, [per] * threads))
+    return (per * threads) / (time.perf_counter() - t0)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--stories", type=int, default=200)
+    ap.add_argument("--chapters", type=int, default=10)
+    ap.add_argument("--reads", type=int, default=5000)
+    ap.add_argument("--threads", type=int, default=4)
+    args = ap.parse_args()
+
+    tmp = Path(tempfile.mkdtemp())
+    ids = list(range(1, args.stories + 1))
+
+    # before: connect ใหม่ทุก call, journal แบบ rollback ปกติ
+    before_db = str(tmp / "before.db")
+    _seed(before_db, args.stories, args.chapters)
+    con = sqlite3.connect(before_db)
+    con.execute("PRAGMA journal_mode=DELETE")
+    con.close()
+    pooled_conn = storage._conn
+    storage._conn = lambda: sqlite3.connect(storage.DB_PATH)
+    storage.DB_PATH = before_db
+    before = _read(ids, args.reads, args.threads)
+    storage._conn = pooled_conn
+
+    # after: per-thread connection + WAL/pragmas
+    after_db = str(tmp / "after.db")
+    _seed(after_db, args.stories, args.chapters)
+    storage.DB_PATH = after_db
+    after = _read(ids, args.reads, args.threads)
+    storage.close_connections()
+
+    print(f"before  {before:8.0f} get_story+list_chapters / s")
+    print(f"after   {after:8.0f} get_story+list_chapters / s")
+    print(f"speedup x{after / before:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Load-test the real server (uvicorn subprocess) against an offline Gemini
+backend (GEMINI_BACKEND=stub by default, or replay of a recorded cassette).
+
+    cd backend
+    python bench/loadtest.py --concurrency 16 --requests 200
+    python bench/loadtest.py --scenarios story,stories,pdf --latency fixed:0.2
+    python bench/loadtest.py --backend replay --cassette gemini_cassette.jsonl
+
+Scenarios run in order (generate first: it creates the stories the others use):
+  generate  POST /api/generate
+  next      POST /api/next
+  story     GET  /api/story/{id}
+  stories   GET  /api/stories
+  pdf       GET  /download/{id}.pdf  (first hit per story renders, later ones hit the export cache)
+            503 here is render-pool backpressure (PDF_QUEUE_LIMIT), not a failure of the harness
+
+Reports throughput, p50/p95/p99 latency and peak RSS of the server process
+tree (server + PDF workers, from /proc; Linux only) per scenario.
+The server gets its own temp DB / image dir / export cache, so nothing in
+the working tree is touched.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+SCENARIOS = ("generate", "next", "story", "stories", "pdf")
+MODELS = ("gemini-2.5-flash", "gemini-2.5-flash-image")
+
+
+# ---------------------------
+# Server process
+# ---------------------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workdir: Path) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "GEMINI_BACKEND": args.backend,
+        "GEMINI_CASSETTE": str(Path(args.cassette).resolve()),
+        "GEMINI_REPLAY_MISS": "stub",
+        "GEMINI_STUB_LATENCY": args.latency,
+        "GEMINI_STUB_429_RATE": str(args.rate_429),
+        "GEMINI_STUB_SEED": "1",
+        "STORIES_DB": str(workdir / "bench.db"),
+        "IMAGE_DIR": str(workdir / "generated"),
+        "EXPORT_CACHE_DIR": str(workdir / "exports"),
+        # limiter ไม่ใช่สิ่งที่วัด (ยกเว้นสั่งเอง)
+        "RATE_LIMITS": args.rate_limits or ",".join(f"{m}=1000:1000" for m in MODELS),
+    }
+    cmd = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(args.port),
+           "--log-level", "warning", "--workers", "1"]
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env)
+
+
+def wait_ready(base_url: str, proc: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with code {proc.returncode}")
+        try:
+            if httpx.get(f"{base_url}/api/stories?limit=1", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("server did not become ready")
+
+
+# ---------------------------
+# Peak RSS of the server process tree
+# ---------------------------
+def _children(pid: int) -> List[int]:
+    out = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                out.extend(int(c) for c in f.read().split())
+    except OSError:
+        pass
+    return out
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler(threading.Thread):
+    """Polls the summed RSS of pid and its descendants; peak() since the last reset()."""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.available = os.path.exists(f"/proc/{pid}/status")
+        self._peak = 0
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.is_set():
+            pids, stack = [], [self.pid]
+            while stack:
+                p = stack.pop()
+                pids.append(p)
+                stack.extend(_children(p))
+            self._peak = max(self._peak, sum(_rss_kb(p) for p in pids))
+            self._stop.wait(self.interval)
+
+    def reset(self):
+        self._peak = 0
+
+    def peak_mb(self) -> Optional[float]:
+        return self._peak / 1024 if self.available else None
+
+    def stop(self):
+        self._stop.set()
+
+
+# ---------------------------
+# Scenarios
+# ---------------------------
+IDEAS = ("แมวที่อยากบินได้", "เด็กกับดาวตก", "ห้องสมุดกลางป่า", "เรือกระดาษผจญภัย", "มังกรขี้อาย")
+
+
+def request_for(client: httpx.AsyncClient, name: str, i: int, story_ids: List[int]) -> httpx.Request:
+    if name == "generate":
+        body = {"idea": f"{random.choice(IDEAS)} #{i}", "genre": "fantasy", "want_illustration_prompt": True}
+        return client.build_request("POST", "/api/generate", json=body, headers={"Cache-Control": "no-store"})
+    if name == "next":
+        body = {"story_id": random.choice(story_ids), "user_direction": ""}
+        return client.build_request("POST", "/api/next", json=body)
+    if name == "story":
+        return client.build_request("GET", f"/api/story/{random.choice(story_ids)}")
+    if name == "stories":
+        return client.build_request("GET", "/api/stories?limit=60")
+    if name == "pdf":
+        return client.build_request("GET", f"/download/{random.choice(story_ids)}.pdf")
+    raise ValueError(name)
+
+
+async def run_scenario(client: httpx.AsyncClient, name: str, requests: int, concurrency: int,
+                       story_ids: List[int]) -> Dict[str, object]:
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            req = request_for(client, name, i, story_ids)
+            t0 = time.perf_counter()
+            try:
+                resp = await client.send(req)
+                await resp.aread()
+                ok = resp.status_code < 400
+                status = str(resp.status_code)
+            except httpx.HTTPError as e:
+                resp, ok, status = None, False, type(e).__name__
+            latencies.append(time.perf_counter() - t0)
+            if not ok:
+                errors[status] = errors.get(status, 0) + 1
+            elif name == "generate":
+                story_ids.append(resp.json()["story_id"])
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - t0
+    return {"scenario": name, "requests": len(latencies), "errors": errors, "seconds": elapsed,
+            "rps": len(latencies) / elapsed if elapsed else 0.0, **percentiles(latencies)}
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+    s = sorted(values)
+
+    def pct(p: float) -> float:
+        return s[min(len(s) - 1, max(0, round(p / 100 * len(s)) - 1))] * 1000
+
+    return {"p50_ms": pct(50), "p95_ms": pct(95), "p99_ms": pct(99)}
+
+
+def print_report(rows: List[Dict[str, object]]):
+    print(f"{'scenario':<10} {'reqs':>6} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak RSS MB':>12}")
+    for r in rows:
+        rss = f"{r['peak_rss_mb']:.1f}" if r["peak_rss_mb"] is not None else "n/a"
+        errors = sum(r["errors"].values())
+        print(f"{r['scenario']:<10} {r['requests']:>6} {errors:>7} {r['rps']:>8.1f} "
+              f"{r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['p99_ms']:>9.1f} {rss:>12}")
+        if r["errors"]:
+            print(f"{'':<10} errors by status: {r['errors']}")
+
+
+async def seed_stories(client: httpx.AsyncClient, n: int, concurrency: int) -> List[int]:
+    ids: List[int] = []
+    await run_scenario(client, "generate", n, concurrency, ids)
+    return ids
+
+
+async def drive(args, sampler: Optional[RssSampler]) -> List[Dict[str, object]]:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        story_ids: List[int] = []
+        rows = []
+        for name in args.scenarios:
+            if name != "generate" and name != "stories" and not story_ids:
+                # scenario ที่ต้องมี story อยู่แล้ว -> สร้างก่อน (ไม่นับในผล)
+                story_ids = await seed_stories(client, args.seed_stories, args.concurrency)
+            if sampler:
+                sampler.reset()
+            row = await run_scenario(client, name, args.requests, args.concurrency, story_ids)
+            row["peak_rss_mb"] = sampler.peak_mb() if sampler else None
+            rows.append(row)
+        return rows
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma list of {', '.join(SCENARIOS)}")
+    ap.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--seed-stories", type=int, default=20, help="stories created when generate is skipped")
+    ap.add_argument("--backend", default="stub", choices=("stub", "replay"))
+    ap.add_argument("--cassette", default="gemini_cassette.jsonl", help="for --backend replay")
+    ap.add_argument("--latency", default="lognormal:0.5:0.4", help="stub text latency distribution")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="fraction of stub calls answering 429")
+    ap.add_argument("--rate-limits", default="", help="RATE_LIMITS for the server (default: effectively unlimited)")
+    ap.add_argument("--base-url", default="", help="drive an already running server instead of starting one")
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--json", default="", help="also write the results to this file")
+    args = ap.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        ap.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    random.seed(1)
+    proc = sampler = None
+    workdir = tempfile.TemporaryDirectory(prefix="loadtest-")
+    try:
+        if not args.base_url:
+            args.port = _free_port()
+            args.base_url = f"http://127.0.0.1:{args.port}"
+            proc = start_server(args, Path(workdir.name))
+            wait_ready(args.base_url, proc)
+            sampler = RssSampler(proc.pid)
+            sampler.start()
+
+        rows = asyncio.run(drive(args, sampler))
+    finally:
+        if sampler:
+            sampler.stop()
+        if proc:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        workdir.cleanup()
+
+    print(f"backend={args.backend} latency={args.latency} concurrency={args.concurrency} requests/scenario={args.requests}")
+    print_report(rows)
+    if args.json:
+        Path(args.json).write_text(json.dumps({"args": {k: v for k, v in vars(args).items()}, "results": rows}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import io
+import re
+import time
+import zipfile
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Sequence
+
+import storage
+import export_cache
+import images
+import render_pool
+
+# ---------------------------
+# Many stories -> one streamed ZIP
+# ---------------------------
+# อ่าน DB ทีละกลุ่ม EXPORT_BATCH เรื่อง (4 query ต่อกลุ่ม) และส่ง ZIP ออกไปทีละ chunk
+# memory ใช้แค่ระดับ 1 เรื่อง / 1 chunk ไม่ขึ้นกับขนาด archive
+EXPORT_BATCH = 25
+COPY_CHUNK = 64 * 1024
+TEXT_FORMATS = ("md", "txt")
+FORMATS = ("md", "txt", "pdf")
+
+
+def slug_filename(title: str, story_id: int) -> str:
+    filename_base = re.sub(r"[^a-zA-Z0-9ก-๙ _-]+", "", title).strip() or f"story_{story_id}"
+    return filename_base[:80]
+
+
+def write_text(f: BinaryIO, story: Dict[str, Any], chapters: Iterable[Dict[str, Any]], ext: str):
+    """Write the md/txt export chunk by chunk into f."""
+    for i, chunk in enumerate(storage.story_markdown_chunks(story, chapters)):
+        if ext == "txt":
+            chunk = chunk.replace("# ", "").replace("## ", "").replace("### ", "")
+        f.write((chunk if i == 0 else "\n" + chunk).encode("utf-8"))
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, non-seekable target for ZipFile; drain() hands out what was written."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+
+def _entry(name: str, compress_type: int) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = compress_type
+    return info
+
+
+def _open_pdf(story_id: int, version: str) -> BinaryIO:
+    """Cached PDF opened for reading, rendered through the process pool on a miss."""
+    f = export_cache.open_cached(story_id, version, "pdf")
+    if f is None:
+        with export_cache.staging(story_id, version, "pdf") as tmp:
+            render_pool.render_story_pdf_blocking(story_id, tmp)
+            f = export_cache.open_staged(tmp)
+    return f
+
+
+def _copy_file(zf: zipfile.ZipFile, sink: _Sink, fin: BinaryIO, name: str) -> Iterator[bytes]:
+    # pdf/png/webp บีบอัดมาแล้ว -> เก็บแบบ STORED ไม่เสีย CPU deflate ซ้ำ
+    with fin, zf.open(_entry(name, zipfile.ZIP_STORED), "w") as fout:
+        while True:
+            chunk = fin.read(COPY_CHUNK)
+            if not chunk:
+                break
+            fout.write(chunk)
+            yield sink.drain()
+
+
+def id_batches(story_ids: Sequence[int]) -> Iterator[List[int]]:
+    for i in range(0, len(story_ids), EXPORT_BATCH):
+        yield list(story_ids[i:i + EXPORT_BATCH])
+
+
+def iter_zip(batches: Iterable[List[int]], formats: Sequence[str], include_images: bool) -> Iterator[bytes]:
+    """
+    Yield a ZIP archive with one folder per story:
+      {id}-{title}/story.md|txt|pdf, {id}-{title}/images/...
+    A story whose PDF fails gets an ERROR.txt instead of failing the archive.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for ids in batches:
+            stories = storage.get_stories(ids)
+            chapters = storage.chapters_for_stories(ids)
+            versions = storage.story_versions(ids) if "pdf" in formats else {}
+            story_images = storage.images_for_stories(ids) if include_images else {}
+
+            for story in stories:
+                sid = story["id"]
+                folder = f"{sid}-{slug_filename(story['title'], sid)}"
+
+                for ext in TEXT_FORMATS:
+                    if ext in formats:
+                        with zf.open(_entry(f"{folder}/story.{ext}", zipfile.ZIP_DEFLATED), "w") as f:
+                            write_text(f, story, chapters[sid], ext)
+                        yield sink.drain()
+
+                if "pdf" in formats:
+                    try:
+                        yield from _copy_file(zf, sink, _open_pdf(sid, versions[sid]), f"{folder}/story.pdf")
+                    except Exception as e:
+                        zf.writestr(_entry(f"{folder}/ERROR.txt", zipfile.ZIP_DEFLATED), f"PDF: {type(e).__name__}: {e}")
+                        yield sink.drain()
+
+                for img in story_images.get(sid, []):
+                    src = images.IMAGE_DIR / f"{img['stem']}.{img['ext']}"
+                    try:
+                        fin = open(src, "rb")
+                    except FileNotFoundError:
+                        continue  # ถูก GC ไปแล้ว
+                    yield from _copy_file(zf, sink, fin, f"{folder}/images/{src.name}")
+
+    yield sink.drain()  # central directory
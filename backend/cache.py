@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import storage
+
+# ---------------------------
+# Config (env)
+# ---------------------------
+# LLM_CACHE_BACKEND: memory | sqlite | off
+# LLM_CACHE_ENDPOINTS: endpoint ที่ opt-in ให้ใช้ cache (คั่นด้วย ,)
+CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory").lower()
+CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+CACHE_ENDPOINTS = {e.strip() for e in os.getenv("LLM_CACHE_ENDPOINTS", "outline,generate").split(",") if e.strip()}
+
+
+def prompt_key(model: str, prompt: str) -> str:
+    """Content address of one LLM request."""
+    h = hashlib.sha256()
+    h.update(model.encode("utf-8"))
+    h.update(b"\0")
+    h.update(prompt.encode("utf-8"))
+    return h.hexdigest()
+
+
+# ---------------------------
+# Backends
+# ---------------------------
+class MemoryBackend:
+    """In-process LRU (OrderedDict) with per-entry expiry."""
+
+    blocking = False  # เร็วพอเรียกบน event loop ได้
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._data.move_to_end(key)
+            return item
+
+    def set(self, key: str, value: str, expires_at: float) -> int:
+        """Store a value, returns how many entries were evicted."""
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            evicted = 0
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def size(self) -> int:
+        return len(self._data)
+
+
+class SQLiteBackend:
+    """LRU table (llm_cache) inside the stories database."""
+
+    blocking = True  # disk I/O -> async caller เรียกผ่าน thread
+
+    def __init__(self, max_entries: int, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._con: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        # เปิด connection ตอนใช้ครั้งแรก (DB_PATH อาจถูกเปลี่ยนหลัง import)
+        if self._con is None:
+            self._con = sqlite3.connect(self.db_path or storage.DB_PATH, check_same_thread=False)
+            # ตาราง llm_cache มาจาก storage.MIGRATIONS (ไม่สร้างเองที่นี่)
+            storage.ensure_schema(self._con)
+        return self._con
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            con = self._db()
+            row = con.execute("SELECT value, expires_at FROM llm_cache WHERE key=?", (key,)).fetchone()
+            if row:
+                con.execute("UPDATE llm_cache SET accessed_at=? WHERE key=?", (time.time(), key))
+                con.commit()
+            return (row[0], row[1]) if row else None
+
+    def set(self, key: str, value: str, expires_at: float) -> int:
+        with self._lock:
+            con = self._db()
+            con.execute(
+                "INSERT OR REPLACE INTO llm_cache(key, value, expires_at, accessed_at) VALUES(?,?,?,?)",
+                (key, value, expires_at, time.time()),
+            )
+            # LRU: เก็บไว้แค่ max_entries แถวที่ถูกใช้ล่าสุด
+            cur = con.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                " SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            con.commit()
+            return max(cur.rowcount, 0)
+
+    def delete(self, key: str):
+        with self._lock:
+            con = self._db()
+            con.execute("DELETE FROM llm_cache WHERE key=?", (key,))
+            con.commit()
+
+    def size(self) -> int:
+        with self._lock:
+            return int(self._db().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0])
+
+
+# ---------------------------
+# Cache front
+# ---------------------------
+class ResponseCache:
+    def __init__(self, backend, ttl: float, endpoints):
+        self.backend = backend
+        self.ttl = ttl
+        self.endpoints = set(endpoints)
+        self.counters: Dict[str, int] = {"hits": 0, "misses": 0, "bypass": 0, "stores": 0, "evictions": 0}
+
+    def enabled_for(self, endpoint: str) -> bool:
+        return self.backend is not None and endpoint in self.endpoints
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        key = prompt_key(model, prompt)
+        item = self.backend.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.time():
+            self.backend.delete(key)
+            return None
+        return value
+
+    def set(self, model: str, prompt: str, value: str):
+        evicted = self.backend.set(prompt_key(model, prompt), value, time.time() + self.ttl)
+        self.counters["stores"] += 1
+        self.counters["evictions"] += evicted
+
+    def lookup(self, endpoint: str, model: str, prompt: str, mode: str = "default") -> Optional[str]:
+        """
+        mode (จาก Cache-Control ของ request):
+        - default: อ่าน/เขียน cache ตามปกติ
+        - no-cache: ข้ามการอ่าน แต่เก็บผลลัพธ์ใหม่
+        - no-store: ไม่แตะ cache เลย
+        """
+        if not self.enabled_for(endpoint):
+            return None
+        if mode != "default":
+            self.counters["bypass"] += 1
+            return None
+
+        hit = self.get(model, prompt)
+        self.counters["hits" if hit is not None else "misses"] += 1
+        return hit
+
+    def store(self, endpoint: str, model: str, prompt: str, value: str, mode: str = "default"):
+        if self.enabled_for(endpoint) and mode != "no-store" and value:
+            self.set(model, prompt, value)
+
+    async def alookup(self, endpoint: str, model: str, prompt: str, mode: str = "default") -> Optional[str]:
+        """lookup() for async callers (backend ที่ block -> ทำใน thread)."""
+        if self.enabled_for(endpoint) and self.backend.blocking:
+            return await asyncio.to_thread(self.lookup, endpoint, model, prompt, mode)
+        return self.lookup(endpoint, model, prompt, mode)
+
+    async def astore(self, endpoint: str, model: str, prompt: str, value: str, mode: str = "default"):
+        if self.enabled_for(endpoint) and self.backend.blocking:
+            await asyncio.to_thread(self.store, endpoint, model, prompt, value, mode)
+        else:
+            self.store(endpoint, model, prompt, value, mode)
+
+    async def get_or_generate(
+        self,
+        endpoint: str,
+        model: str,
+        prompt: str,
+        fetch: Callable[[], Awaitable[str]],
+        mode: str = "default",
+    ) -> str:
+        hit = await self.alookup(endpoint, model, prompt, mode)
+        if hit is not None:
+            return hit
+
+        value = await fetch()
+        await self.astore(endpoint, model, prompt, value, mode)
+        return value
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "backend": CACHE_BACKEND,
+            "endpoints": sorted(self.endpoints),
+            "ttl": self.ttl,
+            "max_entries": CACHE_MAX_ENTRIES,
+            "size": self.backend.size() if self.backend is not None else 0,
+            **self.counters,
+        }
+
+
+def cache_mode(cache_control: Optional[str]) -> str:
+    """Map a Cache-Control request header to a cache mode."""
+    directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+    if "no-store" in directives:
+        return "no-store"
+    if "no-cache" in directives or "max-age=0" in directives:
+        return "no-cache"
+    return "default"
+
+
+def _make_backend():
+    if CACHE_BACKEND == "sqlite":
+        return SQLiteBackend(CACHE_MAX_ENTRIES)
+    if CACHE_BACKEND == "memory":
+        return MemoryBackend(CACHE_MAX_ENTRIES)
+    return None
+
+
+llm_cache = ResponseCache(_make_backend(), CACHE_TTL, CACHE_ENDPOINTS)
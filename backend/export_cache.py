@@ -0,0 +1,136 @@
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, Optional
+
+import storage
+
+# ---------------------------
+# Rendered-export cache (md / txt / pdf)
+# ---------------------------
+# ไฟล์ชื่อ story_{id}_{version}_r{RENDER_VERSION}.{ext} - version เปลี่ยนเมื่อมี chapter ใหม่
+# อยู่นอก /static: ไฟล์ถูกส่งผ่าน /api/story/{id}/download เท่านั้น (ไม่ให้ดึงตรงโดยเดาชื่อไฟล์)
+EXPORT_DIR = Path(os.getenv("EXPORT_CACHE_DIR", "exports"))
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# เพิ่มเลขนี้เมื่อเปลี่ยนรูปแบบการ render -> ETag และไฟล์ใน cache เดิมใช้ไม่ได้ทันที
+# (ไฟล์รุ่นเก่าไม่มีใครอ่านอีก -> ถูก _evict() ลบทิ้งตาม LRU)
+RENDER_VERSION = "2"
+
+_lock = threading.Lock()
+
+
+def _path(story_id: int, version: str, ext: str) -> Path:
+    return EXPORT_DIR / f"story_{story_id}_{version}_r{RENDER_VERSION}.{ext}"
+
+
+def etag(story_id: int, version: str, ext: str) -> str:
+    return f'"{story_id}-{version}-{ext}-r{RENDER_VERSION}"'
+
+
+def etag_matches(if_none_match: Optional[str], tag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+    return tag in candidates
+
+
+def open_cached(story_id: int, version: str, ext: str) -> Optional[BinaryIO]:
+    """
+    Open a cached export for reading, or None on a miss. The caller owns the
+    handle; it stays readable even if the file is evicted/invalidated meanwhile.
+    """
+    try:
+        f = open(_path(story_id, version, ext), "rb")
+    except FileNotFoundError:
+        return None
+    os.utime(f.fileno())  # mtime = last used (ใช้ทำ LRU)
+    return f
+
+
+@contextmanager
+def staging(story_id: int, version: str, ext: str) -> Iterator[Path]:
+    """
+    Yield a temp path to render into; on success it is moved into the cache
+    atomically (worker อื่นไม่เห็นไฟล์ครึ่งๆ).
+    """
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    path = _path(story_id, version, ext)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        # job ที่ยังเขียนอยู่ (timeout) จะลบไฟล์เองเมื่อเสร็จ
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    _evict()
+
+
+def open_staged(tmp: Path) -> BinaryIO:
+    """
+    Open a file rendered inside staging() before it is moved into the cache,
+    so the caller can serve it whatever _evict()/invalidate() do afterwards.
+    """
+    return open(tmp, "rb")
+
+
+def put(story_id: int, version: str, ext: str, write: Callable[[BinaryIO], None]) -> BinaryIO:
+    """
+    Render into the cache by calling write(fileobj) on a temp file, so the
+    export is streamed to disk instead of being built as one bytes object.
+    Returns the rendered file opened for reading (caller closes it).
+    """
+    f = None
+    try:
+        with staging(story_id, version, ext) as tmp:
+            f = open(tmp, "w+b")
+            write(f)
+        f.seek(0)
+        return f
+    except BaseException:
+        if f is not None:
+            f.close()
+        raise
+
+
+def invalidate(story_id: int):
+    for path in EXPORT_DIR.glob(f"story_{story_id}_*"):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _evict():
+    """Delete least recently used exports until the directory fits the size budget."""
+    with _lock:
+        entries = []
+        total = 0
+        for path in EXPORT_DIR.glob("story_*"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= EXPORT_CACHE_MAX_BYTES:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+storage.on_story_changed(invalidate)
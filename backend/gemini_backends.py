@@ -0,0 +1,464 @@
+import asyncio
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from prompts import ILLUSTRATION_PROMPT_RULES, OUTPUT_FORMAT_FIRST, OUTPUT_FORMAT_NEXT, SUMMARY_RULES
+from singleflight import call_key
+
+# ---------------------------
+# Config (env)
+# ---------------------------
+# GEMINI_BACKEND (อ่านตอนสร้าง client ใน gemini_client): live (default) | stub | record | replay
+#   stub   - ไม่ต่อเน็ต ตอบข้อความไทยตาม OUTPUT_FORMAT_* หลัง latency ที่สุ่มจาก distribution
+#   record - เรียก Gemini จริงและบันทึก response ลง GEMINI_CASSETTE (JSONL)
+#   replay - ตอบจาก GEMINI_CASSETTE; call ที่ไม่เคยบันทึก -> error หรือ stub (GEMINI_REPLAY_MISS)
+# GEMINI_STUB_LATENCY / GEMINI_STUB_IMAGE_LATENCY: "fixed:S" | "uniform:A:B" | "lognormal:MEDIAN:SIGMA" (วินาที)
+# GEMINI_STUB_429_RATE: สัดส่วน call ที่ตอบ 429 (0..1)
+GEMINI_CASSETTE = os.getenv("GEMINI_CASSETTE", "gemini_cassette.jsonl")
+GEMINI_REPLAY_MISS = os.getenv("GEMINI_REPLAY_MISS", "error").lower()
+GEMINI_REPLAY_LATENCY = os.getenv("GEMINI_REPLAY_LATENCY", "recorded").lower()  # recorded | none
+GEMINI_STUB_LATENCY = os.getenv("GEMINI_STUB_LATENCY", "lognormal:1.5:0.4")
+GEMINI_STUB_IMAGE_LATENCY = os.getenv("GEMINI_STUB_IMAGE_LATENCY", "lognormal:6:0.3")
+GEMINI_STUB_429_RATE = float(os.getenv("GEMINI_STUB_429_RATE", "0"))
+GEMINI_STUB_STREAM_CHUNKS = int(os.getenv("GEMINI_STUB_STREAM_CHUNKS", "24"))
+GEMINI_STUB_SEED = os.getenv("GEMINI_STUB_SEED")
+
+BACKENDS = ("live", "stub", "record", "replay")
+
+
+def create_client(backend: str, live: Callable[[], Any]) -> Any:
+    """Client for `backend`; live() builds the real genai.Client when one is needed."""
+    if backend == "live":
+        return live()
+    if backend == "stub":
+        return StubClient.from_env()
+    if backend == "record":
+        return RecordingClient(live(), Cassette(GEMINI_CASSETTE))
+    if backend == "replay":
+        fallback = StubClient.from_env() if GEMINI_REPLAY_MISS == "stub" else None
+        return ReplayClient(Cassette(GEMINI_CASSETTE), fallback, GEMINI_REPLAY_LATENCY == "recorded")
+    raise ValueError(f"GEMINI_BACKEND must be one of {', '.join(BACKENDS)}, got {backend!r}")
+
+
+def _prompt_text(contents: Any) -> str:
+    if isinstance(contents, str):
+        return contents
+    return "\n".join(str(c) for c in contents)
+
+
+def _aspect_ratio(config: Any) -> Optional[str]:
+    image_config = getattr(config, "image_config", None)
+    return getattr(image_config, "aspect_ratio", None) if image_config is not None else None
+
+
+def _response_from_json(data: str):
+    from google.genai import types
+
+    return types.GenerateContentResponse.model_validate_json(data)
+
+
+# ---------------------------
+# Stub
+# ---------------------------
+class Latency:
+    """Latency distribution parsed from "fixed:S", "uniform:A:B" or "lognormal:MEDIAN:SIGMA"."""
+
+    def __init__(self, spec: str):
+        kind, *args = spec.split(":")
+        self.kind = kind.strip().lower()
+        self.args = [float(a) for a in args]
+        if self.kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"unknown latency distribution: {spec!r}")
+        self.spec = spec
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.args[0], self.args[1])
+        median, sigma = self.args
+        return rng.lognormvariate(math.log(median), sigma)
+
+
+_NAMES = ("มะลิ", "ก้อนเมฆ", "ต้นข้าว", "ดาวเหนือ", "ลมหนาว", "ใบเตย")
+_PLACES = ("หมู่บ้านริมน้ำ", "ป่าไผ่หลังเขา", "ตลาดน้ำยามเช้า", "ห้องสมุดเก่าในเมือง", "เกาะเล็กกลางทะเล")
+_SENTENCES = (
+    "{name}ตื่นขึ้นมาพร้อมกับเสียงนกที่ร้องอยู่นอกหน้าต่างของ{place}",
+    "แสงแดดอ่อนๆ ส่องลอดผ่านใบไม้ลงมาเป็นดวงเล็กดวงน้อยบนพื้นดิน",
+    "{name}สังเกตเห็นกล่องไม้เล็กๆ ที่ไม่เคยเห็นมาก่อนวางอยู่ข้างประตู",
+    "ภายในกล่องมีแผนที่เก่าที่วาดด้วยหมึกสีน้ำเงินจางๆ",
+    "เพื่อนบ้านหลายคนบอกว่าแผนที่นี้พาไปยังที่ที่ไม่มีใครกลับมาเล่าได้ครบ",
+    "แต่{name}รู้สึกว่าหัวใจของตัวเองเต้นแรงด้วยความอยากรู้มากกว่าความกลัว",
+    "ระหว่างทางมีลมเย็นพัดผ่าน กลิ่นดอกไม้ป่าลอยมาเป็นระยะ",
+    "{name}ได้พบกับแมวสีส้มตัวหนึ่งที่ดูเหมือนจะรู้ทางดีกว่าใคร",
+    "ทั้งสองเดินตามลำธารไปจนถึงสะพานไม้ที่ผุพังไปครึ่งหนึ่ง",
+    "เมื่อข้ามไปได้ {name}ก็เข้าใจว่าความกล้าไม่ได้แปลว่าไม่กลัว แต่คือการก้าวต่อไปทั้งที่กลัว",
+)
+_IMAGE_SIZES = {"1:1": (1024, 1024), "3:4": (768, 1024), "4:3": (1024, 768), "9:16": (576, 1024), "16:9": (1024, 576)}
+
+
+class StubClient:
+    """
+    Offline stand-in for genai.Client (same .models / .aio.models surface the
+    app uses). Answers are deterministic per prompt; only latency and 429
+    injection are random.
+    """
+
+    def __init__(self, latency: Latency, image_latency: Latency, rate_429: float = 0.0,
+                 stream_chunks: int = 24, seed: Optional[int] = None):
+        self.latency = latency
+        self.image_latency = image_latency
+        self.rate_429 = rate_429
+        self.stream_chunks = max(1, stream_chunks)
+        self.rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._images: Dict[str, bytes] = {}
+        self.counters: Dict[str, int] = {"calls": 0, "rate_limited": 0}
+        self.models = _SyncModels(self)
+        self.aio = _AsyncAPI(_StubAsyncModels(self))
+
+    @classmethod
+    def from_env(cls) -> "StubClient":
+        return cls(
+            Latency(GEMINI_STUB_LATENCY),
+            Latency(GEMINI_STUB_IMAGE_LATENCY),
+            GEMINI_STUB_429_RATE,
+            GEMINI_STUB_STREAM_CHUNKS,
+            int(GEMINI_STUB_SEED) if GEMINI_STUB_SEED else None,
+        )
+
+    def close(self):
+        pass
+
+    # -- behaviour --------------------------------------------------------
+    def plan(self, config: Any) -> Tuple[float, bool]:
+        """(latency, answer with 429?) for one call."""
+        with self._rng_lock:
+            self.counters["calls"] += 1
+            limited = self.rng.random() < self.rate_429
+            if limited:
+                self.counters["rate_limited"] += 1
+                return self.rng.uniform(0.01, 0.05), True
+            dist = self.image_latency if _aspect_ratio(config) else self.latency
+            return max(0.0, dist.sample(self.rng)), False
+
+    @staticmethod
+    def rate_limited_error():
+        from google.genai import errors
+
+        return errors.ClientError(429, {"error": {
+            "code": 429,
+            "message": "Resource has been exhausted (stub).",
+            "status": "RESOURCE_EXHAUSTED",
+            "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "1s"}],
+        }})
+
+    def text_for(self, prompt: str) -> str:
+        # seed จาก prompt -> prompt เดิมได้คำตอบเดิม (cache / single-flight ทดสอบได้)
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        name, place = rng.choice(_NAMES), rng.choice(_PLACES)
+
+        def paragraphs(n: int) -> str:
+            out = []
+            for _ in range(n):
+                sentences = rng.sample(_SENTENCES, 5)
+                out.append(" ".join(s.format(name=name, place=place) for s in sentences))
+            return "\n\n".join(out)
+
+        if OUTPUT_FORMAT_NEXT in prompt:
+            return (
+                f"[Chapter Title]\n{name}กับประตูบานที่{rng.randint(2, 99)}\n\n"
+                f"[Chapter]\n{paragraphs(6)}\n\n"
+                f"[Cliffhanger]\nแล้วเสียงเคาะประตูก็ดังขึ้นอีกครั้ง..."
+            )
+        if OUTPUT_FORMAT_FIRST in prompt:
+            return (
+                f"[Title]\n{name}และแผนที่แห่ง{place}\n\n"
+                f"[Story]\n{paragraphs(8)}\n\n"
+                f"[Moral]\nความกล้าหาญเริ่มจากก้าวเล็กๆ ที่เราเลือกเดินเอง\n\n"
+                f"[Summary]\n- {name}พบแผนที่เก่า\n- ออกเดินทางกับแมวสีส้ม\n- ข้ามสะพานไม้ได้สำเร็จ"
+            )
+        if SUMMARY_RULES in prompt:
+            return paragraphs(2)
+        if ILLUSTRATION_PROMPT_RULES in prompt:
+            return f"Soft watercolor illustration of {name} with an orange cat near {place}, warm morning light, no text."
+        if "- Title idea:" in prompt:
+            return (
+                f"- Title idea: {name}และแผนที่แห่ง{place}\n- Main conflict: ทางข้างหน้าอันตรายและไม่มีใครเชื่อ\n"
+                f"- Key scenes (3-6 scenes):\n  - พบแผนที่\n  - พบแมวสีส้ม\n  - ข้ามสะพานไม้\n"
+                f"- Ending: กลับบ้านพร้อมเรื่องเล่าใหม่\n- Moral: ความกล้าไม่ได้แปลว่าไม่กลัว"
+            )
+        return paragraphs(1)
+
+    def image_for(self, aspect_ratio: str) -> bytes:
+        data = self._images.get(aspect_ratio)
+        if data is None:
+            from PIL import Image
+
+            size = _IMAGE_SIZES.get(aspect_ratio, (768, 1024))
+            buf = io.BytesIO()
+            Image.new("RGB", size, (238, 200, 150)).save(buf, format="PNG")
+            data = self._images[aspect_ratio] = buf.getvalue()
+        return data
+
+    def response(self, model: str, contents: Any, config: Any = None, text: Optional[str] = None):
+        from google.genai import types
+
+        prompt = _prompt_text(contents)
+        aspect_ratio = _aspect_ratio(config)
+        if aspect_ratio:
+            parts = [types.Part(inline_data=types.Blob(data=self.image_for(aspect_ratio), mime_type="image/png"))]
+            out_tokens = 1290
+        else:
+            text = self.text_for(prompt) if text is None else text
+            parts = [types.Part(text=text)]
+            out_tokens = len(text) // 3
+        prompt_tokens = len(prompt) // 3
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts), finish_reason="STOP")],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=out_tokens,
+                total_token_count=prompt_tokens + out_tokens,
+            ),
+            model_version=model,
+        )
+
+    def sync_generate(self, model: str, contents: Any, config: Any = None):
+        delay, limited = self.plan(config)
+        time.sleep(delay)
+        if limited:
+            raise self.rate_limited_error()
+        return self.response(model, contents, config)
+
+    def stream_pieces(self, prompt: str) -> List[str]:
+        text = self.text_for(prompt)
+        step = max(1, math.ceil(len(text) / self.stream_chunks))
+        return [text[i:i + step] for i in range(0, len(text), step)]
+
+
+class _SyncModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def generate_content(self, model: str, contents: Any, config: Any = None):
+        return self._owner.sync_generate(model, contents, config)
+
+
+class _AsyncAPI:
+    def __init__(self, models):
+        self.models = models
+
+    async def aclose(self):
+        pass
+
+
+class _StubAsyncModels:
+    def __init__(self, stub: StubClient):
+        self._stub = stub
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None):
+        delay, limited = self._stub.plan(config)
+        await asyncio.sleep(delay)
+        if limited:
+            raise self._stub.rate_limited_error()
+        return self._stub.response(model, contents, config)
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> AsyncIterator[Any]:
+        delay, limited = self._stub.plan(config)
+        if limited:
+            await asyncio.sleep(delay)
+            raise self._stub.rate_limited_error()
+        return self._stream(model, _prompt_text(contents), delay)
+
+    async def _stream(self, model: str, prompt: str, delay: float) -> AsyncIterator[Any]:
+        # ~30% ของเวลาไปกับ chunk แรก ที่เหลือกระจายเท่าๆ กัน
+        pieces = self._stub.stream_pieces(prompt)
+        usage = self._stub.response(model, prompt).usage_metadata
+        await asyncio.sleep(delay * 0.3)
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(delay * 0.7 / len(pieces))
+            resp = self._stub.response(model, prompt, text=piece)
+            # usage ของทั้งคำตอบมาเฉพาะ chunk สุดท้ายเหมือนของจริง
+            resp.usage_metadata = usage if i == len(pieces) - 1 else None
+            yield resp
+
+
+
+# ---------------------------
+# Record / replay
+# ---------------------------
+class Cassette:
+    """
+    JSONL file of recorded responses, one line per call:
+    {"key", "kind": "generate" | "stream", "model", "seconds", "responses": [GenerateContentResponse JSON, ...]}
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self._next: Dict[Tuple[str, str], int] = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries.setdefault((entry["kind"], entry["key"]), []).append(entry)
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._entries.values())
+
+    def append(self, kind: str, key: str, model: str, seconds: float, responses: List[Any]):
+        entry = {
+            "key": key,
+            "kind": kind,
+            "model": model,
+            "seconds": round(seconds, 4),
+            "responses": [r.model_dump_json(exclude_none=True) for r in responses],
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._entries.setdefault((kind, key), []).append(entry)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def lookup(self, kind: str, key: str) -> Optional[Dict[str, Any]]:
+        """Recorded entry for this call; several recordings of one call are served round-robin."""
+        with self._lock:
+            entries = self._entries.get((kind, key))
+            if not entries:
+                return None
+            i = self._next.get((kind, key), 0)
+            self._next[(kind, key)] = i + 1
+            return entries[i % len(entries)]
+
+
+def _key(model: str, contents: Any, config: Any) -> str:
+    return call_key(model, _prompt_text(contents), config)
+
+
+class RecordingClient:
+    """Wraps the live client and appends every successful response to the cassette."""
+
+    def __init__(self, inner: Any, cassette: Cassette):
+        self._inner = inner
+        self.cassette = cassette
+        self.models = _SyncModels(self)
+        self.aio = _RecordingAsyncAPI(self)
+
+    def sync_generate(self, model: str, contents: Any, config: Any = None):
+        t0 = time.perf_counter()
+        resp = self._inner.models.generate_content(model=model, contents=contents, config=config)
+        self.cassette.append("generate", _key(model, contents, config), model, time.perf_counter() - t0, [resp])
+        return resp
+
+    def close(self):
+        self._inner.close()
+
+
+class _RecordingAsyncAPI:
+    def __init__(self, owner: RecordingClient):
+        self._owner = owner
+        self.models = self
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None):
+        o = self._owner
+        t0 = time.perf_counter()
+        resp = await o._inner.aio.models.generate_content(model=model, contents=contents, config=config)
+        o.cassette.append("generate", _key(model, contents, config), model, time.perf_counter() - t0, [resp])
+        return resp
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None):
+        o = self._owner
+        t0 = time.perf_counter()
+        stream = await o._inner.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+
+        async def tee():
+            chunks = []
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+            # บันทึกเฉพาะ stream ที่อ่านจนจบ
+            o.cassette.append("stream", _key(model, contents, config), model, time.perf_counter() - t0, chunks)
+
+        return tee()
+
+    async def aclose(self):
+        await self._owner._inner.aio.aclose()
+
+
+class ReplayMiss(LookupError):
+    """No recorded response for this call (GEMINI_REPLAY_MISS=error)."""
+
+
+class ReplayClient:
+    """Serves responses from a cassette; misses go to `fallback` (a StubClient) or raise ReplayMiss."""
+
+    def __init__(self, cassette: Cassette, fallback: Optional[StubClient] = None, with_latency: bool = True):
+        self.cassette = cassette
+        self.fallback = fallback
+        self.with_latency = with_latency
+        self.counters: Dict[str, int] = {"hits": 0, "misses": 0}
+        self.models = _SyncModels(self)
+        self.aio = _AsyncAPI(_ReplayAsyncModels(self))
+
+    def entry(self, kind: str, model: str, contents: Any, config: Any) -> Optional[Dict[str, Any]]:
+        entry = self.cassette.lookup(kind, _key(model, contents, config))
+        if entry is None:
+            self.counters["misses"] += 1
+            if self.fallback is None:
+                raise ReplayMiss(f"no recorded {kind} response for model {model} (cassette {self.cassette.path})")
+            return None
+        self.counters["hits"] += 1
+        return entry
+
+    def delay(self, entry: Dict[str, Any]) -> float:
+        return entry["seconds"] if self.with_latency else 0.0
+
+    def sync_generate(self, model: str, contents: Any, config: Any = None):
+        entry = self.entry("generate", model, contents, config)
+        if entry is None:
+            return self.fallback.models.generate_content(model=model, contents=contents, config=config)
+        time.sleep(self.delay(entry))
+        return _response_from_json(entry["responses"][0])
+
+    def close(self):
+        pass
+
+
+class _ReplayAsyncModels:
+    def __init__(self, replay: ReplayClient):
+        self._replay = replay
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None):
+        r = self._replay
+        entry = r.entry("generate", model, contents, config)
+        if entry is None:
+            return await r.fallback.aio.models.generate_content(model=model, contents=contents, config=config)
+        await asyncio.sleep(r.delay(entry))
+        return _response_from_json(entry["responses"][0])
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None):
+        r = self._replay
+        entry = r.entry("stream", model, contents, config)
+        if entry is None:
+            return await r.fallback.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+
+        async def chunks():
+            responses = entry["responses"]
+            for raw in responses:
+                await asyncio.sleep(r.delay(entry) / max(1, len(responses)))
+                yield _response_from_json(raw)
+
+        return chunks()
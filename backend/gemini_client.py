@@ -1,68 +1,308 @@
+import io
+import itertools
 import os
+import sys
+import threading
 import time
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Optional, Tuple, TypeVar
+
 from dotenv import load_dotenv
-from google import genai
-from google.genai import types
+
+import gemini_backends
+import metrics
+import rate_limit
+from rate_limit import RateLimited
+from singleflight import SingleFlight, call_key
 
 load_dotenv()
 
+# google.genai ใช้เวลา import ~0.6s -> import ตอนสร้าง client ครั้งแรก ไม่ใช่ตอน server start
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai import types
+
+# request ที่เหมือนกันทุกอย่าง (model, prompt, config) ที่มาพร้อมกัน -> เรียก Gemini ครั้งเดียว
+flights = SingleFlight()
+
+# client เดียวทั้ง process -> ใช้ HTTP connection pool ร่วมกัน (ทั้ง sync และ client.aio)
+_client: Optional["genai.Client"] = None
+_client_lock = threading.Lock()
+
+
 def _get_key() -> str:
     return os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY") or ""
 
-def generate_text(model: str, prompt: str) -> str:
+
+def get_client() -> "genai.Client":
+    """Return the process-wide Gemini client, creating it on first use."""
+    global _client
+    if _client is not None:
+        return _client
+
+    with _client_lock:
+        if _client is None:
+            # GEMINI_BACKEND=stub|record|replay -> ดู gemini_backends.py (benchmark / ทดสอบแบบ offline)
+            _client = gemini_backends.create_client(os.getenv("GEMINI_BACKEND", "live").lower(), _live_client)
+        return _client
+
+
+def _live_client() -> "genai.Client":
     api_key = _get_key()
     if not api_key:
         raise RuntimeError("Missing GEMINI_API_KEY or GOOGLE_API_KEY in environment/.env")
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+
+def api_error_status(e: Exception) -> Optional[Tuple[str, int]]:
+    """("ClientError", 400) / ("ServerError", 502) for Gemini API errors, else None."""
+    # ยังไม่เคย import SDK -> e มาจาก SDK ไม่ได้ (ไม่ต้อง import แค่เพื่อเช็ค type)
+    errors = sys.modules.get("google.genai.errors")
+    if errors is None:
+        return None
+    if isinstance(e, errors.ClientError):
+        return "ClientError", 400
+    if isinstance(e, errors.ServerError):
+        return "ServerError", 502
+    return None
+
+
+async def aclose():
+    """Close the shared client's connection pools (call on app shutdown)."""
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is None:
+        return
+    await client.aio.aclose()
+    client.close()
+
+
+T = TypeVar("T")
+
 
-    client = genai.Client(api_key=api_key)
+def _is_rate_limited(e: Exception) -> bool:
+    if getattr(e, "code", None) == 429:
+        return True
+    s = str(e)
+    return "429" in s or "RESOURCE_EXHAUSTED" in s
 
-    # retry 1 ครั้งถ้า 429
-    for attempt in range(2):
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """Server hint: Retry-After header, or RetryInfo.retryDelay ("23s") in the error body."""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers is not None:
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+
+    details = getattr(e, "details", None)
+    err = details.get("error", details) if isinstance(details, dict) else {}
+    for d in err.get("details") or []:
+        delay = d.get("retryDelay") if isinstance(d, dict) else None
+        if delay:
+            try:
+                return float(str(delay).rstrip("s"))
+            except ValueError:
+                pass
+    return None
+
+
+def _on_rate_limited(limiter: rate_limit.TokenBucket, model: str, attempt: int, e: Exception):
+    """
+    429 from Gemini: pause the model's bucket (ทุก request ของ model นี้รอด้วย
+    ไม่ใช่แค่ตัวที่โดน) then let the caller retry, or raise RateLimited when out of retries.
+    """
+    delay = rate_limit.backoff_delay(attempt, _retry_after(e))
+    limiter.penalize(delay)
+    if attempt >= rate_limit.RATE_LIMIT_RETRIES:
+        metrics.GEMINI_RATE_LIMITED.inc(model=model, action="give_up")
+        raise RateLimited(model, delay) from e
+    metrics.GEMINI_RATE_LIMITED.inc(model=model, action="retry")
+    limiter.counters["retries"] += 1
+
+
+def _observe_error(model: str, method: str, t0: float, e: Exception) -> bool:
+    """Record a failed upstream call; True when it was a 429."""
+    limited = _is_rate_limited(e)
+    metrics.observe_gemini(model, method, time.perf_counter() - t0, "rate_limited" if limited else "error")
+    return limited
+
+
+def _call(model: str, method: str, fn: Callable[[], T]) -> T:
+    limiter = rate_limit.limiter_for(model)
+    for attempt in itertools.count():
+        limiter.acquire_blocking()
+        t0 = time.perf_counter()
         try:
-            resp = client.models.generate_content(model=model, contents=prompt)
-            return (resp.text or "").strip()
+            resp = fn()
         except Exception as e:
-            s = str(e)
-            if attempt == 0 and ("429" in s or "RESOURCE_EXHAUSTED" in s):
-                time.sleep(1.5)
-                continue
-            raise
+            if not _observe_error(model, method, t0, e):
+                raise
+            _on_rate_limited(limiter, model, attempt, e)
+        else:
+            metrics.observe_gemini(model, method, time.perf_counter() - t0, "ok", resp)
+            return resp
+
+
+async def _acall(model: str, method: str, fn: Callable[[], Awaitable[T]]) -> T:
+    limiter = rate_limit.limiter_for(model)
+    for attempt in itertools.count():
+        await limiter.acquire()
+        t0 = time.perf_counter()
+        try:
+            resp = await fn()
+        except Exception as e:
+            if not _observe_error(model, method, t0, e):
+                raise
+            _on_rate_limited(limiter, model, attempt, e)
+        else:
+            metrics.observe_gemini(model, method, time.perf_counter() - t0, "ok", resp)
+            return resp
+
+
+def _image_config(aspect_ratio: str) -> "types.GenerateContentConfig":
+    from google.genai import types
+    return types.GenerateContentConfig(
+        response_modalities=["IMAGE"],
+        image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
+    )
+
+
+# mime type ที่เขียนลงไฟล์ได้ตรงๆ โดยไม่ต้อง decode/encode ใหม่
+RAW_IMAGE_TYPES = ("image/png", "image/jpeg", "image/webp")
+
+
+def _to_png(data: bytes) -> bytes:
+    from PIL import Image
+
+    buf = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as img:
+        img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _image_from_response(resp) -> Tuple[bytes, str]:
+    """Return (bytes, mime_type) of the first inline image part."""
+    # ตาม docs: response.parts มีทั้ง text และ inline_data
+    for part in resp.parts or []:
+        blob = part.inline_data
+        if blob is None or not blob.data:
+            continue
+        mime = (blob.mime_type or "").lower()
+        if mime in RAW_IMAGE_TYPES:
+            return blob.data, mime
+        # รูปแบบอื่น (เช่น gif/bmp) -> แปลงเป็น PNG
+        return _to_png(blob.data), "image/png"
+
+    raise RuntimeError("No image returned from model.")
+
+
+# ---------------------------
+# Sync API
+# ---------------------------
+# app ใช้ Async API ด้านล่างทั้งหมด - ชุดนี้เก็บไว้ให้ script/งานที่รันใน thread
+# (เช่น bench/bench_singleflight.py) เรียก Gemini แบบ blocking ได้โดยไม่ต้องมี event loop
+# ทุก call ผ่าน single-flight -> rate limiter ของ model นั้น (rate_limit.py) และ retry 429 ด้วย backoff
+# เวลารอของผู้เรียก (รวมรอคิว/รอ call ที่ซ้ำกัน) -> stage "gemini" ใน Server-Timing
+# เวลาของแต่ละ call จริง -> histogram gemini_request_seconds
+def generate_text(model: str, prompt: str) -> str:
+    client = get_client()
+
+    def run() -> str:
+        resp = _call(model, "generate_text", lambda: client.models.generate_content(model=model, contents=prompt))
+        return (resp.text or "").strip()
+
+    with metrics.stage("gemini"):
+        return flights.do_blocking(call_key(model, prompt), run)
+
+
+def generate_image(model: str, prompt: str, aspect_ratio: str = "3:4") -> Tuple[bytes, str]:
+    """
+    Returns (image bytes, mime type) generated by Gemini image model.
+    """
+    client = get_client()
+    config = _image_config(aspect_ratio)
+
+    def run() -> Tuple[bytes, str]:
+        resp = _call(model, "generate_image", lambda: client.models.generate_content(
+            model=model,
+            contents=[prompt],
+            config=config,
+        ))
+        return _image_from_response(resp)
+
+    with metrics.stage("gemini"):
+        return flights.do_blocking(call_key(model, prompt, config), run)
+
 
 def generate_image_png_bytes(model: str, prompt: str, aspect_ratio: str = "3:4") -> bytes:
     """
     Returns PNG bytes generated by Gemini image model.
     """
-    api_key = _get_key()
-    if not api_key:
-        raise RuntimeError("Missing GEMINI_API_KEY or GOOGLE_API_KEY in environment/.env")
+    data, mime = generate_image(model, prompt, aspect_ratio)
+    return data if mime == "image/png" else _to_png(data)
+
 
-    client = genai.Client(api_key=api_key)
+# ---------------------------
+# Async API (client.aio) - ไม่กิน worker thread ระหว่างรอ Gemini
+# ---------------------------
+async def agenerate_text(model: str, prompt: str) -> str:
+    client = get_client()
 
-    # retry 1 ครั้งถ้า 429
-    for attempt in range(2):
+    async def run() -> str:
+        resp = await _acall(model, "generate_text", lambda: client.aio.models.generate_content(model=model, contents=prompt))
+        return (resp.text or "").strip()
+
+    with metrics.stage("gemini"):
+        return await flights.do(call_key(model, prompt), run)
+
+
+async def astream_text(model: str, prompt: str) -> AsyncIterator[str]:
+    """
+    Yield text chunks as Gemini produces them (generate_content_stream).
+    Retry 429 ได้เฉพาะก่อนที่ chunk แรกจะถูกส่งออกไป
+    """
+    client = get_client()
+    limiter = rate_limit.limiter_for(model)
+
+    for attempt in itertools.count():
+        await limiter.acquire()
+        started = False
+        t0 = time.perf_counter()
+        last = None  # usage_metadata มาใน chunk สุดท้าย
         try:
-            resp = client.models.generate_content(
-                model=model,
-                contents=[prompt],
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"],
-                    image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
-                ),
-            )
-
-            # ตาม docs: response.parts มีทั้ง text และ inline_data, และ part.as_image() ได้ :contentReference[oaicite:2]{index=2}
-            for part in resp.parts:
-                if part.inline_data is not None:
-                    img = part.as_image()  # PIL Image
-                    import io
-                    buf = io.BytesIO()
-                    img.save(buf, format="PNG")
-                    return buf.getvalue()
-
-            raise RuntimeError("No image returned from model.")
+            stream = await client.aio.models.generate_content_stream(model=model, contents=prompt)
+            async for chunk in stream:
+                last = chunk
+                text = chunk.text or ""
+                if text:
+                    started = True
+                    yield text
         except Exception as e:
-            s = str(e)
-            if attempt == 0 and ("429" in s or "RESOURCE_EXHAUSTED" in s):
-                time.sleep(1.5)
-                continue
-            raise
\ No newline at end of file
+            if not _observe_error(model, "stream_text", t0, e) or started:
+                raise
+            _on_rate_limited(limiter, model, attempt, e)
+        else:
+            metrics.observe_gemini(model, "stream_text", time.perf_counter() - t0, "ok", last)
+            return
+
+
+async def agenerate_image(model: str, prompt: str, aspect_ratio: str = "3:4") -> Tuple[bytes, str]:
+    """
+    Async version of generate_image.
+    """
+    client = get_client()
+    config = _image_config(aspect_ratio)
+
+    async def run() -> Tuple[bytes, str]:
+        resp = await _acall(model, "generate_image", lambda: client.aio.models.generate_content(
+            model=model,
+            contents=[prompt],
+            config=config,
+        ))
+        return _image_from_response(resp)
+
+    with metrics.stage("gemini"):
+        return await flights.do(call_key(model, prompt, config), run)
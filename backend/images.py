@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+
+import storage
+
+# Pillow import ตอน encode รูปครั้งแรก (ไม่ใช่ตอน server start)
+if TYPE_CHECKING:
+    from PIL import Image
+
+log = logging.getLogger(__name__)
+
+# ---------------------------
+# Generated-image assets
+# ---------------------------
+# ต่อ 1 ภาพ:
+#   story_{id}_{hash}.{png|jpg|webp}  ต้นฉบับจาก model (ไม่ decode/encode ใหม่)
+#   story_{id}_{hash}_lg.webp         WebP ขนาดเต็ม (เล็กกว่า PNG มาก)
+#   story_{id}_{hash}_sm.webp         thumbnail สำหรับหน้า list / story
+# ชื่อไฟล์มาจาก hash ของเนื้อหา -> ไฟล์ไม่เปลี่ยนอีก เสิร์ฟแบบ immutable ได้
+# ทุกภาพมีแถวในตาราง images (stem = ชื่อไฟล์ไม่รวม suffix/นามสกุล)
+IMAGE_DIR = Path(os.getenv("IMAGE_DIR", "static/generated"))
+IMAGE_URL_PREFIX = "/static/generated"
+THUMB_SIZE = int(os.getenv("IMAGE_THUMB_SIZE", "384"))
+WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+
+# GC: ลบไฟล์ที่ story ถูกลบไปแล้ว + คุมขนาดรวมไม่เกิน quota (ลบภาพที่ใช้ล่าสุดนานที่สุดก่อน)
+IMAGE_QUOTA_BYTES = int(os.getenv("IMAGE_QUOTA_BYTES", str(1024 * 1024 * 1024)))
+IMAGE_GC_INTERVAL = float(os.getenv("IMAGE_GC_INTERVAL", "600"))
+IMAGE_GC_GRACE = 600  # ไฟล์ที่อายุน้อยกว่านี้อาจกำลังถูกเขียน/ยังไม่ลง table -> ไม่แตะ
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+MIME_TYPES = {ext: mime for mime, ext in EXTENSIONS.items()}
+_VARIANT_SUFFIXES = ("_lg", "_sm")
+
+# stem -> เวลาที่ถูกเสิร์ฟล่าสุด (เก็บใน memory แล้ว GC flush ลง DB ทีเดียว)
+_last_used: Dict[str, float] = {}
+_last_used_lock = threading.Lock()
+
+
+def _split(name: str) -> Optional[Tuple[str, bool, str]]:
+    """story_1_ab_sm.webp -> ("story_1_ab", True, "webp"); None if not an image asset."""
+    if not name.startswith("story_"):
+        return None
+    base, _, ext = name.rpartition(".")
+    if ext not in MIME_TYPES:
+        return None
+    for suffix in _VARIANT_SUFFIXES:
+        if base.endswith(suffix) and ext == "webp":
+            return base[: -len(suffix)], True, ext
+    return base, False, ext
+
+
+def _story_id(stem: str) -> Optional[int]:
+    try:
+        return int(stem.split("_")[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _files(stem: str, ext: str) -> List[Path]:
+    return [IMAGE_DIR / f"{stem}.{ext}", IMAGE_DIR / f"{stem}_lg.webp", IMAGE_DIR / f"{stem}_sm.webp"]
+
+
+def urls(image: Dict[str, Any]) -> Dict[str, Any]:
+    stem = image["stem"]
+    return {
+        "image_url": f"{IMAGE_URL_PREFIX}/{stem}.{image['ext']}",
+        "webp_url": f"{IMAGE_URL_PREFIX}/{stem}_lg.webp",
+        "thumb_url": f"{IMAGE_URL_PREFIX}/{stem}_sm.webp",
+    }
+
+
+def public(image: Dict[str, Any]) -> Dict[str, Any]:
+    """API shape of one images row."""
+    return {
+        "id": image["id"],
+        **urls(image),
+        "width": image["width"],
+        "height": image["height"],
+        "aspect_ratio": image["aspect_ratio"],
+        "size_bytes": image["size_bytes"],
+        "created_at": image["created_at"],
+    }
+
+
+def _write_atomic(path: Path, data: bytes):
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _webp(img: "Image.Image", max_side: Optional[int] = None) -> bytes:
+    from PIL import Image
+    if max_side is not None:
+        img = img.copy()
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="WEBP", quality=WEBP_QUALITY, method=4)
+    return buf.getvalue()
+
+
+def _write_variants(stem: str, data: bytes) -> Tuple[int, int, int]:
+    """Write the _lg/_sm WebP variants; returns (width, height, bytes written)."""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        width, height = img.size
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        large, thumb = _webp(img), _webp(img, THUMB_SIZE)
+    _write_atomic(IMAGE_DIR / f"{stem}_lg.webp", large)
+    _write_atomic(IMAGE_DIR / f"{stem}_sm.webp", thumb)
+    return width, height, len(large) + len(thumb)
+
+
+def save_generated(story_id: int, data: bytes, mime_type: str, aspect_ratio: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Write a model image as-is plus its WebP and thumbnail variants, and
+    index it in the images table. CPU bound (encode WebP) -> call from a worker thread.
+    """
+    ext = EXTENSIONS[mime_type]
+    stem = f"story_{story_id}_{hashlib.sha256(data).hexdigest()[:16]}"
+    IMAGE_DIR.mkdir(parents=True, exist_ok=True)
+
+    _write_atomic(IMAGE_DIR / f"{stem}.{ext}", data)
+    width, height, variant_bytes = _write_variants(stem, data)
+    image = storage.add_image(
+        story_id, stem, ext, mime_type, len(data) + variant_bytes, width, height, aspect_ratio
+    )
+    return public(image)
+
+
+def latest_for_stories(story_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Newest image of each story, as {story_id: {image_url, webp_url, thumb_url, width, ...}}."""
+    return {sid: public(img) for sid, img in storage.latest_images(story_ids).items()}
+
+
+def list_for_story(story_id: int) -> List[Dict[str, Any]]:
+    return [public(img) for img in storage.list_images(story_id)]
+
+
+def note_access(name: str):
+    """Called for every served file; feeds LRU eviction."""
+    parts = _split(name)
+    if parts is None:
+        return
+    with _last_used_lock:
+        _last_used[parts[0]] = time.time()
+
+
+def _flush_access():
+    global _last_used
+    with _last_used_lock:
+        pending, _last_used = _last_used, {}
+    storage.touch_images(pending)
+
+
+def _unlink(paths: Iterable[Path]):
+    for path in paths:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _adopt(stem: str, ext: str, story_id: int) -> bool:
+    """Index an image written before the images table existed (สร้าง variant ให้ด้วย)."""
+    from PIL import Image
+    original = IMAGE_DIR / f"{stem}.{ext}"
+    try:
+        created = original.stat().st_mtime
+        data = original.read_bytes()
+        width, height, variant_bytes = _write_variants(stem, data)
+    except (OSError, Image.UnidentifiedImageError):
+        return False
+    storage.add_image(
+        story_id, stem, ext, MIME_TYPES[ext], len(data) + variant_bytes, width, height, None, created=created
+    )
+    return True
+
+
+def gc() -> Dict[str, int]:
+    """
+    One GC pass over IMAGE_DIR:
+    - rows whose files are gone are dropped
+    - files of deleted stories (no row) are deleted; older files of live
+      stories without a row are indexed instead
+    - least recently used images are evicted until under IMAGE_QUOTA_BYTES
+    """
+    _flush_access()
+    stats = {"missing": 0, "orphans": 0, "adopted": 0, "evicted": 0, "bytes": 0}
+    now = time.time()
+
+    # อ่านแถวก่อน scan: ภาพที่เพิ่งถูกเขียนระหว่างนี้ยังอยู่ใน grace period
+    rows = storage.image_usage()
+    indexed = {r["stem"] for r in rows}
+
+    # stem -> (ext ของต้นฉบับ, [(path, mtime)])
+    on_disk: Dict[str, Tuple[Optional[str], List[Tuple[Path, float]]]] = {}
+    try:
+        entries = os.scandir(IMAGE_DIR)
+    except FileNotFoundError:
+        return stats
+    with entries:
+        for entry in entries:
+            parts = _split(entry.name)
+            if parts is None or not entry.is_file():
+                continue
+            stem, is_variant, ext = parts
+            orig_ext, files = on_disk.get(stem, (None, []))
+            files.append((Path(entry.path), entry.stat().st_mtime))
+            on_disk[stem] = (orig_ext if is_variant else ext, files)
+
+    missing = [r for r in rows if on_disk.get(r["stem"], (None,))[0] is None]
+    storage.delete_images(r["id"] for r in missing)
+    stats["missing"] = len(missing)
+
+    unindexed = {
+        stem: v for stem, v in on_disk.items()
+        if stem not in indexed and all(now - mtime > IMAGE_GC_GRACE for _, mtime in v[1])
+    }
+    alive = storage.existing_story_ids({_story_id(s) for s in unindexed} - {None})
+    for stem, (ext, files) in unindexed.items():
+        story_id = _story_id(stem)
+        if story_id in alive and ext is not None and _adopt(stem, ext, story_id):
+            stats["adopted"] += 1
+        else:
+            _unlink(path for path, _ in files)
+            stats["orphans"] += 1
+
+    # LRU: image_usage เรียงจากใช้ล่าสุดนานที่สุด
+    rows = storage.image_usage()
+    total = sum(r["size_bytes"] for r in rows)
+    evicted = []
+    for r in rows:
+        if total <= IMAGE_QUOTA_BYTES:
+            break
+        _unlink(_files(r["stem"], r["ext"]))
+        evicted.append(r["id"])
+        total -= r["size_bytes"]
+    storage.delete_images(evicted)
+    stats["evicted"] = len(evicted)
+    stats["bytes"] = total
+    return stats
+
+
+async def gc_loop(interval: float = IMAGE_GC_INTERVAL):
+    """Run gc() in a worker thread every `interval` seconds until cancelled."""
+    while True:
+        try:
+            stats = await asyncio.to_thread(gc)
+            if stats["orphans"] or stats["evicted"] or stats["missing"]:
+                log.info("image gc: %s", stats)
+        except Exception:
+            log.exception("image gc failed")
+        await asyncio.sleep(interval)
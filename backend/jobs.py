@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import metrics
+import storage
+
+# ---------------------------
+# Config (env)
+# ---------------------------
+# JOB_WORKERS: จำนวน job ที่รันพร้อมกันสูงสุด (ต่อ process)
+# JOB_HEARTBEAT_SECONDS: ทุกๆเท่านี้ process ต่อ heartbeat ให้ job ที่ตัวเองรันอยู่ และ sweep job ที่ค้าง
+# JOB_STALE_SECONDS: job running ของ process อื่นที่ไม่มี heartbeat นานเกินนี้ ถือว่า process นั้นตายไปแล้ว
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "60"))
+
+# id ของ process นี้ (ต่างกันทุกครั้งที่ start) -> owner ของ job ที่ claim ไป
+BOOT_ID = uuid.uuid4().hex
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+
+class JobQueue:
+    """
+    Durable background jobs: state lives in the jobs table, this process
+    only keeps an asyncio.Queue of ids and JOB_WORKERS worker tasks.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._handlers: Dict[str, Handler] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.counters: Dict[str, int] = {"submitted": 0, "deduped": 0, "done": 0, "error": 0}
+
+    def handler(self, kind: str):
+        """Decorator: register the coroutine that runs jobs of this kind."""
+        def register(fn: Handler) -> Handler:
+            self._handlers[kind] = fn
+            return fn
+        return register
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep_loop()))
+
+    async def recover(self):
+        """
+        Requeue jobs left running by a dead process and enqueue every queued
+        job (server restart). Jobs of a crashed process that still look alive
+        are picked up by the periodic sweep once their heartbeat goes stale.
+        """
+        await self.sweep()
+        for job_id in await asyncio.to_thread(storage.queued_job_ids):
+            self._enqueue(job_id)
+
+    async def sweep(self):
+        """Heartbeat our running jobs, requeue stale ones of other processes."""
+        await asyncio.to_thread(storage.heartbeat_jobs, BOOT_ID)
+        stale_before = time.time() - JOB_STALE_SECONDS
+        for job_id in await asyncio.to_thread(storage.requeue_stale_jobs, BOOT_ID, stale_before):
+            log.warning("requeued stale job %s", job_id)
+            self._enqueue(job_id)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                await self.sweep()
+            except Exception:
+                log.exception("job sweep failed")
+
+    def _enqueue(self, job_id: str):
+        if self._queue is not None:
+            self._queue.put_nowait(job_id)
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def submit(self, kind: str, dedupe_key: str, payload: Dict[str, Any], story_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Persist and enqueue a job. If an identical job (same dedupe_key) is
+        still queued/running, that job is returned instead of a new one.
+        """
+        if kind not in self._handlers:
+            raise KeyError(f"unknown job kind: {kind}")
+
+        job_id = uuid.uuid4().hex
+        job = await asyncio.to_thread(storage.create_job, job_id, kind, story_id, f"{kind}:{dedupe_key}", payload)
+        if job["id"] != job_id:
+            self.counters["deduped"] += 1
+            return job
+
+        self.counters["submitted"] += 1
+        self._enqueue(job_id)
+        return job
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        # storage เป็น sqlite แบบ sync -> เรียกใน thread ไม่ให้ block event loop
+        if not await asyncio.to_thread(storage.claim_job, job_id, BOOT_ID):
+            return  # worker/process อื่นเอาไปแล้ว
+        job = await asyncio.to_thread(storage.get_job, job_id)
+        if job is None:
+            return  # story ถูกลบ -> job หายไปด้วย (cascade)
+
+        try:
+            with metrics.job_context(f"job:{job['kind']}"):
+                result = await self._handlers[job["kind"]](job["payload"])
+        except asyncio.CancelledError:
+            # shutdown: คืนกลับเป็น queued ให้รอบหน้าทำต่อ
+            await asyncio.to_thread(storage.release_job, job_id)
+            raise
+        except Exception as e:
+            await asyncio.to_thread(storage.finish_job, job_id, error=f"{type(e).__name__}: {e}")
+            self.counters["error"] += 1
+            return
+        await asyncio.to_thread(storage.finish_job, job_id, result=result)
+        self.counters["done"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            **self.counters,
+        }
+
+
+job_queue = JobQueue(JOB_WORKERS)
@@ -0,0 +1,289 @@
+import contextvars
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Sequence, Tuple
+
+# ---------------------------
+# Prometheus-style metrics (text exposition format, ไม่ต้องพึ่ง prometheus_client)
+# ---------------------------
+# ค่าทั้งหมดอยู่ใน memory ของ process นี้ (PDF ที่ render ใน process pool วัดจากฝั่ง server)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+
+_registry: List["_Metric"] = []
+_lock = threading.Lock()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        head = f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+        return head + "".join(line + "\n" for line in self._samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        with _lock:
+            items = sorted(self._values.items())
+        for key, v in items:
+            yield f"{self.name}{_labels(self.labelnames, key)} {_num(v)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = FAST_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # key -> [count ต่อ bucket (ไม่สะสม)..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = next(i for i, b in enumerate(self.buckets) if value <= b)
+        with _lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def _samples(self) -> Iterator[str]:
+        with _lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, row in items:
+            cumulative = 0
+            for b, n in zip(self.buckets, row):
+                cumulative += n
+                le = 'le="%s"' % _num(b)
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {row[-2]!r}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {row[-1]}"
+
+
+def render() -> str:
+    """Every registered metric in Prometheus text format (GET /metrics)."""
+    return "".join(m.render() for m in _registry)
+
+
+# ---------------------------
+# Metric definitions
+# ---------------------------
+HTTP_SECONDS = Histogram(
+    "http_request_seconds", "HTTP request latency (until the response body is sent).",
+    ("method", "endpoint", "status"), SLOW_BUCKETS,
+)
+GEMINI_SECONDS = Histogram(
+    "gemini_request_seconds", "One upstream Gemini call (each 429 retry counts as its own call).",
+    ("model", "endpoint", "method", "outcome"), SLOW_BUCKETS,
+)
+GEMINI_TOKENS = Counter(
+    "gemini_tokens_total", "Tokens reported by Gemini usage_metadata.",
+    ("model", "endpoint", "type"),
+)
+GEMINI_RATE_LIMITED = Counter(
+    "gemini_rate_limited_total", "Gemini 429 responses, by what happened next (retry / give_up).",
+    ("model", "action"),
+)
+STORAGE_SECONDS = Histogram("storage_seconds", "storage.py function latency.", ("fn",), FAST_BUCKETS)
+PROMPT_SECONDS = Histogram("prompt_build_seconds", "Prompt building latency.", ("fn",), FAST_BUCKETS)
+PDF_SECONDS = Histogram("pdf_render_seconds", "PDF layout / render latency.", ("fn",), SLOW_BUCKETS)
+
+# field ของ usage_metadata -> label type
+_USAGE_FIELDS = (
+    ("prompt_token_count", "prompt"),
+    ("candidates_token_count", "output"),
+    ("thoughts_token_count", "thoughts"),
+    ("cached_content_token_count", "cached"),
+    ("total_token_count", "total"),
+)
+
+
+# ---------------------------
+# Per-request stage timing (Server-Timing header)
+# ---------------------------
+class RequestTiming:
+    """Stage totals of one HTTP request (or one background job)."""
+
+    def __init__(self, scope: Optional[Dict[str, Any]] = None, label: Optional[str] = None):
+        self.scope = scope
+        self.label = label
+        self.started = time.perf_counter()
+        self.stages: Dict[str, List[float]] = {}  # name -> [seconds, calls]
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            row = self.stages.setdefault(stage, [0.0, 0])
+            row[0] += seconds
+            row[1] += 1
+
+    def endpoint(self) -> str:
+        if self.label:
+            return self.label
+        route = (self.scope or {}).get("route")
+        if route is not None:
+            return route.path
+        # mount (static files) ไม่มี route -> ใช้ prefix ของ mount
+        return (self.scope or {}).get("root_path") or "other"
+
+    def header(self) -> str:
+        with self._lock:
+            stages = sorted(self.stages.items())
+        parts = [f'{name};desc="{int(n)} call(s)";dur={s * 1000:.1f}' for name, (s, n) in stages]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: contextvars.ContextVar[Optional[RequestTiming]] = contextvars.ContextVar("metrics_request", default=None)
+# stage ที่กำลังวัดอยู่ใน call stack นี้ -> call ซ้อน (เช่น storage เรียก storage) ไม่ถูกนับซ้ำ
+_active: contextvars.ContextVar[FrozenSet[str]] = contextvars.ContextVar("metrics_active", default=frozenset())
+
+
+def endpoint() -> str:
+    rt = _current.get()
+    return rt.endpoint() if rt is not None else "-"
+
+
+def add_stage(stage: str, seconds: float):
+    rt = _current.get()
+    if rt is not None:
+        rt.add(stage, seconds)
+
+
+@contextmanager
+def stage(name: str, histogram: Optional[Histogram] = None, **labels):
+    """Time a block into the request's Server-Timing stage (and optionally a histogram)."""
+    active = _active.get()
+    token = _active.set(active | {name})
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        _active.reset(token)
+        if histogram is not None:
+            histogram.observe(seconds, **labels)
+        if name not in active:
+            add_stage(name, seconds)
+
+
+def timed(stage_name: str, histogram: Histogram) -> Callable:
+    """Decorator: stage() around a sync function, labelled fn=<name>."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with stage(stage_name, histogram, fn=fn.__name__):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+@contextmanager
+def job_context(label: str):
+    """Attribute metrics recorded inside a background job to `label`."""
+    token = _current.set(RequestTiming(label=label))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+# ---------------------------
+# Gemini
+# ---------------------------
+def observe_gemini(model: str, method: str, seconds: float, outcome: str, resp: Any = None):
+    ep = endpoint()
+    GEMINI_SECONDS.observe(seconds, model=model, endpoint=ep, method=method, outcome=outcome)
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is not None:
+        for field, kind in _USAGE_FIELDS:
+            n = getattr(usage, field, None)
+            if n:
+                GEMINI_TOKENS.inc(n, model=model, endpoint=ep, type=kind)
+
+
+# ---------------------------
+# ASGI middleware
+# ---------------------------
+class ServerTimingMiddleware:
+    """
+    Per-request stage breakdown as a Server-Timing header (devtools > Timing)
+    plus http_request_seconds. Streaming responses send headers first, so
+    their header only covers the stages before the stream started.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        rt = RequestTiming(scope)
+        token = _current.set(rt)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", rt.header().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            HTTP_SECONDS.observe(
+                time.perf_counter() - rt.started, method=scope["method"], endpoint=rt.endpoint(), status=status
+            )
@@ -1,12 +1,14 @@
 from io import BytesIO
 from pathlib import Path
-from typing import List
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Tuple
 
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
+import metrics
+
 
 # ---------------------------
 # Font setup (Thai)
@@ -41,59 +43,136 @@ def _ensure_fonts():
 # ---------------------------
 # Wrapping helpers
 # ---------------------------
+# สระบน/ล่าง, ไม้ยมก ฯลฯ (combining) -> ต้องติดกับพยัญชนะข้างหน้าเสมอ
+_THAI_COMBINING = frozenset(chr(c) for c in (0x0E31, *range(0x0E34, 0x0E3B), *range(0x0E47, 0x0E4F)))
+# สระตามหลัง / เครื่องหมายที่ห้ามขึ้นต้นบรรทัด: ะ า ำ ๅ ๆ ฯ
+_THAI_NO_BREAK_BEFORE = frozenset("\u0E30\u0E32\u0E33\u0E45\u0E46\u0E2F")
+# สระหน้า เ แ โ ใ ไ -> ห้ามตัดหลังตัวมัน
+_THAI_NO_BREAK_AFTER = frozenset(chr(c) for c in range(0x0E40, 0x0E45))
+
+_ADVANCES: Dict[str, Tuple[Dict[int, float], float]] = {}
+
+
+def _is_thai(ch: str) -> bool:
+    return "\u0E00" <= ch <= "\u0E7F"
+
+
+def _advances(font_name: str) -> Tuple[Dict[int, float], float]:
+    """Per-glyph advance widths (1/1000 em) read once from the registered TTF."""
+    adv = _ADVANCES.get(font_name)
+    if adv is None:
+        face = pdfmetrics.getFont(font_name).face
+        adv = _ADVANCES[font_name] = (face.charWidths, face.defaultWidth)
+    return adv
+
+
+# ตัวสะกดสระประสมที่ต้องอยู่กับพยางค์ก่อนหน้า: -ือ, -ีย, -ัว, -ัย
+_THAI_VOWEL_TAILS = {"\u0E2D": "\u0E37", "\u0E22": "\u0E35\u0E31", "\u0E27": "\u0E31"}
+_THAI_THANTHAKHAT = "\u0E4C"  # ์ (การันต์) -> พยัญชนะนั้นเป็นของพยางค์ก่อนหน้า
+
+
+def _can_break_before(text: str, i: int) -> bool:
+    """
+    Line-break opportunity between text[i-1] and text[i]: after spaces, or
+    between Thai character clusters (a simplified TCC segmentation).
+    """
+    prev, ch = text[i - 1], text[i]
+    if prev == " ":
+        return ch != " "
+    if not (_is_thai(prev) and _is_thai(ch)):
+        return False
+    if ch in _THAI_COMBINING or ch in _THAI_NO_BREAK_BEFORE or prev in _THAI_NO_BREAK_AFTER:
+        return False
+
+    # อ/ย/ว ที่ต่อจากสระ ื ี ั (ชื่อ, เรียน, ตัว)
+    tail_vowels = _THAI_VOWEL_TAILS.get(ch)
+    if tail_vowels:
+        j = i - 1
+        while j >= 0 and text[j] in _THAI_COMBINING:
+            if text[j] in tail_vowels:
+                return False
+            j -= 1
+
+    # พยัญชนะที่มีการันต์ (จันทร์, ศักดิ์)
+    j = i + 1
+    while j < len(text) and text[j] in _THAI_COMBINING:
+        if text[j] == _THAI_THANTHAKHAT:
+            return False
+        j += 1
+    return True
+
+
 def _wrap_line(c: canvas.Canvas, text: str, font_name: str, font_size: int, max_width: float) -> List[str]:
     """
     Wrap 1 line to multiple lines.
-    - If has spaces -> wrap by words
-    - If no spaces (Thai) -> wrap by characters
+    - Break at spaces or between Thai character clusters (never inside a
+      cluster, so tone marks / vowels stay with their consonant)
+    - Latin words are only broken if a single word is wider than max_width
+    Widths come from cumulative sums of glyph advances (no re-measuring).
     """
     text = (text or "").rstrip()
     if not text:
         return [""]
 
-    # ถ้ามีช่องว่าง ใช้ word wrap
-    if " " in text:
-        words = text.split(" ")
-        lines = []
-        cur = ""
-        for w in words:
-            test = (cur + " " + w).strip()
-            if c.stringWidth(test, font_name, font_size) <= max_width:
-                cur = test
-            else:
-                if cur:
-                    lines.append(cur)
-                # ถ้าคำยาวเกิน max_width ให้ตัดเป็นตัวอักษร
-                if c.stringWidth(w, font_name, font_size) > max_width:
-                    lines.extend(_wrap_line(c, w, font_name, font_size, max_width))
-                    cur = ""
-                else:
-                    cur = w
-        if cur:
-            lines.append(cur)
-        return lines
-
-    # ไม่มีช่องว่าง (ไทย) -> ตัดตามตัวอักษร
-    lines = []
-    cur = ""
-    for ch in text:
-        test = cur + ch
-        if c.stringWidth(test, font_name, font_size) <= max_width:
-            cur = test
-        else:
-            if cur:
-                lines.append(cur)
-            cur = ch
-    if cur:
-        lines.append(cur)
-    return lines
+    widths, default = _advances(font_name)
+    scale = 0.001 * font_size
+    limit = max_width / scale  # เทียบใน font units
 
-
-def text_to_pdf_bytes(title: str, text: str) -> bytes:
+    lines = []
+    start = 0          # ต้นบรรทัดปัจจุบัน
+    width = 0.0        # ความกว้าง text[start:i]
+    last_break = -1    # ตำแหน่งตัดได้ล่าสุดในบรรทัดนี้
+    break_width = 0.0  # ความกว้าง text[start:last_break]
+    n = len(text)
+    i = 0
+    while i < n:
+        ch = text[i]
+        if i > start and _can_break_before(text, i):
+            last_break, break_width = i, width
+
+        w = widths.get(ord(ch), default)
+        if width + w > limit and ch != " " and i > start:
+            if last_break > start:
+                cut = last_break
+                width -= break_width
+            else:
+                # ไม่มีจุดตัด (คำยาวเกินบรรทัด) -> ตัดตรงนี้ แต่ไม่แยก combining mark
+                cut = i
+                while cut > start + 1 and text[cut] in _THAI_COMBINING:
+                    cut -= 1
+                width = sum(widths.get(ord(x), default) for x in text[cut:i])
+            lines.append(text[start:cut].rstrip())
+            # ช่องว่างต้นบรรทัดใหม่ไม่นับ
+            while cut < i and text[cut] == " ":
+                width -= widths.get(ord(" "), default)
+                cut += 1
+            start, last_break = cut, -1
+            continue  # วัด ch เดิมอีกครั้งกับบรรทัดใหม่
+
+        width += w
+        i += 1
+        if start == i - 1 and ch == " ":
+            start, width = i, 0.0
+
+    if start < n:
+        lines.append(text[start:].rstrip())
+    return lines or [""]
+
+
+def _lines(chunks: Iterable[str]) -> Iterator[str]:
+    for chunk in chunks:
+        yield from chunk.split("\n")
+
+
+@metrics.timed("pdf", metrics.PDF_SECONDS)
+def write_pdf(fileobj: BinaryIO, title: str, chunks: Iterable[str]):
+    """
+    Render into a binary file object. chunks is consumed lazily (joined with
+    "\n"), so a long story never has to exist as one big string.
+    """
     _ensure_fonts()
 
-    buf = BytesIO()
-    c = canvas.Canvas(buf, pagesize=A4)
+    c = canvas.Canvas(fileobj, pagesize=A4, pageCompression=1)
     width, height = A4
 
     margin_x = 40
@@ -119,7 +198,7 @@ def text_to_pdf_bytes(title: str, text: str) -> bytes:
     # Body
     c.setFont("NotoThai", 11)
 
-    for paragraph in (text or "").split("\n"):
+    for paragraph in _lines(chunks):
         line = paragraph.rstrip()
 
         # empty line
@@ -141,4 +220,10 @@ def text_to_pdf_bytes(title: str, text: str) -> bytes:
                 c.setFont("NotoThai", 11)
 
     c.save()
+
+
+@metrics.timed("pdf", metrics.PDF_SECONDS)
+def text_to_pdf_bytes(title: str, text: str) -> bytes:
+    buf = BytesIO()
+    write_pdf(buf, title, [text or ""])
     return buf.getvalue()
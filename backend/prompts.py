@@ -67,3 +67,11 @@ No text in the image. Describe characters, setting, lighting, mood, and composit
 Keep it consistent with the story options.
 Output only the prompt, no extra commentary.
 """
+
+SUMMARY_RULES = """You keep a running summary of a Thai story so a writer can continue it later.
+Merge the new chapter into the summary so far.
+Write in Thai. Keep every named character, their goals and relationships,
+unresolved conflicts, promises/foreshadowing, and where the story currently stands.
+Drop scene-level detail that no longer matters. Keep it under 250 words.
+Output only the updated summary, no headings or extra commentary.
+"""
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# ---------------------------
+# Config (env)
+# ---------------------------
+# RATE_LIMITS: "model=requests_per_sec:burst,..." (ทับค่า default ที่ app ตั้งให้แต่ละ model)
+# RATE_LIMIT_DEFAULT: ใช้กับ model ที่ไม่ได้ตั้งค่าไว้
+# RATE_LIMIT_MAX_WAIT: รอคิวได้นานสุดกี่วินาที เกินกว่านั้นตอบ 429 ทันที
+# RATE_LIMIT_RETRIES: retry กี่ครั้งเมื่อ Gemini ตอบ 429
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+RATE_LIMIT_DEFAULT = os.getenv("RATE_LIMIT_DEFAULT", "2:10")
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+RATE_LIMIT_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "4"))
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+
+class RateLimited(Exception):
+    """Upstream quota exhausted (after retries) or the wait queue is too long."""
+
+    def __init__(self, model: str, retry_after: float):
+        super().__init__(f"429 rate limited on {model}, retry after {retry_after:.1f}s")
+        self.model = model
+        self.retry_after = retry_after
+
+
+def _parse(spec: str) -> Tuple[float, int]:
+    rate, _, burst = spec.partition(":")
+    return float(rate), int(burst or 1)
+
+
+class TokenBucket:
+    """
+    Token bucket in GCRA form: each acquire reserves the next free slot, so
+    waiters are served strictly in arrival order (fair queue) and nobody
+    polls. penalize() pauses the whole bucket after an upstream 429.
+    """
+
+    def __init__(self, model: str, rate: float, burst: int):
+        self.model = model
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._interval = 1.0 / rate
+        self._tolerance = (self.burst - 1) * self._interval
+        self._tat = 0.0  # theoretical arrival time ของ slot ถัดไป
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.counters: Dict[str, int] = {"acquired": 0, "delayed": 0, "rejected": 0, "throttled": 0, "retries": 0}
+        self.wait_seconds = 0.0
+
+    def reserve(self, max_wait: float) -> float:
+        """Book a slot and return how long to wait for it; RateLimited if longer than max_wait."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._tat - self._tolerance, self._paused_until)
+            wait = start - now
+            if wait > max_wait:
+                self.counters["rejected"] += 1
+                raise RateLimited(self.model, wait)
+            self._tat = max(self._tat, start) + self._interval
+            self.counters["acquired"] += 1
+            if wait > 0:
+                self.counters["delayed"] += 1
+                self.wait_seconds += wait
+            return wait
+
+    def _refund(self):
+        # waiter ถูก cancel ก่อนถึงคิว -> คืน slot
+        with self._lock:
+            self._tat -= self._interval
+
+    async def acquire(self, max_wait: float = RATE_LIMIT_MAX_WAIT):
+        wait = self.reserve(max_wait)
+        if wait <= 0:
+            return
+        self.waiting += 1
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            self._refund()
+            raise
+        finally:
+            self.waiting -= 1
+
+    def acquire_blocking(self, max_wait: float = RATE_LIMIT_MAX_WAIT):
+        """Sync callers (worker threads)."""
+        wait = self.reserve(max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    def penalize(self, delay: float):
+        """Upstream said 429: nobody on this model goes out for `delay` seconds."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self.counters["throttled"] += 1
+
+    def stats(self) -> Dict[str, object]:
+        now = time.monotonic()
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "waiting": self.waiting,
+            "queue_delay": round(max(0.0, self._tat - self._tolerance - now, self._paused_until - now), 3),
+            "paused_for": round(max(0.0, self._paused_until - now), 3),
+            "wait_seconds": round(self.wait_seconds, 3),
+            **self.counters,
+        }
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Delay before retry number `attempt` (0-based): the server's hint when
+    given, else exponential backoff; jitter so callers don't retry in lockstep.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, BACKOFF_BASE)
+    d = min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt))
+    return d / 2 + random.uniform(0, d / 2)
+
+
+# ---------------------------
+# Per-model registry
+# ---------------------------
+_buckets: Dict[str, TokenBucket] = {}
+_specs: Dict[str, str] = {}
+_registry_lock = threading.Lock()
+
+
+def _env_specs() -> Dict[str, str]:
+    out = {}
+    for item in RATE_LIMITS.split(","):
+        model, _, spec = item.strip().partition("=")
+        if model and spec:
+            out[model.strip()] = spec.strip()
+    return out
+
+
+def configure(defaults: Dict[str, str]):
+    """Default "rate:burst" per model; RATE_LIMITS in the environment wins."""
+    with _registry_lock:
+        _specs.update({**defaults, **_env_specs()})
+        for model in list(_buckets):
+            if model in _specs:
+                del _buckets[model]
+
+
+def limiter_for(model: str) -> TokenBucket:
+    bucket = _buckets.get(model)
+    if bucket is not None:
+        return bucket
+    with _registry_lock:
+        if model not in _buckets:
+            spec = _specs.get(model) or _env_specs().get(model) or RATE_LIMIT_DEFAULT
+            _buckets[model] = TokenBucket(model, *_parse(spec))
+        return _buckets[model]
+
+
+def stats() -> Dict[str, object]:
+    return {
+        "max_wait": RATE_LIMIT_MAX_WAIT,
+        "retries": RATE_LIMIT_RETRIES,
+        "models": {model: b.stats() for model, b in sorted(_buckets.items())},
+    }
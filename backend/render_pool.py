@@ -0,0 +1,197 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Optional
+
+import metrics
+import storage
+
+# pdf_utils (reportlab) import เฉพาะตอน render -> server ไม่ต้องโหลดตอน start
+
+# ---------------------------
+# Config (env)
+# ---------------------------
+# PDF_WORKERS=0 -> render ใน thread ของ process นี้ (ไม่ใช้ process pool)
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_QUEUE_LIMIT = int(os.getenv("PDF_QUEUE_LIMIT", str(max(1, PDF_WORKERS) * 4)))
+PDF_TIMEOUT = float(os.getenv("PDF_TIMEOUT", "60"))
+
+
+class RenderBusy(Exception):
+    """Too many PDF jobs queued; caller should answer 503."""
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+# job ที่รัน/รอคิวอยู่ (ทั้ง request และ bulk export) - แก้ได้เฉพาะตอนถือ _slots
+_in_flight = 0
+_slots = threading.Condition()
+
+
+# ---------------------------
+# Worker side
+# ---------------------------
+def _init_worker(db_path: str):
+    import pdf_utils
+    storage.DB_PATH = db_path
+    # ลงทะเบียน font ครั้งเดียวตอน worker เริ่ม แทนที่จะรอ request แรก
+    pdf_utils._ensure_fonts()
+
+
+def _ready() -> bool:
+    return True
+
+
+def _render_story_pdf(story_id: int, out_path: str):
+    import pdf_utils
+    story = storage.get_story(story_id)
+    if story is None:
+        raise LookupError(f"story {story_id} not found")
+    chunks = storage.story_markdown_chunks(story, storage.iter_chapters(story_id))
+    with open(out_path, "wb") as f:
+        pdf_utils.write_pdf(f, story["title"], chunks)
+
+
+# ---------------------------
+# Server side
+# ---------------------------
+def get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if PDF_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # spawn: ไม่ fork thread / sqlite connection ของ server ติดไปด้วย
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(storage.DB_PATH,),
+            )
+        return _pool
+
+
+async def warmup():
+    """
+    Start the worker processes (and register the Thai fonts in them) before
+    the first PDF request; with PDF_WORKERS=0 register them in this process.
+    """
+    pool = get_pool()
+    if pool is None:
+        import pdf_utils
+        await asyncio.to_thread(pdf_utils._ensure_fonts)
+        return
+    # spawn pool สร้าง worker ตาม job ที่ค้าง (ไม่มีตัวว่าง -> spawn ใหม่) -> ส่งงานเปล่าให้ครบทุกตัว
+    # initializer (font) รันก่อน job แรกของแต่ละ worker
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*[loop.run_in_executor(pool, _ready) for _ in range(PDF_WORKERS)])
+    except BrokenProcessPool:
+        shutdown()  # request ถัดไปสร้าง pool ใหม่ แทนที่จะเจอ pool ที่พังค้างไว้
+        raise
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def stats():
+    return {
+        "workers": PDF_WORKERS,
+        "queue_limit": PDF_QUEUE_LIMIT,
+        "timeout": PDF_TIMEOUT,
+        "in_flight": _in_flight,
+    }
+
+
+def _discard_when_done(fut, path: Path):
+    # job ที่ timeout ยังเขียนไฟล์ต่อใน worker -> ลบทิ้งเมื่อเสร็จ
+    def cleanup(_):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    fut.add_done_callback(cleanup)
+
+
+def _acquire(wait: Optional[float] = None):
+    """
+    Take a queue slot. wait=None -> RenderBusy right away when full,
+    otherwise wait up to `wait` seconds for a slot before raising it.
+    """
+    global _in_flight
+    with _slots:
+        if wait is not None:
+            _slots.wait_for(lambda: _in_flight < PDF_QUEUE_LIMIT, wait)
+        if _in_flight >= PDF_QUEUE_LIMIT:
+            raise RenderBusy()
+        _in_flight += 1
+
+
+def _release(_=None):
+    global _in_flight
+    with _slots:
+        _in_flight -= 1
+        _slots.notify()
+
+
+async def render_story_pdf(story_id: int, out_path: Path):
+    """
+    Render a story's PDF into out_path off the event loop.
+    Raises RenderBusy when PDF_QUEUE_LIMIT jobs are already running/queued
+    and asyncio.TimeoutError after PDF_TIMEOUT seconds.
+    """
+    _acquire()
+    loop = asyncio.get_running_loop()
+    try:
+        fut = loop.run_in_executor(get_pool(), _render_story_pdf, story_id, str(out_path))
+    except BaseException:
+        _release()
+        raise
+    # นับจนกว่า job จะจบจริง (แม้ request จะ timeout ไปแล้ว worker ก็ยังไม่ว่าง)
+    fut.add_done_callback(_release)
+
+    try:
+        # วัดฝั่ง server (รวมเวลารอคิวของ pool) - metric ใน worker process ไม่ถูกส่งกลับมา
+        with metrics.stage("pdf", metrics.PDF_SECONDS, fn="render_story_pdf"):
+            await asyncio.wait_for(asyncio.shield(fut), PDF_TIMEOUT)
+    except asyncio.TimeoutError:
+        _discard_when_done(fut, out_path)
+        raise
+
+
+@metrics.timed("pdf", metrics.PDF_SECONDS)
+def render_story_pdf_blocking(story_id: int, out_path: Path):
+    """
+    render_story_pdf() for code already running in a worker thread (เช่น
+    bulk export). Waits up to PDF_TIMEOUT for a queue slot, then raises RenderBusy.
+    """
+    _acquire(wait=PDF_TIMEOUT)
+    pool = get_pool()
+    if pool is None:
+        try:
+            _render_story_pdf(story_id, str(out_path))
+        finally:
+            _release()
+        return
+
+    try:
+        fut = pool.submit(_render_story_pdf, story_id, str(out_path))
+    except BaseException:
+        _release()
+        raise
+    fut.add_done_callback(_release)
+    try:
+        fut.result(timeout=PDF_TIMEOUT)
+    except TimeoutError:
+        _discard_when_done(fut, out_path)
+        raise
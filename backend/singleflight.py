@@ -0,0 +1,80 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+def call_key(model: str, prompt: str, config: Any = None) -> str:
+    """Identity of one upstream call: (model, prompt, config)."""
+    h = hashlib.sha256()
+    h.update(model.encode("utf-8"))
+    h.update(b"\0")
+    h.update(prompt.encode("utf-8"))
+    if config is not None:
+        h.update(b"\0")
+        dump = getattr(config, "model_dump_json", None)
+        h.update((dump(exclude_none=True) if dump else repr(config)).encode("utf-8"))
+    return h.hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesce identical concurrent calls: the first caller for a key runs
+    fn(), everyone who arrives while it is in flight gets the same result
+    (or exception). Nothing is remembered once the call finishes - that is
+    the response cache's job.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._futures: Dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {"calls": 0, "coalesced": 0}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        # task ผูกกับ event loop -> แยก key ตาม loop
+        k = (id(asyncio.get_running_loop()), key)
+        task = self._tasks.get(k)
+        if task is None:
+            self.counters["calls"] += 1
+            task = asyncio.ensure_future(fn())
+            self._tasks[k] = task
+            task.add_done_callback(lambda t: self._done(k, t))
+        else:
+            self.counters["coalesced"] += 1
+        # shield: caller ที่ถูก cancel (client ตัดการเชื่อมต่อ) ไม่ยกเลิก call ของคนอื่น
+        return await asyncio.shield(task)
+
+    def _done(self, k: Tuple[int, str], task: asyncio.Task):
+        if self._tasks.get(k) is task:
+            del self._tasks[k]
+        if not task.cancelled():
+            task.exception()  # caller ทุกคนอาจ cancel ไปแล้ว -> กัน warning "never retrieved"
+
+    def do_blocking(self, key: str, fn: Callable[[], T]) -> T:
+        """Same for sync callers in worker threads."""
+        with self._lock:
+            fut: Optional[concurrent.futures.Future] = self._futures.get(key)
+            leader = fut is None
+            if leader:
+                fut = concurrent.futures.Future()
+                self._futures[key] = fut
+                self.counters["calls"] += 1
+            else:
+                self.counters["coalesced"] += 1
+
+        if leader:
+            try:
+                fut.set_result(fn())
+            except BaseException as e:
+                fut.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._futures[key]
+        return fut.result()
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._tasks) + len(self._futures), **self.counters}
@@ -13,6 +13,10 @@ const statusEl = document.getElementById("status");
 const genOutlineBtn = document.getElementById("genOutline");
 const outlineEl = document.getElementById("outline");
 
+const previewWrap = document.getElementById("previewWrap");
+const previewTitle = document.getElementById("previewTitle");
+const preview = document.getElementById("preview");
+
 let isBusy = false;
 
 function addCharRow(name = "", traits = "") {
@@ -172,18 +176,32 @@ genBtn.addEventListener("click", async () => {
     idea: v("idea"),
   };
 
+  previewTitle.textContent = "";
+  preview.textContent = "";
+  previewWrap.classList.remove("hidden");
+
   try {
-    const res = await fetch("/api/generate", {
+    const res = await fetch("/api/generate/stream", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify(payload),
     });
-    const data = await res.json();
     if (!res.ok) {
+      const data = await res.json().catch(() => ({}));
       statusEl.textContent = data.error || `Error ${res.status}`;
       return;
     }
-    window.location.href = `/story/${data.story_id}`;
+
+    let storyId = null;
+    await readSSE(res, (event, data) => {
+      if (event === "delta") preview.textContent += data.text;
+      else if (event === "title") previewTitle.textContent = data.title;
+      else if (event === "status") statusEl.textContent = "Generating illustration prompt...";
+      else if (event === "error") statusEl.textContent = data.error || "Error";
+      else if (event === "done") storyId = data.story_id;
+    });
+
+    if (storyId !== null) window.location.href = `/story/${storyId}`;
   } catch (e) {
     statusEl.textContent = "เชื่อมต่อเซิร์ฟเวอร์ไม่ได้";
   } finally {
@@ -13,12 +13,26 @@ function card(item) {
   top.className = "flex items-start justify-between gap-3";
 
   const left = document.createElement("div");
-  left.innerHTML = `
+  left.className = "flex items-start gap-3";
+
+  if (item.thumb_url) {
+    const thumb = document.createElement("img");
+    thumb.src = item.thumb_url;
+    thumb.alt = "";
+    thumb.loading = "lazy";
+    thumb.decoding = "async";
+    thumb.className = "h-16 w-16 flex-none rounded-xl object-cover";
+    left.appendChild(thumb);
+  }
+
+  const info = document.createElement("div");
+  info.innerHTML = `
     <div class="text-sm font-semibold text-slate-900 dark:text-slate-100">${item.title}</div>
     <div class="mt-1 text-xs text-slate-500 dark:text-slate-400 whitespace-nowrap">
       ${fmtDate(item.created_at)}
     </div>
   `;
+  left.appendChild(info);
 
   const btns = document.createElement("div");
   btns.className = "flex items-center gap-2";
@@ -64,11 +78,40 @@ function card(item) {
   return wrap;
 }
 
-(async () => {
-  const res = await fetch("/api/stories");
-  const data = await res.json();
-  (data.items || []).forEach((it) => list.appendChild(card(it)));
-})();
+// infinite scroll (keyset: before_id = id สุดท้ายของหน้าก่อน)
+const PAGE_SIZE = 30;
+const sentinel = document.getElementById("more");
+let nextBeforeId = null;
+let loading = false;
+let finished = false;
+
+async function loadPage() {
+  if (loading || finished) return;
+  loading = true;
+  try {
+    const params = new URLSearchParams(window.location.search);
+    params.set("limit", PAGE_SIZE);
+    if (nextBeforeId !== null) params.set("before_id", nextBeforeId);
+
+    const res = await fetch(`/api/stories?${params}`);
+    const data = await res.json();
+    (data.items || []).forEach((it) => list.appendChild(card(it)));
+
+    nextBeforeId = data.next_before_id;
+    if (nextBeforeId === null || nextBeforeId === undefined) {
+      finished = true;
+      observer.disconnect();
+      sentinel.classList.add("hidden");
+    }
+  } finally {
+    loading = false;
+  }
+}
+
+const observer = new IntersectionObserver((entries) => {
+  if (entries.some((e) => e.isIntersecting)) loadPage();
+}, { rootMargin: "400px" });
+observer.observe(sentinel);
 
 function fmtDate(s) {
   if (!s) return "";
@@ -80,3 +123,57 @@ function fmtDate(s) {
     timeStyle: "short",
   }).format(d);
 }
+
+
+// ---------------------------
+// Search (/api/search)
+// ---------------------------
+const searchForm = document.getElementById("searchForm");
+const searchQ = document.getElementById("searchQ");
+const searchResults = document.getElementById("searchResults");
+
+function searchHit(item) {
+  const a = document.createElement("a");
+  a.href = `/story/${item.id}`;
+  a.className =
+    "block rounded-2xl border border-slate-200 bg-white p-4 shadow-sm hover:bg-slate-50 dark:border-slate-800 dark:bg-slate-900 dark:hover:bg-slate-800";
+
+  const title = document.createElement("div");
+  title.className = "text-sm font-semibold text-slate-900 dark:text-slate-100";
+  title.textContent = item.chapter_index ? `${item.title} · Chapter ${item.chapter_index}` : item.title;
+
+  const snip = document.createElement("div");
+  snip.className = "mt-1 text-xs text-slate-600 dark:text-slate-300 whitespace-pre-wrap";
+  snip.innerHTML = item.snippet_html; // escape แล้วฝั่ง server เหลือแค่ <mark>
+
+  a.appendChild(title);
+  a.appendChild(snip);
+  return a;
+}
+
+searchForm.addEventListener("submit", async (e) => {
+  e.preventDefault();
+  const q = searchQ.value.trim();
+  searchResults.innerHTML = "";
+
+  if (!q) {
+    searchResults.classList.add("hidden");
+    list.classList.remove("hidden");
+    return;
+  }
+
+  list.classList.add("hidden");
+  searchResults.classList.remove("hidden");
+
+  const res = await fetch(`/api/search?${new URLSearchParams({ q })}`);
+  const data = await res.json().catch(() => ({}));
+  if (!res.ok) {
+    searchResults.textContent = data.error || `Error ${res.status}`;
+    return;
+  }
+  if (!(data.items || []).length) {
+    searchResults.textContent = "ไม่พบเรื่องที่ตรงกับคำค้น";
+    return;
+  }
+  data.items.forEach((it) => searchResults.appendChild(searchHit(it)));
+});
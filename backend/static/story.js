@@ -15,14 +15,14 @@ const imgOut = document.getElementById("imgOut");
 const imgHint = document.getElementById("imgHint");
 const arSel = document.getElementById("ar");
 
+const THUMB_WIDTH = 384;
+
 let isBusy = false;
 
-function renderChapters(chapters) {
-    chaptersEl.innerHTML = "";
-    if (!chapters || !chapters.length) {
-        chaptersEl.innerHTML = `<div class="text-xs text-slate-500 dark:text-slate-400">(ยังไม่มี)</div>`;
-        return;
-    }
+let lastIndex = 0; // chapter ล่าสุดที่แสดงอยู่ -> ขอเฉพาะตอนที่ใหม่กว่านี้
+
+function appendChapters(chapters) {
+    chaptersEl.querySelector(".empty")?.remove();
     chapters.forEach(ch => {
         const wrap = document.createElement("div");
         wrap.className = "rounded-2xl border border-slate-200 bg-slate-50 p-4 dark:border-slate-800 dark:bg-slate-950";
@@ -34,46 +34,121 @@ function renderChapters(chapters) {
     `;
         wrap.querySelector("pre").textContent = ch.text;
         chaptersEl.appendChild(wrap);
+        lastIndex = Math.max(lastIndex, ch.index);
     });
 }
 
+async function fetchChapters() {
+    // ดึงทีละหน้าจนครบ; แต่ละ request ได้เฉพาะตอนหลัง lastIndex
+    let data;
+    do {
+        const res = await fetch(`/api/story/${storyId}?since_index=${lastIndex}`);
+        data = await res.json();
+        if (!res.ok) throw new Error(data.error || `Error ${res.status}`);
+        if (data.story.full_text !== undefined) storyText.textContent = data.story.full_text || "";
+        appendChapters(data.chapters || []);
+    } while (data.has_more && data.chapters.length);
+    if (data.image && imgOut.classList.contains("hidden")) showImage(data.image);
+}
+
 async function loadStory() {
-    const res = await fetch(`/api/story/${storyId}`);
-    const data = await res.json();
-    if (!res.ok) {
-        storyText.textContent = data.error || `Error ${res.status}`;
+    lastIndex = 0;
+    chaptersEl.innerHTML = "";
+    try {
+        await fetchChapters();
+    } catch (e) {
+        storyText.textContent = e.message;
         return;
     }
-    storyText.textContent = data.story.full_text || "";
-    renderChapters(data.chapters || []);
+    if (!lastIndex) {
+        chaptersEl.innerHTML = `<div class="empty text-xs text-slate-500 dark:text-slate-400">(ยังไม่มี)</div>`;
+    }
 
     dlMd.href = `/download/${storyId}.md`;
     dlTxt.href = `/download/${storyId}.txt`;
     dlPdf.href = `/download/${storyId}.pdf`;
 }
 
+function showImage(img) {
+    // thumbnail สำหรับจอเล็ก, WebP ขนาดเต็มสำหรับจอใหญ่ (ไม่โหลด PNG ต้นฉบับ)
+    imgOut.srcset = `${img.thumb_url} ${THUMB_WIDTH}w, ${img.webp_url} ${img.width || 1024}w`;
+    imgOut.sizes = "(max-width: 640px) 100vw, 768px";
+    imgOut.src = img.webp_url;
+    imgOut.onload = () => {
+        imgHint.classList.add("hidden");
+        imgOut.classList.remove("hidden");
+    };
+}
+
+function liveChapterCard() {
+    const wrap = document.createElement("div");
+    wrap.className = "rounded-2xl border border-slate-200 bg-slate-50 p-4 dark:border-slate-800 dark:bg-slate-950";
+    wrap.innerHTML = `
+            <div class="flex flex-wrap items-center gap-2">
+                <span class="idx inline-flex rounded-full border border-slate-200 px-3 py-1 text-xs text-slate-600 dark:border-slate-800 dark:text-slate-300">Chapter …</span>
+                <span class="ttl text-sm font-semibold text-slate-900 dark:text-slate-100">กำลังเขียน...</span>
+            </div><pre class="mt-3 whitespace-pre-wrap font-sans text-sm text-slate-700 dark:text-slate-200"></pre>
+    `;
+    chaptersEl.appendChild(wrap);
+    return {
+        wrap,
+        idx: wrap.querySelector(".idx"),
+        title: wrap.querySelector(".ttl"),
+        text: wrap.querySelector("pre"),
+    };
+}
+
 nextBtn.addEventListener("click", async () => {
     if (isBusy) return;
     isBusy = true;
     nextBtn.disabled = true;
     try {
-        const res = await fetch("/api/next", {
+        const res = await fetch("/api/next/stream", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({ story_id: storyId, user_direction: dirInput.value }),
         });
-        const data = await res.json();
         if (!res.ok) {
+            const data = await res.json().catch(() => ({}));
             alert(data.error || `Error ${res.status}`);
             return;
         }
-        await loadStory();
+
+        const live = liveChapterCard();
+        let failed = null;
+        await readSSE(res, (event, data) => {
+            if (event === "start" || event === "done") live.idx.textContent = `Chapter ${data.chapter_index}`;
+            else if (event === "title") live.title.textContent = data.title;
+            else if (event === "delta") live.text.textContent += data.text;
+            else if (event === "error") failed = data.error || "Error";
+        });
+
+        if (failed) {
+            live.wrap.remove();
+            alert(failed);
+            return;
+        }
+        live.wrap.remove();
+        await fetchChapters().catch((e) => alert(e.message));
     } finally {
         nextBtn.disabled = false;
         isBusy = false;
     }
 });
 
+async function waitForJob(job) {
+    // poll จนกว่า job จะเสร็จ (done / error)
+    let delay = 1000;
+    while (job.status === "queued" || job.status === "running") {
+        await new Promise((r) => setTimeout(r, delay));
+        delay = Math.min(delay * 1.5, 5000);
+        const res = await fetch(job.status_url);
+        if (!res.ok) return { status: "error", error: `Error ${res.status}` };
+        job = await res.json();
+    }
+    return job;
+}
+
 genImgBtn.addEventListener("click", async () => {
     if (isBusy) return;
     isBusy = true;
@@ -89,16 +164,17 @@ genImgBtn.addEventListener("click", async () => {
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({ story_id: storyId, aspect_ratio: arSel.value }),
         });
-        const data = await res.json();
+        let data = await res.json();
         if (!res.ok) {
             imgHint.textContent = data.error || `Error ${res.status}`;
             return;
         }
-        imgOut.src = data.image_url + `?t=${Date.now()}`;
-        imgOut.onload = () => {
-            imgHint.classList.add("hidden");
-            imgOut.classList.remove("hidden");
-        };
+        data = await waitForJob(data);
+        if (data.status !== "done") {
+            imgHint.textContent = data.error || "สร้างภาพไม่สำเร็จ";
+            return;
+        }
+        showImage(data);
     } finally {
         genImgBtn.disabled = false;
         isBusy = false;
@@ -1,39 +1,375 @@
 import json
+import os
 import sqlite3
+import threading
+import time
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
 
-DB_PATH = "stories.db"
+import metrics
 
-def _conn():
-    return sqlite3.connect(DB_PATH)
+DB_PATH = os.getenv("STORIES_DB", "stories.db")
 
-def init_db():
-    with _conn() as con:
-        cur = con.cursor()
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS stories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            created_at TEXT NOT NULL,
-            options_json TEXT NOT NULL,
-            title TEXT NOT NULL,
-            full_text TEXT NOT NULL,
-            illustration_prompt TEXT
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS chapters (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            story_id INTEGER NOT NULL,
-            chapter_index INTEGER NOT NULL,
-            chapter_title TEXT NOT NULL,
-            chapter_text TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(story_id) REFERENCES stories(id)
+# storage_seconds{fn} + stage "db" ใน Server-Timing - ใส่เฉพาะฟังก์ชันที่ query sqlite จริง
+# (generator อย่าง iter_chapters วัดได้แค่ตอนสร้าง ไม่ใช่ตอนอ่าน -> ไม่ใส่)
+_query = metrics.timed("db", metrics.STORAGE_SECONDS)
+
+# เก็บ connection ไว้ต่อ thread แทนการ connect ใหม่ทุกครั้ง
+# (statement cache ของ sqlite3 อยู่ใน connection -> prepared statement ถูกใช้ซ้ำด้วย)
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # reader ไม่ต้องรอ writer
+    "PRAGMA synchronous=NORMAL",      # ปลอดภัยพอสำหรับ WAL และ fsync น้อยลง
+    "PRAGMA cache_size=-20000",       # ~20MB page cache ต่อ connection
+    "PRAGMA mmap_size=268435456",     # 256MB memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",         # ให้ ON DELETE CASCADE ทำงาน
+)
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+_all_conns: List[sqlite3.Connection] = []
+_all_conns_lock = threading.Lock()
+_generation = 0  # เพิ่มทุกครั้งที่ close_connections() -> thread อื่น connect ใหม่
+# DB_PATH ที่ migrate แล้วใน process นี้ (connection แรกของแต่ละ path เป็นคน migrate)
+_migrated: set = set()
+_migrate_lock = threading.Lock()
+
+# callback(story_id) ที่ถูกเรียกเมื่อเนื้อหาของ story เปลี่ยน (เช่น ล้าง export cache)
+_change_listeners: List[Callable[[int], None]] = []
+
+
+def _conn() -> sqlite3.Connection:
+    """
+    Per-thread cached connection. Use as `with _conn() as con:` - the
+    context manager commits/rolls back but does not close it.
+    """
+    con = getattr(_local, "con", None)
+    if con is not None and _local.path == DB_PATH and _local.gen == _generation:
+        return con
+
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+    _local.con = con
+    _local.path = DB_PATH
+    _local.gen = _generation
+    with _all_conns_lock:
+        _all_conns.append(con)
+    if DB_PATH not in _migrated:
+        try:
+            _ensure_schema(con, DB_PATH)
+        except Exception:
+            _local.con = None  # migrate ไม่ผ่าน -> query ถัดไปลองใหม่
+            raise
+    return con
+
+
+def _ensure_schema(con: sqlite3.Connection, path: str):
+    with _migrate_lock:
+        if path in _migrated:
+            return
+        ensure_schema(con)
+        _migrated.add(path)
+
+
+def close_connections():
+    """Close every cached connection (app shutdown / tests)."""
+    global _generation
+    with _all_conns_lock:
+        conns = list(_all_conns)
+        _all_conns.clear()
+        _generation += 1
+    for con in conns:
+        try:
+            con.close()
+        except sqlite3.ProgrammingError:
+            pass
+
+def on_story_changed(fn: Callable[[int], None]):
+    """Register fn(story_id), called after add_chapter / delete_story."""
+    _change_listeners.append(fn)
+    return fn
+
+
+def _notify_changed(story_id: int):
+    for fn in _change_listeners:
+        fn(story_id)
+
+
+# ---------------------------
+# Schema migrations
+# ---------------------------
+def _m001_base(con: sqlite3.Connection):
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS stories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TEXT NOT NULL,
+        options_json TEXT NOT NULL,
+        title TEXT NOT NULL,
+        full_text TEXT NOT NULL,
+        illustration_prompt TEXT
+    )
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS chapters (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        story_id INTEGER NOT NULL,
+        chapter_index INTEGER NOT NULL,
+        chapter_title TEXT NOT NULL,
+        chapter_text TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY(story_id) REFERENCES stories(id)
+    )
+    """)
+
+
+def _m002_chapter_indexes_cascade(con: sqlite3.Connection):
+    # SQLite แก้ FOREIGN KEY ไม่ได้ -> สร้างตาราง chapters ใหม่แล้ว copy ข้อมูล
+    con.execute("""
+    CREATE TABLE chapters_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        story_id INTEGER NOT NULL,
+        chapter_index INTEGER NOT NULL,
+        chapter_title TEXT NOT NULL,
+        chapter_text TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY(story_id) REFERENCES stories(id) ON DELETE CASCADE
+    )
+    """)
+    # chapter ที่ไม่มี story แล้ว (orphan) ไม่ถูก copy ไป
+    ranked = """
+        SELECT c.*, ROW_NUMBER() OVER (PARTITION BY story_id, chapter_index ORDER BY id) AS rn
+        FROM chapters c
+        WHERE story_id IN (SELECT id FROM stories)
+    """
+    con.execute(f"""
+    INSERT INTO chapters_new(id, story_id, chapter_index, chapter_title, chapter_text, created_at)
+    SELECT id, story_id, chapter_index, chapter_title, chapter_text, created_at
+    FROM ({ranked}) WHERE rn = 1
+    """)
+    # index ซ้ำ (จาก /api/next ที่ชนกัน) -> ย้ายไปต่อท้ายเรื่อง ไม่ทิ้งเนื้อหา
+    con.execute(f"""
+    INSERT INTO chapters_new(id, story_id, chapter_index, chapter_title, chapter_text, created_at)
+    SELECT id, story_id,
+           (SELECT MAX(chapter_index) FROM chapters c2 WHERE c2.story_id = d.story_id)
+             + ROW_NUMBER() OVER (PARTITION BY story_id ORDER BY id),
+           chapter_title, chapter_text, created_at
+    FROM ({ranked}) d WHERE rn > 1
+    """)
+    con.execute("DROP TABLE chapters")
+    con.execute("ALTER TABLE chapters_new RENAME TO chapters")
+    con.execute("CREATE UNIQUE INDEX idx_chapters_story_index ON chapters(story_id, chapter_index)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_stories_created_at ON stories(created_at)")
+
+
+def _m003_story_filter_columns(con: sqlite3.Connection):
+    # generated column ดึงค่าจาก options_json ไว้ให้ index ได้ -> filter ไม่ต้อง parse JSON ทุกแถว
+    for col in ("genre", "tone", "age"):
+        con.execute(
+            f"ALTER TABLE stories ADD COLUMN {col} TEXT "
+            f"GENERATED ALWAYS AS (json_extract(options_json, '$.{col}')) VIRTUAL"
         )
-        """)
-        con.commit()
+        con.execute(f"CREATE INDEX idx_stories_{col}_id ON stories({col}, id)")
+
+
+# trigger ของ migration 4 (ทีละ statement)
+_FTS_TRIGGERS = (
+    """
+    CREATE TRIGGER stories_fts_ai AFTER INSERT ON stories BEGIN
+        INSERT INTO stories_fts(rowid, title, full_text) VALUES (new.id, new.title, new.full_text);
+    END
+    """,
+    """
+    CREATE TRIGGER stories_fts_ad AFTER DELETE ON stories BEGIN
+        INSERT INTO stories_fts(stories_fts, rowid, title, full_text)
+        VALUES ('delete', old.id, old.title, old.full_text);
+    END
+    """,
+    """
+    CREATE TRIGGER stories_fts_au AFTER UPDATE OF title, full_text ON stories BEGIN
+        INSERT INTO stories_fts(stories_fts, rowid, title, full_text)
+        VALUES ('delete', old.id, old.title, old.full_text);
+        INSERT INTO stories_fts(rowid, title, full_text) VALUES (new.id, new.title, new.full_text);
+    END
+    """,
+    """
+    CREATE TRIGGER chapters_fts_ai AFTER INSERT ON chapters BEGIN
+        INSERT INTO chapters_fts(rowid, chapter_title, chapter_text)
+        VALUES (new.id, new.chapter_title, new.chapter_text);
+    END
+    """,
+    """
+    CREATE TRIGGER chapters_fts_ad AFTER DELETE ON chapters BEGIN
+        INSERT INTO chapters_fts(chapters_fts, rowid, chapter_title, chapter_text)
+        VALUES ('delete', old.id, old.chapter_title, old.chapter_text);
+    END
+    """,
+    """
+    CREATE TRIGGER chapters_fts_au AFTER UPDATE OF chapter_title, chapter_text ON chapters BEGIN
+        INSERT INTO chapters_fts(chapters_fts, rowid, chapter_title, chapter_text)
+        VALUES ('delete', old.id, old.chapter_title, old.chapter_text);
+        INSERT INTO chapters_fts(rowid, chapter_title, chapter_text)
+        VALUES (new.id, new.chapter_title, new.chapter_text);
+    END
+    """,
+)
+
+
+def _m004_fulltext_search(con: sqlite3.Connection):
+    # trigram tokenizer: ภาษาไทยไม่มีช่องว่างระหว่างคำ จึงค้นแบบ substring (>= 3 ตัวอักษร)
+    con.execute("""
+    CREATE VIRTUAL TABLE stories_fts USING fts5(
+        title, full_text, content='stories', content_rowid='id', tokenize='trigram'
+    )
+    """)
+    con.execute("""
+    CREATE VIRTUAL TABLE chapters_fts USING fts5(
+        chapter_title, chapter_text, content='chapters', content_rowid='id', tokenize='trigram'
+    )
+    """)
+    # trigger ให้ index ตามตารางหลักเสมอ (รวมถึงการลบแบบ cascade)
+    # execute ทีละ statement - executescript() จะ COMMIT transaction ของ migrate() ทิ้ง
+    for trigger in _FTS_TRIGGERS:
+        con.execute(trigger)
+    con.execute("INSERT INTO stories_fts(stories_fts) VALUES ('rebuild')")
+    con.execute("INSERT INTO chapters_fts(chapters_fts) VALUES ('rebuild')")
+
+
+def _m005_jobs(con: sqlite3.Connection):
+    con.execute("""
+    CREATE TABLE jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        story_id INTEGER REFERENCES stories(id) ON DELETE CASCADE,
+        dedupe_key TEXT NOT NULL,
+        payload_json TEXT NOT NULL,
+        status TEXT NOT NULL,
+        result_json TEXT,
+        error TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    """)
+    # job ที่ยังไม่จบ มีได้แค่ 1 ตัวต่อ dedupe_key
+    con.execute(
+        "CREATE UNIQUE INDEX idx_jobs_active_dedupe ON jobs(dedupe_key) WHERE status IN ('queued', 'running')"
+    )
+    con.execute("CREATE INDEX idx_jobs_status ON jobs(status, created_at)")
+
+
+def _m006_images(con: sqlite3.Connection):
+    con.execute("""
+    CREATE TABLE images (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        story_id INTEGER NOT NULL REFERENCES stories(id) ON DELETE CASCADE,
+        stem TEXT NOT NULL UNIQUE,
+        ext TEXT NOT NULL,
+        mime_type TEXT NOT NULL,
+        size_bytes INTEGER NOT NULL,
+        width INTEGER,
+        height INTEGER,
+        aspect_ratio TEXT,
+        created_at TEXT NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+    """)
+    con.execute("CREATE INDEX idx_images_story ON images(story_id, created_at)")
+    con.execute("CREATE INDEX idx_images_last_used ON images(last_used_at)")
+
+
+def _m007_story_summaries(con: sqlite3.Connection):
+    # สรุปเรื่องย่อสะสม ของ chapter 1..upto_index (ใช้ทำ context ของ /api/next)
+    con.execute("""
+    CREATE TABLE story_summaries (
+        story_id INTEGER PRIMARY KEY REFERENCES stories(id) ON DELETE CASCADE,
+        upto_index INTEGER NOT NULL,
+        summary TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    """)
+
+
+def _m008_job_owner(con: sqlite3.Connection):
+    # process ที่ถือ job (boot id) + heartbeat -> รู้ว่า job running ไหนเป็นของ process ที่ตายไปแล้ว
+    con.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+    con.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+
+
+def _m009_llm_cache(con: sqlite3.Connection):
+    # เดิม cache.SQLiteBackend สร้างเอง -> DB เก่ามีตารางนี้อยู่แล้ว (IF NOT EXISTS)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+    )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache(accessed_at)")
+
+
+# (version, migration) เรียงตามลำดับ - เพิ่มอันใหม่ต่อท้ายเท่านั้น
+MIGRATIONS = [
+    (1, _m001_base),
+    (2, _m002_chapter_indexes_cascade),
+    (3, _m003_story_filter_columns),
+    (4, _m004_fulltext_search),
+    (5, _m005_jobs),
+    (6, _m006_images),
+    (7, _m007_story_summaries),
+    (8, _m008_job_owner),
+    (9, _m009_llm_cache),
+]
+
+
+def schema_version(con: sqlite3.Connection) -> int:
+    con.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TEXT NOT NULL)")
+    row = con.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return int(row[0] or 0)
 
+
+def migrate(con: sqlite3.Connection) -> int:
+    """Apply pending migrations, each in its own transaction. Returns the new version."""
+    # ต้องปิด foreign_keys ระหว่าง rebuild ตาราง (เปลี่ยน pragma ใน transaction ไม่ได้)
+    con.execute("PRAGMA foreign_keys=OFF")
+    try:
+        for version, migration in MIGRATIONS:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                # อ่าน version ใหม่ใน transaction - หลาย worker อาจ migrate พร้อมกัน
+                if version <= schema_version(con):
+                    con.rollback()
+                    continue
+                migration(con)
+                con.execute(
+                    "INSERT INTO schema_version(version, applied_at) VALUES(?,?)",
+                    (version, datetime.utcnow().isoformat()),
+                )
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+        return schema_version(con)
+    finally:
+        con.execute("PRAGMA foreign_keys=ON")
+
+
+def ensure_schema(con: sqlite3.Connection):
+    """Migrate con's database if it is behind (read only when already current)."""
+    # อ่านอย่างเดียวถ้า schema ล่าสุดแล้ว (เช่น PDF worker) - ไม่ต้องจับ write lock ทีละ migration
+    if schema_version(con) < MIGRATIONS[-1][0]:
+        migrate(con)
+    con.commit()
+
+
+@_query
+def init_db():
+    """Connect and migrate DB_PATH now (otherwise the first query does it)."""
+    _conn()
+
+
+@_query
 def create_story(options: Dict[str, Any], title: str, full_text: str, illustration_prompt: Optional[str]) -> int:
     now = datetime.utcnow().isoformat()
     with _conn() as con:
@@ -45,6 +381,32 @@ def create_story(options: Dict[str, Any], title: str, full_text: str, illustrati
         con.commit()
         return int(cur.lastrowid)
 
+@_query
+def create_stories(items: Iterable[Dict[str, Any]]) -> List[int]:
+    """
+    Insert many new stories, each with its Chapter 1, in one transaction.
+    items: {"options", "title", "full_text", "illustration_prompt"}; returns ids in order.
+    """
+    now = datetime.utcnow().isoformat()
+    with _conn() as con:
+        ids = []
+        chapters = []
+        for it in items:
+            cur = con.execute(
+                "INSERT INTO stories(created_at, options_json, title, full_text, illustration_prompt) VALUES(?,?,?,?,?)",
+                (now, json.dumps(it["options"], ensure_ascii=False), it["title"], it["full_text"], it["illustration_prompt"])
+            )
+            story_id = int(cur.lastrowid)
+            ids.append(story_id)
+            chapters.append((story_id, 1, "Chapter 1", it["full_text"], now))
+        con.executemany(
+            "INSERT INTO chapters(story_id, chapter_index, chapter_title, chapter_text, created_at) VALUES(?,?,?,?,?)",
+            chapters
+        )
+        con.commit()
+        return ids
+
+@_query
 def add_chapter(story_id: int, chapter_index: int, chapter_title: str, chapter_text: str) -> int:
     now = datetime.utcnow().isoformat()
     with _conn() as con:
@@ -54,8 +416,48 @@ def add_chapter(story_id: int, chapter_index: int, chapter_title: str, chapter_t
             (story_id, chapter_index, chapter_title, chapter_text, now)
         )
         con.commit()
-        return int(cur.lastrowid)
+    _notify_changed(story_id)
+    return int(cur.lastrowid)
+
+@_query
+def append_chapter(story_id: int, chapter_title: str, chapter_text: str) -> int:
+    """
+    Add the story's next chapter and return its chapter_index. The index is
+    allocated (MAX + 1) inside the same write transaction, so concurrent
+    appends to one story never read the same max.
+    """
+    now = datetime.utcnow().isoformat()
+    with _conn() as con:
+        # IMMEDIATE: จอง write lock ก่อนอ่าน MAX (WAL แบบ deferred อาจได้ snapshot เก่า -> busy)
+        # story เก่าที่ไม่มีแถว chapter เลย นับ full_text เป็นตอนที่ 1 -> เริ่มที่ 2
+        con.execute("BEGIN IMMEDIATE")
+        row = con.execute(
+            "INSERT INTO chapters(story_id, chapter_index, chapter_title, chapter_text, created_at) "
+            "SELECT ?, COALESCE(MAX(chapter_index), 1) + 1, ?, ?, ? FROM chapters WHERE story_id=? "
+            "RETURNING chapter_index",
+            (story_id, chapter_title, chapter_text, now, story_id)
+        ).fetchone()
+    _notify_changed(story_id)
+    return int(row[0])
+
+@_query
+def get_story_header(story_id: int) -> Optional[Dict[str, Any]]:
+    """get_story() without full_text."""
+    with _conn() as con:
+        row = con.execute(
+            "SELECT id, created_at, options_json, title, illustration_prompt FROM stories WHERE id=?", (story_id,)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "id": row[0],
+            "created_at": row[1],
+            "options": json.loads(row[2]),
+            "title": row[3],
+            "illustration_prompt": row[4],
+        }
 
+@_query
 def get_story(story_id: int) -> Optional[Dict[str, Any]]:
     with _conn() as con:
         cur = con.cursor()
@@ -72,6 +474,7 @@ def get_story(story_id: int) -> Optional[Dict[str, Any]]:
             "illustration_prompt": row[5],
         }
 
+@_query
 def list_chapters(story_id: int) -> List[Dict[str, Any]]:
     with _conn() as con:
         cur = con.cursor()
@@ -85,44 +488,498 @@ def list_chapters(story_id: int) -> List[Dict[str, Any]]:
             for r in rows
         ]
 
-def story_markdown(story: Dict[str, Any], chapters: List[Dict[str, Any]]) -> str:
+@_query
+def chapter_stats(story_id: int) -> Dict[str, Any]:
+    """
+    {"count", "max_index", "max_id", "modified_at"} of a story's chapters
+    (0 / None when there are none) - no chapter text is read except the
+    newest row's created_at.
+    """
+    with _conn() as con:
+        row = con.execute(
+            "SELECT s.n, s.last, s.m, (SELECT created_at FROM chapters WHERE id=s.m) FROM ("
+            "SELECT COUNT(*) AS n, COALESCE(MAX(chapter_index), 0) AS last, COALESCE(MAX(id), 0) AS m "
+            "FROM chapters WHERE story_id=?) s",
+            (story_id,)
+        ).fetchone()
+        return {"count": row[0], "max_index": row[1], "max_id": row[2], "modified_at": row[3]}
+
+def story_version(stats: Dict[str, Any]) -> str:
+    """Cheap content version from chapter_stats() (changes whenever a chapter is added)."""
+    return f"c{stats['count']}-{stats['max_id']}"
+
+@_query
+def chapters_after(story_id: int, after_index: int, limit: int, newest_first: bool = False) -> List[Dict[str, Any]]:
+    """
+    Up to `limit` chapters with chapter_index > after_index, oldest first
+    (or the newest ones, newest first).
+    """
+    order = "DESC" if newest_first else "ASC"
+    with _conn() as con:
+        rows = con.execute(
+            "SELECT chapter_index, chapter_title, chapter_text, created_at FROM chapters "
+            f"WHERE story_id=? AND chapter_index > ? ORDER BY chapter_index {order} LIMIT ?",
+            (story_id, after_index, limit)
+        ).fetchall()
+        return [{"index": r[0], "title": r[1], "text": r[2], "created_at": r[3]} for r in rows]
+
+@_query
+def get_summary(story_id: int) -> Optional[Dict[str, Any]]:
+    with _conn() as con:
+        row = con.execute(
+            "SELECT upto_index, summary, updated_at FROM story_summaries WHERE story_id=?", (story_id,)
+        ).fetchone()
+        return {"upto_index": row[0], "summary": row[1], "updated_at": row[2]} if row else None
+
+@_query
+def save_summary(story_id: int, upto_index: int, summary: str):
+    """Store the rolling summary; never moves backwards (upto_index only grows)."""
+    now = datetime.utcnow().isoformat()
+    with _conn() as con:
+        con.execute(
+            "INSERT INTO story_summaries(story_id, upto_index, summary, updated_at) VALUES(?,?,?,?) "
+            "ON CONFLICT(story_id) DO UPDATE SET upto_index=excluded.upto_index, summary=excluded.summary, "
+            "updated_at=excluded.updated_at WHERE excluded.upto_index > story_summaries.upto_index",
+            (story_id, upto_index, summary, now)
+        )
+        con.commit()
+
+# ---------------------------
+# Batched reads (bulk export) - 1 query ต่อกลุ่ม id แทน N+1
+# ---------------------------
+def _marks(ids: List[int]) -> str:
+    return ",".join("?" * len(ids))
+
+@_query
+def get_stories(story_ids: Iterable[int]) -> List[Dict[str, Any]]:
+    ids = list(story_ids)
+    if not ids:
+        return []
+    with _conn() as con:
+        rows = con.execute(
+            "SELECT id, created_at, options_json, title, full_text, illustration_prompt FROM stories "
+            f"WHERE id IN ({_marks(ids)}) ORDER BY id",
+            ids
+        ).fetchall()
+        return [
+            {
+                "id": r[0],
+                "created_at": r[1],
+                "options": json.loads(r[2]),
+                "title": r[3],
+                "full_text": r[4],
+                "illustration_prompt": r[5],
+            }
+            for r in rows
+        ]
+
+@_query
+def chapters_for_stories(story_ids: Iterable[int]) -> Dict[int, List[Dict[str, Any]]]:
+    ids = list(story_ids)
+    out: Dict[int, List[Dict[str, Any]]] = {i: [] for i in ids}
+    if not ids:
+        return out
+    with _conn() as con:
+        rows = con.execute(
+            "SELECT story_id, chapter_index, chapter_title, chapter_text, created_at FROM chapters "
+            f"WHERE story_id IN ({_marks(ids)}) ORDER BY story_id, chapter_index",
+            ids
+        )
+        for r in rows:
+            out[r[0]].append({"index": r[1], "title": r[2], "text": r[3], "created_at": r[4]})
+        return out
+
+@_query
+def story_versions(story_ids: Iterable[int]) -> Dict[int, str]:
+    """story_version() of many stories in one query."""
+    ids = list(story_ids)
+    out = {i: "c0-0" for i in ids}
+    if not ids:
+        return out
+    with _conn() as con:
+        rows = con.execute(
+            "SELECT story_id, COUNT(*), MAX(id) FROM chapters "
+            f"WHERE story_id IN ({_marks(ids)}) GROUP BY story_id",
+            ids
+        )
+        for r in rows:
+            out[r[0]] = story_version({"count": r[1], "max_id": r[2]})
+        return out
+
+@_query
+def images_for_stories(story_ids: Iterable[int]) -> Dict[int, List[Dict[str, Any]]]:
+    ids = list(story_ids)
+    out: Dict[int, List[Dict[str, Any]]] = {i: [] for i in ids}
+    if not ids:
+        return out
+    with _conn() as con:
+        rows = con.execute(
+            f"SELECT {_IMAGE_COLUMNS} FROM images WHERE story_id IN ({_marks(ids)}) ORDER BY story_id, created_at",
+            ids
+        )
+        for r in rows:
+            out[r[1]].append(_image_row(r))
+        return out
+
+def iter_chapters(story_id: int) -> Iterator[Dict[str, Any]]:
+    """Like list_chapters but yields rows one by one instead of loading all chapter texts."""
+    cur = _conn().execute(
+        "SELECT chapter_index, chapter_title, chapter_text, created_at FROM chapters WHERE story_id=? ORDER BY chapter_index ASC",
+        (story_id,)
+    )
+    try:
+        for r in cur:
+            yield {"index": r[0], "title": r[1], "text": r[2], "created_at": r[3]}
+    finally:
+        cur.close()
+
+def story_markdown_chunks(story: Dict[str, Any], chapters: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """story_markdown as a stream of chunks ("\n".join(chunks) == story_markdown)."""
     opts = story["options"]
-    lines = []
-    lines.append(f"# {story['title']}\n")
-    lines.append("## Options\n")
+    yield f"# {story['title']}\n"
+    yield "## Options\n"
     for k, v in opts.items():
-        lines.append(f"- **{k}**: {v}")
-    lines.append("\n---\n")
-    lines.append(story["full_text"].strip())
+        yield f"- **{k}**: {v}"
+    yield "\n---\n"
+    yield story["full_text"].strip()
     if story.get("illustration_prompt"):
-        lines.append("\n---\n")
-        lines.append("## Illustration Prompt\n")
-        lines.append(story["illustration_prompt"].strip())
+        yield "\n---\n"
+        yield "## Illustration Prompt\n"
+        yield story["illustration_prompt"].strip()
 
-    if chapters:
-        lines.append("\n---\n")
-        lines.append("## Chapters\n")
-        for ch in chapters:
-            lines.append(f"\n### Chapter {ch['index']}: {ch['title']}\n")
-            lines.append(ch["text"].strip())
-    return "\n".join(lines)
+    first = True
+    for ch in chapters:
+        if first:
+            yield "\n---\n"
+            yield "## Chapters\n"
+            first = False
+        yield f"\n### Chapter {ch['index']}: {ch['title']}\n"
+        yield ch["text"].strip()
+
+def story_markdown(story: Dict[str, Any], chapters: List[Dict[str, Any]]) -> str:
+    return "\n".join(story_markdown_chunks(story, chapters))
+
+@_query
+def list_stories(
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    genre: Optional[str] = None,
+    tone: Optional[str] = None,
+    age: Optional[str] = None,
+):
+    """
+    Keyset pagination on id (newest first): pass the last id of the previous
+    page as before_id. genre/tone/age match the values stored in options.
+    """
+    where, params = [], []
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+    for col, value in (("genre", genre), ("tone", tone), ("age", age)):
+        if value:
+            where.append(f"{col} = ?")
+            params.append(value)
+    sql = "SELECT id, created_at, title FROM stories"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
 
-def list_stories(limit: int = 50):
     with _conn() as con:
         cur = con.cursor()
-        cur.execute(
-            "SELECT id, created_at, title FROM stories ORDER BY id DESC LIMIT ?",
-            (limit,)
-        )
+        cur.execute(sql, params)
         rows = cur.fetchall()
         return [{"id": r[0], "created_at": r[1], "title": r[2]} for r in rows]
 
+# ---------------------------
+# Full-text search
+# ---------------------------
+SEARCH_MIN_TERM = 3  # trigram ต้องมีอย่างน้อย 3 ตัวอักษร
+SNIPPET_OPEN, SNIPPET_CLOSE = "\ue000", "\ue001"  # marker ชั่วคราว แทนที่ตอน escape HTML
+
+
+def fts_query(q: str) -> str:
+    """User text -> FTS5 MATCH expression (AND of quoted phrases). '' if nothing searchable."""
+    terms = [t for t in (q or "").split() if len(t) >= SEARCH_MIN_TERM]
+    return " AND ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+@_query
+def search(q: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    Ranked (bm25) search over story titles/text and chapters.
+    One result per story: its best match, with a snippet around the hit.
+    """
+    match = fts_query(q)
+    if not match:
+        return []
+
+    sql = f"""
+    SELECT s.id, s.title, s.created_at, NULL AS chapter_index,
+           snippet(stories_fts, -1, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', 64) AS snip,
+           bm25(stories_fts, 10.0, 1.0) AS score
+    FROM stories_fts JOIN stories s ON s.id = stories_fts.rowid
+    WHERE stories_fts MATCH ?
+    UNION ALL
+    SELECT s.id, s.title, s.created_at, c.chapter_index,
+           snippet(chapters_fts, -1, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', 64) AS snip,
+           bm25(chapters_fts, 5.0, 1.0) AS score
+    FROM chapters_fts
+    JOIN chapters c ON c.id = chapters_fts.rowid
+    JOIN stories s ON s.id = c.story_id
+    WHERE chapters_fts MATCH ?
+    ORDER BY score
+    LIMIT ?
+    """
+    with _conn() as con:
+        rows = con.execute(sql, (match, match, limit * 4)).fetchall()
+
+    results: List[Dict[str, Any]] = []
+    seen = set()
+    for r in rows:
+        if r[0] in seen:
+            continue
+        seen.add(r[0])
+        results.append({
+            "id": r[0],
+            "title": r[1],
+            "created_at": r[2],
+            "chapter_index": r[3],
+            "snippet": r[4],
+            "score": r[5],
+        })
+        if len(results) >= limit:
+            break
+    return results
+
+
+@_query
 def delete_story(story_id: int) -> bool:
-    conn = _conn()
-    cur = conn.cursor()
+    with _conn() as con:
+        cur = con.cursor()
+        # chapters ถูกลบตาม (ON DELETE CASCADE)
+        cur.execute("DELETE FROM stories WHERE id = ?", (story_id,))
+        con.commit()
+        deleted = cur.rowcount > 0
+    if deleted:
+        _notify_changed(story_id)
+    return deleted
+
+# ---------------------------
+# Generated images
+# ---------------------------
+_IMAGE_COLUMNS = "id, story_id, stem, ext, mime_type, size_bytes, width, height, aspect_ratio, created_at, last_used_at"
+
+def _image_row(r) -> Dict[str, Any]:
+    return dict(zip(
+        ("id", "story_id", "stem", "ext", "mime_type", "size_bytes", "width", "height",
+         "aspect_ratio", "created_at", "last_used_at"),
+        r,
+    ))
+
+@_query
+def add_image(
+    story_id: int,
+    stem: str,
+    ext: str,
+    mime_type: str,
+    size_bytes: int,
+    width: Optional[int],
+    height: Optional[int],
+    aspect_ratio: Optional[str],
+    created: Optional[float] = None,
+) -> Dict[str, Any]:
+    """created: unix time of the file (ภาพเก่าที่ถูก index ทีหลัง), default = now."""
+    created = time.time() if created is None else created
+    created_at = datetime.utcfromtimestamp(created).isoformat()
+    with _conn() as con:
+        # ภาพเดิม (hash เดียวกัน) -> แค่นับว่าถูกใช้ล่าสุด
+        con.execute(
+            "INSERT INTO images(story_id, stem, ext, mime_type, size_bytes, width, height, aspect_ratio, created_at, last_used_at) "
+            "VALUES(?,?,?,?,?,?,?,?,?,?) "
+            "ON CONFLICT(stem) DO UPDATE SET last_used_at=excluded.last_used_at",
+            (story_id, stem, ext, mime_type, size_bytes, width, height, aspect_ratio, created_at, created)
+        )
+        con.commit()
+        row = con.execute(f"SELECT {_IMAGE_COLUMNS} FROM images WHERE stem=?", (stem,)).fetchone()
+        return _image_row(row)
 
-    cur.execute("DELETE FROM chapters WHERE story_id = ?", (story_id,))
-    cur.execute("DELETE FROM stories WHERE id = ?", (story_id,))
-    conn.commit()
+@_query
+def list_images(story_id: int) -> List[Dict[str, Any]]:
+    with _conn() as con:
+        rows = con.execute(
+            f"SELECT {_IMAGE_COLUMNS} FROM images WHERE story_id=? ORDER BY created_at DESC, id DESC", (story_id,)
+        ).fetchall()
+        return [_image_row(r) for r in rows]
+
+@_query
+def latest_images(story_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Newest image of each story in one query: {story_id: image}."""
+    ids = list(story_ids)
+    if not ids:
+        return {}
+    marks = ",".join("?" * len(ids))
+    with _conn() as con:
+        rows = con.execute(
+            f"SELECT {_IMAGE_COLUMNS} FROM ("
+            f" SELECT *, ROW_NUMBER() OVER (PARTITION BY story_id ORDER BY created_at DESC, id DESC) AS rn"
+            f" FROM images WHERE story_id IN ({marks})) WHERE rn = 1",
+            ids
+        ).fetchall()
+        return {r[1]: _image_row(r) for r in rows}
 
-    return cur.rowcount > 0
\ No newline at end of file
+@_query
+def image_usage() -> List[Dict[str, Any]]:
+    """Every image (stem, story_id, size, last use) oldest use first, for GC."""
+    with _conn() as con:
+        rows = con.execute(
+            "SELECT id, stem, ext, story_id, size_bytes, last_used_at FROM images ORDER BY last_used_at"
+        ).fetchall()
+        return [
+            {"id": r[0], "stem": r[1], "ext": r[2], "story_id": r[3], "size_bytes": r[4], "last_used_at": r[5]}
+            for r in rows
+        ]
+
+@_query
+def touch_images(last_used: Dict[str, float]):
+    """Record last-use times ({stem: unix time}) collected by the static file handler."""
+    if not last_used:
+        return
+    with _conn() as con:
+        con.executemany(
+            "UPDATE images SET last_used_at=MAX(last_used_at, ?) WHERE stem=?",
+            [(ts, stem) for stem, ts in last_used.items()]
+        )
+        con.commit()
+
+@_query
+def delete_images(image_ids: Iterable[int]):
+    ids = list(image_ids)
+    if not ids:
+        return
+    with _conn() as con:
+        con.executemany("DELETE FROM images WHERE id=?", [(i,) for i in ids])
+        con.commit()
+
+@_query
+def existing_story_ids(story_ids: Iterable[int]) -> set:
+    ids = list(story_ids)
+    if not ids:
+        return set()
+    with _conn() as con:
+        found = set()
+        # SQLite จำกัดจำนวน parameter -> แบ่งเป็นก้อน
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            found.update(r[0] for r in con.execute(f"SELECT id FROM stories WHERE id IN ({marks})", chunk))
+        return found
+
+# ---------------------------
+# Background jobs
+# ---------------------------
+def _job_row(r) -> Dict[str, Any]:
+    return {
+        "id": r[0],
+        "kind": r[1],
+        "story_id": r[2],
+        "payload": json.loads(r[3]),
+        "status": r[4],
+        "result": json.loads(r[5]) if r[5] else None,
+        "error": r[6],
+        "created_at": r[7],
+        "updated_at": r[8],
+    }
+
+_JOB_COLUMNS = "id, kind, story_id, payload_json, status, result_json, error, created_at, updated_at"
+
+@_query
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    with _conn() as con:
+        row = con.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return _job_row(row) if row else None
+
+@_query
+def create_job(job_id: str, kind: str, story_id: Optional[int], dedupe_key: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Insert a queued job, or return the queued/running job that already has
+    the same dedupe_key (identical request in flight).
+    """
+    now = datetime.utcnow().isoformat()
+    with _conn() as con:
+        try:
+            con.execute(
+                "INSERT INTO jobs(id, kind, story_id, dedupe_key, payload_json, status, created_at, updated_at) "
+                "VALUES(?,?,?,?,?,'queued',?,?)",
+                (job_id, kind, story_id, dedupe_key, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            con.commit()
+        except sqlite3.IntegrityError:
+            con.rollback()
+            row = con.execute(
+                f"SELECT {_JOB_COLUMNS} FROM jobs WHERE dedupe_key=? AND status IN ('queued', 'running')",
+                (dedupe_key,)
+            ).fetchone()
+            if row:
+                return _job_row(row)
+            raise
+    return get_job(job_id)
+
+@_query
+def claim_job(job_id: str, owner: str) -> bool:
+    """queued -> running (owned by `owner`); False if another worker already took it."""
+    now = datetime.utcnow().isoformat()
+    with _conn() as con:
+        cur = con.execute(
+            "UPDATE jobs SET status='running', owner=?, heartbeat_at=?, updated_at=? WHERE id=? AND status='queued'",
+            (owner, time.time(), now, job_id)
+        )
+        con.commit()
+        return cur.rowcount == 1
+
+@_query
+def finish_job(job_id: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+    now = datetime.utcnow().isoformat()
+    status = "error" if error else "done"
+    with _conn() as con:
+        con.execute(
+            "UPDATE jobs SET status=?, result_json=?, error=?, updated_at=? WHERE id=?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, now, job_id)
+        )
+        con.commit()
+
+@_query
+def release_job(job_id: str):
+    """running -> queued (worker ถูกหยุดกลางคัน)."""
+    with _conn() as con:
+        con.execute("UPDATE jobs SET status='queued', owner=NULL WHERE id=? AND status='running'", (job_id,))
+        con.commit()
+
+@_query
+def heartbeat_jobs(owner: str):
+    """Mark the running jobs of `owner` as still alive."""
+    with _conn() as con:
+        con.execute("UPDATE jobs SET heartbeat_at=? WHERE status='running' AND owner=?", (time.time(), owner))
+        con.commit()
+
+@_query
+def requeue_stale_jobs(owner: str, stale_before: float) -> List[str]:
+    """
+    Put jobs left 'running' by a dead process (another owner, no heartbeat
+    since stale_before, or claimed before owners were recorded) back to
+    'queued'; return their ids.
+    """
+    with _conn() as con:
+        rows = con.execute(
+            "UPDATE jobs SET status='queued', owner=NULL WHERE status='running' "
+            "AND (owner IS NULL OR (owner != ? AND COALESCE(heartbeat_at, 0) < ?)) RETURNING id",
+            (owner, stale_before)
+        ).fetchall()
+        con.commit()
+        return [r[0] for r in rows]
+
+@_query
+def queued_job_ids() -> List[str]:
+    with _conn() as con:
+        rows = con.execute("SELECT id FROM jobs WHERE status='queued' ORDER BY created_at").fetchall()
+        return [r[0] for r in rows]
@@ -0,0 +1,104 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List
+
+import metrics
+import storage
+from prompts import SUMMARY_RULES
+
+# ---------------------------
+# Continuation context for /api/next
+# ---------------------------
+# prompt = [สรุปเรื่องย่อของ chapter 1..k] + [เนื้อเรื่องเต็มของ NEXT_RECENT_CHAPTERS ตอนล่าสุด]
+# สรุปถูกอัปเดตทีละตอน (background job) เมื่อตอนนั้นหลุดออกจากช่วง verbatim
+# -> ขนาด prompt ไม่โตตามจำนวนตอน
+NEXT_RECENT_CHAPTERS = int(os.getenv("NEXT_RECENT_CHAPTERS", "2"))
+NEXT_VERBATIM_CHARS = int(os.getenv("NEXT_VERBATIM_CHARS", "12000"))
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "3000"))
+
+
+def summary_target(last_index: int) -> int:
+    """Chapters 1..target belong in the summary; the rest are sent verbatim."""
+    return max(0, last_index - NEXT_RECENT_CHAPTERS)
+
+
+def needs_summary(story_id: int) -> bool:
+    summary = storage.get_summary(story_id)
+    upto = summary["upto_index"] if summary else 0
+    return upto < summary_target(storage.chapter_stats(story_id)["max_index"])
+
+
+@metrics.timed("prompt", metrics.PROMPT_SECONDS)
+def gather(story: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Context for the next chapter: {"summary", "recent" (oldest first), "last_index"}.
+    Reads the summary row plus at most 2 * NEXT_RECENT_CHAPTERS chapter rows;
+    story may be a header from storage.get_story_header().
+    """
+    summary = storage.get_summary(story["id"])
+    upto = summary["upto_index"] if summary else 0
+
+    # ถ้าสรุปยังตามไม่ทัน (job ยังไม่เสร็จ) อาจมีตอนที่ยังไม่สรุปมากกว่า N ตอน
+    # -> เอาตอนล่าสุดเท่าที่งบตัวอักษรพอ ตอนที่ตกหล่นจะเข้าสรุปทีหลัง
+    candidates = storage.chapters_after(story["id"], upto, max(1, NEXT_RECENT_CHAPTERS) * 2, newest_first=True)
+    recent: List[Dict[str, Any]] = []
+    budget = NEXT_VERBATIM_CHARS
+    for ch in candidates:
+        text = ch["text"] or ""
+        if len(text) > budget:
+            if not recent:
+                recent.append({**ch, "text": text[-budget:]})  # ตอนล่าสุดต้องมีเสมอ (เก็บท้ายตอน)
+            break
+        recent.append(ch)
+        budget -= len(text)
+    recent.reverse()
+
+    last_index = candidates[0]["index"] if candidates else upto
+    if not candidates and not summary:
+        # story เก่าที่ไม่มีแถว chapter เลย -> โหลด full_text เฉพาะกรณีนี้
+        full_text = story.get("full_text")
+        if full_text is None:
+            full_text = (storage.get_story(story["id"]) or {}).get("full_text") or ""
+        recent = [{"index": 1, "title": "Chapter 1", "text": full_text[-NEXT_VERBATIM_CHARS:]}]
+        last_index = 1
+
+    return {
+        "summary": summary["summary"] if summary else "",
+        "recent": recent,
+        "last_index": last_index,
+    }
+
+
+def summary_prompt(summary: str, chapter: Dict[str, Any]) -> str:
+    return f"""{SUMMARY_RULES}
+[Summary so far]
+{summary or "(none - this is the first chapter)"}
+
+[New chapter {chapter["index"]}: {chapter["title"]}]
+{chapter["text"]}
+"""
+
+
+async def catch_up(story_id: int, generate: Callable[[str], Awaitable[str]]) -> Dict[str, int]:
+    """
+    Fold every chapter that left the verbatim window into the rolling
+    summary, one chapter per LLM call; progress is saved after each one.
+    """
+    # storage เป็น sqlite แบบ sync -> เรียกใน thread ไม่ให้ block event loop
+    summary = await asyncio.to_thread(storage.get_summary, story_id)
+    upto = summary["upto_index"] if summary else 0
+    text = summary["summary"] if summary else ""
+    folded = 0
+
+    # อ่าน max ใหม่ทุกรอบ: ตอนที่เพิ่มระหว่างรันจะถูกสรุปต่อใน job เดียวกัน
+    while upto < summary_target((await asyncio.to_thread(storage.chapter_stats, story_id))["max_index"]):
+        nxt = await asyncio.to_thread(storage.chapters_after, story_id, upto, 1)
+        if not nxt:
+            break
+        chapter = nxt[0]
+        text = (await generate(summary_prompt(text, chapter))).strip()[:SUMMARY_MAX_CHARS]
+        upto = chapter["index"]
+        await asyncio.to_thread(storage.save_summary, story_id, upto, text)
+        folded += 1
+
+    return {"upto_index": upto, "folded": folded}
@@ -0,0 +1,58 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+_SECTION_RE = re.compile(r"^\[(.+?)\]\s*$")
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format one Server-Sent Event frame."""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+class SectionParser:
+    """
+    Incremental parser for the [Title] / [Story] / [Chapter Title] ... format.
+
+    feed() รับ chunk ทีละชิ้นจาก stream แล้วคืน event ที่เกิดขึ้น:
+    - ("section", {"name": ...}) เมื่อเจอหัวข้อ [xxx] ใหม่
+    - ("title", {"title": ...}) บรรทัดแรกที่ไม่ว่างใต้ title_section
+    """
+
+    def __init__(self, title_section: str = "Title"):
+        self.title_section = title_section
+        self.section: Optional[str] = None
+        self.title = ""
+        self._parts: List[str] = []
+        self._pending = ""
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def feed(self, chunk: str) -> List[Tuple[str, Dict[str, Any]]]:
+        self._parts.append(chunk)
+        self._pending += chunk
+
+        events: List[Tuple[str, Dict[str, Any]]] = []
+        *lines, self._pending = self._pending.split("\n")
+        for line in lines:
+            events.extend(self._line(line))
+        return events
+
+    def close(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Flush the last (unterminated) line."""
+        line, self._pending = self._pending, ""
+        return self._line(line) if line else []
+
+    def _line(self, line: str) -> List[Tuple[str, Dict[str, Any]]]:
+        m = _SECTION_RE.match(line.strip())
+        if m:
+            self.section = m.group(1).strip()
+            return [("section", {"name": self.section})]
+
+        if self.section == self.title_section and not self.title and line.strip():
+            self.title = line.strip()
+            return [("title", {"title": self.title})]
+        return []
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# module ของ backend อยู่ที่ระดับบนสุด (ไม่ใช่ package) -> ให้ import ได้จาก tests/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
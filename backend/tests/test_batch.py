@@ -0,0 +1,65 @@
+import asyncio
+import importlib
+import json
+from pathlib import Path
+
+import pytest
+
+import storage
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    # app mount static/templates แบบ relative path -> import จากโฟลเดอร์ backend
+    monkeypatch.chdir(BACKEND_DIR)
+    monkeypatch.setattr(storage, "DB_PATH", str(tmp_path / "stories.db"))
+    yield importlib.import_module("app")
+    storage.close_connections()
+
+
+def test_batch_saves_finished_drafts_when_client_disconnects(app_module, monkeypatch):
+    async def fake_draft(body, idea, request):
+        if idea == "slow":
+            await asyncio.sleep(30)  # ยังไม่เสร็จตอน client หลุด -> ต้องไม่ถูกเก็บ
+        ctx = app_module._story_context(body)
+        return {"options": ctx["options"], "title": f"เรื่อง {idea}", "full_text": f"# เรื่อง {idea}\n\nเนื้อเรื่อง",
+                "illustration_prompt": None}
+
+    monkeypatch.setattr(app_module, "_generate_draft", fake_draft)
+    payload = json.dumps({"items": [{"idea": "fast"}, {"idea": "slow"}], "concurrency": 2}).encode()
+
+    async def main():
+        first_item = asyncio.Event()
+        request_sent = False
+        events = []
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": payload, "more_body": False}
+            await first_item.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                events.append(message.get("body", b""))
+                if b"event: item" in message.get("body", b""):
+                    first_item.set()
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+            "method": "POST", "scheme": "http", "path": "/api/generate/batch", "raw_path": b"/api/generate/batch",
+            "root_path": "", "query_string": b"", "headers": [(b"content-type", b"application/json")],
+            "client": ("127.0.0.1", 1234), "server": ("testserver", 80),
+        }
+        await asyncio.wait_for(app_module.app(scope, receive, send), timeout=10)
+        return events
+
+    events = asyncio.run(main())
+
+    assert not any(b"event: saved" in chunk for chunk in events)
+    stories = storage.list_stories()
+    assert [s["title"] for s in stories] == ["เรื่อง fast"]
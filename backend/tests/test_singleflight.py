@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+N = 20
+
+
+class Upstream:
+    """Fake upstream call: counts invocations and blocks until released."""
+
+    def __init__(self, result=None, error=None):
+        self.calls = 0
+        self.result = result
+        self.error = error
+
+    async def acall(self, release: asyncio.Event):
+        self.calls += 1
+        await release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+async def _concurrent(flights: SingleFlight, upstream: Upstream, n: int = N):
+    release = asyncio.Event()
+    callers = [asyncio.create_task(flights.do("k", lambda: upstream.acall(release))) for _ in range(n)]
+    await asyncio.sleep(0)  # ทุก caller เข้ามาระหว่างที่ call แรกยังไม่จบ
+    release.set()
+    return await asyncio.gather(*callers, return_exceptions=True)
+
+
+def test_concurrent_identical_calls_hit_upstream_once():
+    flights, upstream = SingleFlight(), Upstream(result={"text": "ok"})
+
+    results = asyncio.run(_concurrent(flights, upstream))
+
+    assert upstream.calls == 1
+    assert all(r == {"text": "ok"} for r in results)
+    assert flights.stats() == {"in_flight": 0, "calls": 1, "coalesced": N - 1}
+
+
+def test_exception_reaches_every_waiter():
+    error = RuntimeError("upstream 500")
+    flights, upstream = SingleFlight(), Upstream(error=error)
+
+    results = asyncio.run(_concurrent(flights, upstream))
+
+    assert upstream.calls == 1
+    assert len(results) == N
+    assert all(r is error for r in results)
+
+
+def test_nothing_is_remembered_after_the_call():
+    flights, upstream = SingleFlight(), Upstream(result=1)
+
+    async def twice():
+        await _concurrent(flights, upstream, 3)
+        await _concurrent(flights, upstream, 3)
+
+    asyncio.run(twice())
+    assert upstream.calls == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    flights, upstream = SingleFlight(), Upstream(result="ok")
+
+    async def scenario():
+        release = asyncio.Event()
+        first = asyncio.create_task(flights.do("k", lambda: upstream.acall(release)))
+        second = asyncio.create_task(flights.do("k", lambda: upstream.acall(release)))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == "ok"
+    assert upstream.calls == 1
+
+
+def _blocking(flights: SingleFlight, fn):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def upstream():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return fn()
+
+    results = [None] * N
+
+    def caller(i):
+        try:
+            results[i] = flights.do_blocking("k", upstream)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(N)]
+    for t in threads:
+        t.start()
+    started.wait(5)
+    # ปล่อย leader เมื่อ caller ที่เหลือมารอครบแล้ว
+    while flights.counters["coalesced"] < N - 1:
+        time.sleep(0.001)
+    release.set()
+    for t in threads:
+        t.join(5)
+    return calls, results
+
+
+def test_blocking_identical_calls_hit_upstream_once():
+    calls, results = _blocking(SingleFlight(), lambda: "ok")
+
+    assert len(calls) == 1
+    assert results == ["ok"] * N
+
+
+def test_blocking_exception_reaches_every_waiter():
+    error = ValueError("bad prompt")
+
+    def fail():
+        raise error
+
+    calls, results = _blocking(SingleFlight(), fail)
+
+    assert len(calls) == 1
+    assert all(r is error for r in results)
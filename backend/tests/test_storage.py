@@ -0,0 +1,92 @@
+import sqlite3
+import threading
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DB_PATH", str(tmp_path / "stories.db"))
+    yield
+    storage.close_connections()
+
+
+def _new_story() -> int:
+    draft = {"options": {}, "title": "เรื่องทดสอบ", "full_text": "# เรื่องทดสอบ\n\nตอนที่ 1", "illustration_prompt": None}
+    return storage.create_stories([draft])[0]
+
+
+def test_concurrent_append_chapter_allocates_unique_sequential_indexes(db):
+    story_id = _new_story()
+    threads_n, per_thread = 8, 5
+    start = threading.Barrier(threads_n)
+    got, errors = [], []
+    lock = threading.Lock()
+
+    def worker(n: int):
+        try:
+            start.wait()  # ทุก thread เริ่ม append พร้อมกัน
+            for k in range(per_thread):
+                idx = storage.append_chapter(story_id, f"ตอน {n}-{k}", "เนื้อหา")
+                with lock:
+                    got.append(idx)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(threads_n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    # ตอนที่ 1 คือ full_text ของ create_stories -> append เริ่มที่ 2
+    expected = list(range(2, 2 + threads_n * per_thread))
+    assert sorted(got) == expected
+    assert [c["index"] for c in storage.list_chapters(story_id)] == [1] + expected
+    stats = storage.chapter_stats(story_id)
+    assert (stats["count"], stats["max_index"]) == (1 + threads_n * per_thread, expected[-1])
+
+
+def _v1_database(path: str):
+    """Database as it was at schema version 1 (no unique index, no cascade)."""
+    con = sqlite3.connect(path)
+    storage._m001_base(con)
+    con.execute("CREATE TABLE schema_version (version INTEGER PRIMARY KEY, applied_at TEXT NOT NULL)")
+    con.execute("INSERT INTO schema_version VALUES (1, '2025-01-01T00:00:00')")
+    for sid in (1, 2):
+        con.execute(
+            "INSERT INTO stories(id, created_at, options_json, title, full_text) VALUES(?, '2025-01-01', '{}', ?, '')",
+            (sid, f"เรื่อง {sid}"),
+        )
+    # (id, story_id, chapter_index): ตอนซ้ำจาก /api/next ที่ชนกัน + ตอนของ story ที่ถูกลบไปแล้ว
+    rows = [(1, 1, 1), (2, 1, 2), (3, 1, 2), (4, 1, 3), (5, 2, 1), (6, 2, 1), (7, 99, 1)]
+    con.executemany(
+        "INSERT INTO chapters(id, story_id, chapter_index, chapter_title, chapter_text, created_at) "
+        "VALUES(?, ?, ?, 'ตอน', '', '2025-01-01')",
+        rows,
+    )
+    con.commit()
+    con.close()
+
+
+def test_m002_renumbers_duplicates_drops_orphans_and_cascades(db):
+    _v1_database(storage.DB_PATH)
+
+    storage.init_db()
+
+    con = sqlite3.connect(storage.DB_PATH)
+    chapters = con.execute("SELECT id, story_id, chapter_index FROM chapters ORDER BY id").fetchall()
+    # ตอนซ้ำถูกย้ายไปต่อท้ายเรื่องของตัวเอง (ไม่ทิ้งเนื้อหา), orphan (story 99) หายไป
+    assert chapters == [(1, 1, 1), (2, 1, 2), (3, 1, 4), (4, 1, 3), (5, 2, 1), (6, 2, 2)]
+    assert con.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] == storage.MIGRATIONS[-1][0]
+    con.close()
+
+    assert storage.delete_story(1)
+    assert [c["index"] for c in storage.list_chapters(2)] == [1, 2]
+    assert storage.list_chapters(1) == []
+    con = sqlite3.connect(storage.DB_PATH)
+    assert con.execute("SELECT story_id, COUNT(*) FROM chapters GROUP BY story_id").fetchall() == [(2, 2)]
+    con.close()